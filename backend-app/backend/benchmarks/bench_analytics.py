@@ -0,0 +1,79 @@
+"""
+Benchmark the admin analytics over a synthetic snapshot: export time and the latency of
+spending_by for each grouping, cold (first load after an export) and warm.
+
+    python benchmarks/bench_analytics.py [--receipts N] [--users N] [--years N]
+"""
+
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src import analytics  # noqa: E402
+
+VENDORS = ["KEDAI BUKU SRI MAJU", "FARMASI ALPRO", "POPULAR BOOKSTORE", "KLINIK MEDIVIRON", "DECATHLON", "MR DIY"]
+CATEGORIES = ["Books", "Medical", "Sports", "Lifestyle", "Childcare"]
+
+
+def synthetic_rows(receipts: int, users: int, years: int):
+    rng = random.Random(0)
+    first_year = 2025 - years + 1
+    rows = []
+    for index in range(receipts):
+        year = rng.randint(first_year, 2025)
+        month = rng.randint(1, 12)
+        rows.append(
+            {
+                "receipt_username": f"user{rng.randrange(users)}",
+                "receipt_id": f"r{index}",
+                "version": 1,
+                "receipt_date": f"{year}-{month:02d}-{rng.randint(1, 28):02d}",
+                "year": year,
+                "month": month,
+                "total": round(rng.uniform(1, 500), 2),
+                "vendor": rng.choice(VENDORS),
+                "category": rng.choice(CATEGORIES),
+                "receipt_status": "approved",
+            }
+        )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--years", type=int, default=5)
+    args = parser.parse_args()
+
+    if not analytics.available():
+        raise SystemExit("pyarrow is not installed: pip install -r requirements-analytics.txt")
+
+    rows = synthetic_rows(args.receipts, args.users, args.years)
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        store = analytics.LocalSnapshotStore(snapshot_dir)
+        start = time.perf_counter()
+        analytics.export_snapshot(store, rows=rows)
+        print(f"export {len(rows)} rows: {time.perf_counter() - start:.2f}s")
+
+        start = time.perf_counter()
+        table = analytics.load_snapshot(store)
+        print(f"load snapshot (cold): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        for group in analytics.GROUP_COLUMNS:
+            start = time.perf_counter()
+            results = analytics.spending_by(analytics.load_snapshot(store), group)
+            print(f"spending by {group:<8}: {(time.perf_counter() - start) * 1000:7.1f} ms ({len(results)} groups)")
+
+        start = time.perf_counter()
+        analytics.spending_by(table, "month", username="user42")
+        print(f"spending by month, one user: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
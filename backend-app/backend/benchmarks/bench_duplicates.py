@@ -0,0 +1,52 @@
+"""
+Benchmark near-duplicate image hash lookups: a MultiIndexHash search against comparing the
+upload with every stored hash, for one user's receipt count.
+
+    python benchmarks/bench_duplicates.py [--receipts 1000,10000,100000] [--distance 8] [--queries N]
+
+Stored hashes are random 64-bit values; queries are stored hashes with a few bits flipped,
+as a re-shot photo of a receipt would be.
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.duplicates import MultiIndexHash, hamming_distance  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", default="1000,10000,100000")
+    parser.add_argument("--distance", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    for count in (int(value) for value in args.receipts.split(",")):
+        hashes = [rng.getrandbits(64) for _ in range(count)]
+        start = time.perf_counter()
+        index = MultiIndexHash()
+        for position, value in enumerate(hashes):
+            index.add(value, position)
+        build_s = time.perf_counter() - start
+
+        queries = [rng.choice(hashes) ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)) for _ in range(args.queries)]
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query, args.distance)
+        index_us = (time.perf_counter() - start) / len(queries) * 1e6
+        start = time.perf_counter()
+        for query in queries:
+            [position for position, value in enumerate(hashes) if hamming_distance(query, value) <= args.distance]
+        linear_us = (time.perf_counter() - start) / len(queries) * 1e6
+
+        print(f"{count:>8,} hashes  build {build_s * 1000:8.1f} ms  multi-index {index_us:9.1f} us/query  linear {linear_us:9.1f} us/query  ({linear_us / index_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
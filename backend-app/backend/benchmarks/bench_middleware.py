@@ -0,0 +1,107 @@
+"""
+Benchmark per-request middleware overhead on a receipts route, with the browser's session
+cookie attached as it is on every request: SessionMiddleware on all routes (before) against
+AuthSessionMiddleware, which only runs it under /auth (after).
+
+    python benchmarks/bench_middleware.py [--requests N]
+
+Requests are sent straight to the ASGI app, so the numbers are framework and middleware
+time only, without a network or server in between.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from starlette.middleware.sessions import SessionMiddleware  # noqa: E402
+
+from src.middleware import AuthSessionMiddleware  # noqa: E402
+
+SECRET_KEY = "bench-secret"
+
+
+def build_app(session_middleware) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(session_middleware, secret_key=SECRET_KEY, same_site="lax", https_only=False)
+    app.add_middleware(CORSMiddleware, allow_origins=["http://localhost:3000"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+
+    @app.get("/receipts/view")
+    async def view_receipts():
+        return []
+
+    @app.get("/auth/login")
+    async def login():
+        return {}
+
+    return app
+
+
+async def session_cookie() -> bytes:
+    """A signed session cookie as left behind by the OAuth login flow."""
+    cookies = []
+
+    async def app(scope, receive, send):
+        scope["session"]["oauth_state"] = {"state": "x" * 32, "nonce": "y" * 32, "redirect_uri": "http://localhost:8000/auth/authorize"}
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            cookies.extend(value.split(b";")[0] for name, value in message["headers"] if name == b"set-cookie")
+
+    await SessionMiddleware(app, secret_key=SECRET_KEY)({"type": "http", "path": "/", "headers": []}, None, send)
+    return cookies[0]
+
+
+async def run(app: FastAPI, path: str, cookie: bytes, requests: int) -> float:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"origin", b"http://localhost:3000"), (b"cookie", cookie + b"; access_token=" + b"t" * 900)],
+        "client": ("127.0.0.1", 1234),
+        "server": ("localhost", 8000),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for _ in range(200):
+        await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20_000)
+    args = parser.parse_args()
+
+    cookie = await session_cookie()
+    before = build_app(SessionMiddleware)
+    after = build_app(AuthSessionMiddleware)
+    for path in ("/receipts/view", "/auth/login"):
+        before_us = await run(before, path, cookie, args.requests)
+        after_us = await run(after, path, cookie, args.requests)
+        print(f"{path:<16} before {before_us:6.1f} us/request  after {after_us:6.1f} us/request  ({before_us - after_us:+.1f} us saved)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
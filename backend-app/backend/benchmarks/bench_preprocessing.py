@@ -0,0 +1,122 @@
+"""
+Benchmark the upload preprocessing stage: throughput serially and through the process
+pool, bytes saved, and (when pytesseract and the tesseract binary are available) OCR
+accuracy of the optimised image against the original.
+
+    python benchmarks/bench_preprocessing.py [--images DIR] [--count N] [--workers N]
+
+Without --images, synthetic 4000x3000 receipt photos with known text are generated.
+"""
+
+import argparse
+import difflib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from PIL import Image, ImageDraw, ImageFont  # noqa: E402
+
+from src.preprocessing import preprocess_image  # noqa: E402
+
+RECEIPT_LINES = [
+    "KEDAI BUKU SRI MAJU",
+    "NO 12 JALAN SS2/24 PETALING JAYA",
+    "DATE: 14/03/2024  TIME: 13:45",
+    "INVOICE NO: 000123",
+    "NOTEBOOK A4          2 x 6.50   13.00",
+    "PEN BLUE             3 x 1.20    3.60",
+    "SUBTOTAL                        16.60",
+    "SST 6%                           1.00",
+    "TOTAL                           17.60",
+    "CASH                            20.00",
+    "CHANGE                           2.40",
+]
+
+
+def synthetic_receipt(width: int = 4000, height: int = 3000) -> bytes:
+    """A landscape phone photo of a receipt that needs rotating, with sensor noise."""
+    receipt = Image.new("RGB", (height, width), (245, 242, 235))
+    draw = ImageDraw.Draw(receipt)
+    try:
+        font = ImageFont.load_default(size=90)
+    except TypeError:
+        font = ImageFont.load_default()
+    for index, line in enumerate(RECEIPT_LINES):
+        draw.text((150, 300 + index * 220), line, fill=(20, 20, 20), font=font)
+
+    noise = Image.effect_noise(receipt.size, 25).convert("RGB")
+    receipt = Image.blend(receipt, noise, 0.15).rotate(90, expand=True)
+
+    exif = Image.Exif()
+    exif[0x0112] = 6  # viewer must rotate 90 degrees clockwise
+    output = io.BytesIO()
+    receipt.save(output, format="JPEG", quality=95, exif=exif)
+    return output.getvalue()
+
+
+def ocr_text(data: bytes):
+    try:
+        import pytesseract
+        from PIL import ImageOps
+
+        with Image.open(io.BytesIO(data)) as image:
+            return pytesseract.image_to_string(ImageOps.exif_transpose(image))
+    except Exception:
+        return None
+
+
+def similarity(text: str, expected: str) -> float:
+    return difflib.SequenceMatcher(None, " ".join(text.split()), " ".join(expected.split())).ratio()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=Path, help="Directory of real receipt photos to use instead of synthetic ones")
+    parser.add_argument("--count", type=int, default=16, help="Number of synthetic images")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="Process pool size")
+    args = parser.parse_args()
+
+    if args.images:
+        images = [path.read_bytes() for path in sorted(args.images.iterdir()) if path.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp")]
+        expected = None
+    else:
+        images = [synthetic_receipt()] * args.count
+        expected = "\n".join(RECEIPT_LINES)
+    if not images:
+        raise SystemExit("No images found")
+
+    original_bytes = sum(len(image) for image in images)
+    print(f"{len(images)} images, {original_bytes / len(images) / 1e6:.2f} MB average")
+
+    start = time.perf_counter()
+    results = [preprocess_image(image) for image in images]
+    serial_seconds = time.perf_counter() - start
+    print(f"serial:            {len(images) / serial_seconds:6.2f} images/s")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(preprocess_image, images[: args.workers]))  # warm up the workers
+        start = time.perf_counter()
+        list(executor.map(preprocess_image, images))
+        pool_seconds = time.perf_counter() - start
+    print(f"pool ({args.workers} workers): {len(images) / pool_seconds:6.2f} images/s")
+
+    optimized_bytes = sum(len(result[0]) if result else len(image) for image, result in zip(images, results))
+    print(f"bytes: {original_bytes / 1e6:.2f} MB -> {optimized_bytes / 1e6:.2f} MB ({optimized_bytes / original_bytes:.1%})")
+
+    original_text = ocr_text(images[0])
+    if original_text is None:
+        print("OCR accuracy: skipped (pytesseract/tesseract not available)")
+        return
+    optimized_text = ocr_text(results[0][0] if results[0] else images[0])
+    if expected:
+        print(f"OCR accuracy vs ground truth: original {similarity(original_text, expected):.1%}, optimised {similarity(optimized_text, expected):.1%}")
+    print(f"OCR agreement original vs optimised: {similarity(optimized_text, original_text):.1%}")
+
+
+if __name__ == "__main__":
+    main()
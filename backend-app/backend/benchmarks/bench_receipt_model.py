@@ -0,0 +1,111 @@
+"""
+Benchmark materialising receipts as the DynamoDB resource API returns them (dicts of
+Decimals) against Receipt objects: memory held per receipt and conversion throughput.
+
+    python benchmarks/bench_receipt_model.py [--receipts N]
+
+Items are deserialized from typed DynamoDB JSON with boto3's TypeDeserializer, so every
+item owns its strings and Decimals exactly as query results do. Memory is measured with
+tracemalloc as the growth while the list is held.
+"""
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer  # noqa: E402
+
+from src.models.receipts import Receipt  # noqa: E402
+
+VENDORS = ["AEON BIG", "GUARDIAN PHARMACY", "POPULAR BOOKSTORE", "SHELL TTDI", "KLINIK MEDIVIRON", "MR DIY"]
+CATEGORIES = ["medical", "books", "fuel", "groceries", "sports", "lifestyle"]
+
+
+def raw_item(index: int) -> dict:
+    """A list-row item in low-level typed form, as it comes over the wire."""
+    receipt_date = f"{random.choice([2023, 2024, 2025])}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}"
+    item = {
+        "receipt_username": f"user{index % 50}",
+        "receipt_id": str(uuid.uuid4()),
+        "receipt_filename": f"receipt_{index}.jpg",
+        "receipt_status": random.choice(["pending", "approved", "rejected"]),
+        "receipt_upload_datetime": f"{receipt_date}T10:{random.randint(0, 59):02d}:12.345678",
+        "receipt_size": random.randint(80_000, 900_000),
+        "receipt_date": receipt_date,
+        "receipt_summary": {"total": Decimal(f"{random.uniform(5, 500):.2f}"), "date": receipt_date, "vendor": random.choice(VENDORS), "category": random.choice(CATEGORIES)},
+        "version": random.randint(1, 5),
+    }
+    serializer = TypeSerializer()
+    return {name: serializer.serialize(value) for name, value in item.items()}
+
+
+def held_bytes(build) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held, size
+
+
+def timed(fn, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, default=100_000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    deserializer = TypeDeserializer()
+    raw_items = [raw_item(index) for index in range(args.receipts)]
+
+    def deserialize():
+        return [{name: deserializer.deserialize(value) for name, value in item.items()} for item in raw_items]
+
+    def materialise():
+        # Each item dict is dropped once converted, as in /receipts/view
+        return [Receipt.from_item({name: deserializer.deserialize(value) for name, value in item.items()}) for item in raw_items]
+
+    receipts, receipt_bytes = held_bytes(materialise)
+    items, dict_bytes = held_bytes(deserialize)
+
+    count = args.receipts
+    print(f"{count:,} receipts")
+    print(f"  held as dicts     {dict_bytes / 2**20:7.1f} MiB  ({dict_bytes / count:5.0f} B/receipt)")
+    print(f"  held as Receipt   {receipt_bytes / 2**20:7.1f} MiB  ({receipt_bytes / count:5.0f} B/receipt)")
+
+    deserialize_s = timed(deserialize)
+    from_item_s = timed(lambda: [Receipt.from_item(item) for item in items])
+    to_item_s = timed(lambda: [receipt.to_item() for receipt in receipts])
+    list_row_s = timed(lambda: [receipt.list_row() for receipt in receipts])
+    sort_dicts_s = timed(lambda: sorted(items, key=lambda x: (str(x.get("receipt_date", "")), str(x.get("receipt_upload_datetime", ""))), reverse=True))
+    sort_receipts_s = timed(lambda: sorted(receipts, key=Receipt.sort_key, reverse=True))
+    total_dicts_s = timed(lambda: sum(float(item.get("receipt_summary", {}).get("total", 0)) for item in items))
+    total_receipts_s = timed(lambda: sum(receipt.total for receipt in receipts))
+
+    print(f"  deserialize (boto3)  {count / deserialize_s:12,.0f} receipts/s")
+    print(f"  Receipt.from_item    {count / from_item_s:12,.0f} receipts/s")
+    print(f"  Receipt.to_item      {count / to_item_s:12,.0f} receipts/s")
+    print(f"  Receipt.list_row     {count / list_row_s:12,.0f} receipts/s")
+    print(f"  sort dicts           {sort_dicts_s * 1000:9.1f} ms   sort Receipts  {sort_receipts_s * 1000:9.1f} ms")
+    print(f"  total of dicts       {total_dicts_s * 1000:9.1f} ms   total of Receipts  {total_receipts_s * 1000:5.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark encoding the /receipts/view list and a /receipts/view/{id} detail: FastAPI's
+default path (jsonable_encoder, then json.dumps) before, against CompactJSONResponse
+(orjson) and MessagePack after, with the bytes each sends uncompressed, gzipped and, when
+the brotli package is installed, with brotli.
+
+    python benchmarks/bench_responses.py [--receipts 100,1000,5000] [--repeat N]
+
+Items carry Decimal values as the DynamoDB resource API returns them.
+"""
+
+import argparse
+import gzip
+import random
+import sys
+import time
+import uuid
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from src.middleware import brotli  # noqa: E402
+from src.ocr import expense_response_from_lines  # noqa: E402
+from src.responses import CompactJSONResponse, MessagePackResponse, msgpack  # noqa: E402
+
+VENDORS = ["AEON BIG", "GUARDIAN PHARMACY", "POPULAR BOOKSTORE", "SHELL TTDI", "KLINIK MEDIVIRON", "MR DIY"]
+CATEGORIES = ["medical", "books", "fuel", "groceries", "sports", "lifestyle"]
+
+
+def receipt_row(index: int) -> dict:
+    receipt_date = f"{random.choice([2023, 2024, 2025])}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}"
+    return {
+        "receipt_id": str(uuid.uuid4()),
+        "receipt_filename": f"receipt_{index}.jpg",
+        "receipt_status": random.choice(["pending", "approved", "rejected"]),
+        "receipt_upload_datetime": f"{receipt_date}T{random.randint(0, 23):02d}:{random.randint(0, 59):02d}:12.345678",
+        "receipt_size": Decimal(random.randint(80_000, 900_000)),
+        "receipt_date": receipt_date,
+        "receipt_summary": {
+            "total": Decimal(f"{random.uniform(5, 500):.2f}"),
+            "date": receipt_date,
+            "vendor": random.choice(VENDORS),
+            "category": random.choice(CATEGORIES),
+        },
+        "version": Decimal(random.randint(1, 5)),
+    }
+
+
+def receipt_detail() -> dict:
+    lines = [(random.choice(VENDORS), 99.1), ("Date: 12/03/2024", 98.7)]
+    lines += [(f"ITEM {index} x{random.randint(1, 3)} {random.uniform(1, 90):.2f}", random.uniform(85, 99)) for index in range(40)]
+    lines += [("SUBTOTAL 123.40", 99.0), ("SST 6% 7.40", 98.2), ("TOTAL 130.80", 99.5)]
+    return {**receipt_row(0), "textract_data": expense_response_from_lines(lines), "image_url": "/receipts/image/x"}
+
+
+def fastapi_default(content) -> bytes:
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def timed(encode, content, repeat: int):
+    encode(content)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = encode(content)
+    return (time.perf_counter() - start) / repeat * 1000, body
+
+
+def report(name: str, content, repeat: int):
+    encoders = [("default", fastapi_default), ("orjson", lambda c: CompactJSONResponse(c).body)]
+    if msgpack is not None:
+        encoders.append(("msgpack", lambda c: MessagePackResponse(c).body))
+    print(name)
+    for label, encode in encoders:
+        encode_ms, body = timed(encode, content, repeat)
+        sizes = f"raw {len(body):>9,} B  gzip {len(gzip.compress(body, 6)):>8,} B"
+        if brotli is not None:
+            sizes += f"  br {len(brotli.compress(body, quality=4)):>8,} B"
+        print(f"  {label:<8} encode {encode_ms:8.2f} ms  {sizes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", default="100,1000,5000", help="List sizes of /receipts/view")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(1)
+    for count in (int(value) for value in args.receipts.split(",")):
+        report(f"/receipts/view with {count} receipts", [receipt_row(index) for index in range(count)], args.repeat)
+    report("/receipts/view/{id} with inline OCR data", receipt_detail(), args.repeat * 50)
+    if msgpack is None or brotli is None:
+        print("(install msgpack and brotli for the MessagePack and brotli numbers)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark ParallelScan against the local DynamoDB stand-in: scan rate by segment count,
+and with --read-capacity, how the adaptive backoff copes with throttling.
+
+    python benchmarks/bench_scan.py [--items N] [--item-bytes N] [--latency SECONDS] [--segments 1,2,4,8,16] [--read-capacity UNITS]
+
+The stand-in serves 1 MB pages with a fixed per-call latency, so the numbers show how well
+parallel segments hide request latency, not DynamoDB's absolute throughput.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.local_aws import FakeTable  # noqa: E402
+from src.scan import ParallelScan  # noqa: E402
+
+
+def build_table(items: int, item_bytes: int, latency: float, read_capacity: float = None) -> FakeTable:
+    table = FakeTable("receipt_username", "receipt_id", read_capacity=read_capacity)
+    padding = "x" * max(0, item_bytes - 120)
+    for index in range(items):
+        table.put_item(Item={"receipt_username": f"user{index % 500}", "receipt_id": f"{index:08d}", "receipt_status": "approved", "textract_data": {"raw": padding}})
+    # Only the scans being measured pay the request latency
+    table.latency = latency
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=20_000)
+    parser.add_argument("--item-bytes", type=int, default=2_000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per Scan call")
+    parser.add_argument("--segments", default="1,2,4,8,16")
+    parser.add_argument("--read-capacity", type=float, default=None, help="Provisioned read units per second of the stand-in")
+    args = parser.parse_args()
+
+    table = build_table(args.items, args.item_bytes, args.latency, args.read_capacity)
+    print(f"{args.items} items of ~{args.item_bytes} bytes, {args.latency * 1000:.0f} ms per call")
+
+    baseline = None
+    for segments in [int(value) for value in args.segments.split(",")]:
+        table.calls.clear()
+        scan = ParallelScan(table, total_segments=segments)
+        start = time.perf_counter()
+        count = sum(len(page) for page in scan)
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed
+        baseline = baseline or rate
+        print(f"{segments:3d} segments: {rate:9.0f} items/s  {elapsed:6.2f}s  {table.calls.get('scan', 0):4d} calls  {scan.stats['throttled']:4d} throttled  x{rate / baseline:.1f}")
+        assert count == args.items
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,10 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from mangum import Mangum
-from starlette.middleware.sessions import SessionMiddleware
-from src.config import SECRET_KEY
+from src.config import MAINTENANCE_SCHEDULER_ENABLED, SECRET_KEY, TRAFFIC_CAPTURE_PATH
+from src.maintenance import scheduler as maintenance_scheduler
+from src.middleware import AuthSessionMiddleware, CompressionMiddleware, TokenExpiryMiddleware, TrafficCaptureMiddleware
+from src.routers.admin import admin_router
 from src.routers.auth import auth_router
 from src.routers.receipts import receipts_router
 
@@ -16,22 +18,46 @@ logger.setLevel(logging.INFO)
 
 app = FastAPI()
 
+# Only the OAuth login flow under /auth uses the session
 app.add_middleware(
-    SessionMiddleware,
+    AuthSessionMiddleware,
     secret_key=SECRET_KEY,
     same_site="lax",
     https_only=False,
 )
 
+app.add_middleware(TokenExpiryMiddleware)
+
+# gzip or brotli for large JSON/MessagePack responses, never for the event stream
+app.add_middleware(CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://localhost:5173"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Token-Expires-In", "Idempotent-Replayed"],
 )
+
+# Outermost, so captured sizes and durations are what clients see
+if TRAFFIC_CAPTURE_PATH:
+    app.add_middleware(TrafficCaptureMiddleware)
+
 app.include_router(auth_router)
 app.include_router(receipts_router)
+app.include_router(admin_router)
+
+
+@app.on_event("startup")
+async def start_maintenance():
+    if MAINTENANCE_SCHEDULER_ENABLED:
+        maintenance_scheduler.start()
+
+
+@app.on_event("shutdown")
+async def stop_maintenance():
+    await maintenance_scheduler.stop()
 
 
 @app.get("/", response_class=HTMLResponse)
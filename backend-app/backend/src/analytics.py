@@ -0,0 +1,279 @@
+"""
+Columnar snapshots of the receipts table for cross-user, multi-year reporting, so admin
+analytics never scan the live table.
+
+An export reads the table with a parallel segmented scan, projected to the summary
+attributes, and writes one Parquet file per receipt year:
+
+    year=2024/receipts.parquet
+    manifest.json                per-year row count and content fingerprint
+
+By default these are objects under SNAPSHOT_S3_PREFIX in the receipts bucket, so every
+instance (and Lambda, which has no writable app directory) exports to and reads the same
+snapshot. With SNAPSHOT_S3_PREFIX empty or no bucket configured they are files in the
+local SNAPSHOT_DIR, which only the instance that wrote them sees.
+
+Exports are incremental: a year is rewritten only when the (receipt, version) pairs in it
+changed, and years with no receipts left are removed. Analytics load the snapshot once
+per export and aggregate with Arrow's vectorised group-by.
+
+    python -m src.analytics [--segments N] [--dir DIR]
+
+Needs pyarrow (requirements-analytics.txt), which is not part of the API's base install.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from botocore.exceptions import ClientError
+
+from src.config import SNAPSHOT_DIR, SNAPSHOT_S3_PREFIX, SNAPSHOT_SCAN_SEGMENTS, receipt_bucket, receipt_db
+from src.scan import ParallelScan
+from src.utils import projection
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+SNAPSHOT_ATTRIBUTES = ["receipt_username", "receipt_id", "version", "receipt_date", "receipt_upload_datetime", "receipt_status", "receipt_summary"]
+GROUP_COLUMNS = {"year": ["year"], "month": ["year", "month"], "vendor": ["year", "vendor"], "category": ["year", "category"]}
+MANIFEST_FILE = "manifest.json"
+
+_cache_lock = threading.Lock()
+_cache: Dict[str, Tuple[Optional[str], object]] = {}
+
+
+class LocalSnapshotStore:
+    """Snapshot files in a local directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.location = os.path.abspath(directory)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, *name.split("/"))
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self.path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name: str, data: bytes):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temp file of its own per writer, so concurrent exports never write into each other's
+        temp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tmp-", delete=False)
+        try:
+            with temp:
+                temp.write(data)
+            os.replace(temp.name, path)
+        except BaseException:
+            os.unlink(temp.name)
+            raise
+
+    def delete(self, name: str):
+        path = self.path(name)
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+class S3SnapshotStore:
+    """Snapshot objects under a key prefix of a bucket."""
+
+    def __init__(self, bucket, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/") + "/"
+        self.location = f"s3://{bucket.name}/{self.prefix}"
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            return self.bucket.Object(self.prefix + name).get()["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def write(self, name: str, data: bytes):
+        self.bucket.put_object(Key=self.prefix + name, Body=data)
+
+    def delete(self, name: str):
+        self.bucket.Object(self.prefix + name).delete()
+
+
+SnapshotStore = Union[LocalSnapshotStore, S3SnapshotStore]
+
+
+def default_store() -> SnapshotStore:
+    if SNAPSHOT_S3_PREFIX and receipt_bucket is not None:
+        return S3SnapshotStore(receipt_bucket, SNAPSHOT_S3_PREFIX)
+    return LocalSnapshotStore(SNAPSHOT_DIR)
+
+
+def available() -> bool:
+    return pa is not None
+
+
+def snapshot_schema():
+    return pa.schema(
+        [
+            ("receipt_username", pa.string()),
+            ("receipt_id", pa.string()),
+            ("version", pa.int64()),
+            ("receipt_date", pa.string()),
+            ("year", pa.int32()),
+            ("month", pa.int8()),
+            ("total", pa.float64()),
+            ("vendor", pa.string()),
+            ("category", pa.string()),
+            ("receipt_status", pa.string()),
+        ]
+    )
+
+
+def snapshot_row(item: dict) -> Optional[dict]:
+    """Flatten a receipt item into a snapshot row. Receipts without any date are left out."""
+    receipt_date = item.get("receipt_date") or item.get("receipt_upload_datetime", "")[:10]
+    if len(receipt_date) < 7:
+        return None
+    summary = item.get("receipt_summary", {})
+    vendor = " ".join(str(summary.get("vendor", "")).split()).upper()
+    return {
+        "receipt_username": item["receipt_username"],
+        "receipt_id": item["receipt_id"],
+        "version": int(item.get("version", 0)),
+        "receipt_date": receipt_date,
+        "year": int(receipt_date[:4]),
+        "month": int(receipt_date[5:7]),
+        "total": float(summary.get("total", 0)),
+        "vendor": vendor or None,
+        "category": summary.get("category"),
+        "receipt_status": item.get("receipt_status"),
+    }
+
+
+def scan_snapshot_pages(total_segments: int = SNAPSHOT_SCAN_SEGMENTS, throttle=None) -> Iterator[List[dict]]:
+    """Pages of receipts projected to SNAPSHOT_ATTRIBUTES; a throttle paces the reads."""
+    projection_expression, projection_names = projection(SNAPSHOT_ATTRIBUTES)
+    return iter(ParallelScan(receipt_db, total_segments, throttle=throttle, ProjectionExpression=projection_expression, ExpressionAttributeNames=projection_names))
+
+
+def scan_snapshot_rows(total_segments: int = SNAPSHOT_SCAN_SEGMENTS) -> List[dict]:
+    return [row for page in scan_snapshot_pages(total_segments) for row in map(snapshot_row, page) if row]
+
+
+def fingerprint(rows: List[dict]) -> str:
+    digest = hashlib.sha256()
+    for key in sorted(f"{row['receipt_username']}\x1f{row['receipt_id']}\x1f{row['version']}" for row in rows):
+        digest.update(key.encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+
+def read_manifest(store: Optional[SnapshotStore] = None) -> dict:
+    data = (store or default_store()).read(MANIFEST_FILE)
+    return json.loads(data) if data is not None else {"years": {}}
+
+
+def partition_name(year: int) -> str:
+    return f"year={year}/receipts.parquet"
+
+
+def export_snapshot(store: Optional[SnapshotStore] = None, total_segments: int = SNAPSHOT_SCAN_SEGMENTS, rows: Optional[List[dict]] = None) -> Dict[str, int]:
+    """Export the receipts table to year partitions, rewriting only the years that changed."""
+    store = store or default_store()
+    if rows is None:
+        rows = scan_snapshot_rows(total_segments)
+    by_year: Dict[int, List[dict]] = {}
+    for row in rows:
+        by_year.setdefault(row["year"], []).append(row)
+
+    manifest = read_manifest(store)
+    previous = manifest.get("years", {})
+    years = {}
+    stats = {"rows": len(rows), "years_written": 0, "years_unchanged": 0, "years_removed": 0}
+    for year, year_rows in sorted(by_year.items()):
+        year_fingerprint = fingerprint(year_rows)
+        years[str(year)] = {"rows": len(year_rows), "fingerprint": year_fingerprint}
+        if previous.get(str(year), {}).get("fingerprint") == year_fingerprint:
+            stats["years_unchanged"] += 1
+            continue
+        year_rows.sort(key=lambda row: (row["receipt_username"], row["receipt_date"]))
+        sink = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_pylist(year_rows, schema=snapshot_schema()), sink, compression="zstd")
+        store.write(partition_name(year), sink.getvalue().to_pybytes())
+        stats["years_written"] += 1
+
+    for year in set(previous) - set(years):
+        store.delete(partition_name(int(year)))
+        stats["years_removed"] += 1
+
+    # Written last, so readers only see partitions that are complete
+    manifest = {"exported_at": datetime.now().isoformat(), "years": years}
+    store.write(MANIFEST_FILE, json.dumps(manifest, indent=2).encode("utf-8"))
+    return stats
+
+
+def load_snapshot(store: Optional[SnapshotStore] = None):
+    """The whole snapshot as one Arrow table, cached until the next export replaces the manifest."""
+    store = store or default_store()
+    manifest = read_manifest(store)
+    if "exported_at" not in manifest:
+        return None
+
+    with _cache_lock:
+        cached = _cache.get(store.location)
+        if cached and cached[0] == manifest["exported_at"]:
+            return cached[1]
+        tables = []
+        for year in sorted(manifest.get("years", {})):
+            data = store.read(partition_name(int(year)))
+            if data is None:
+                # Removed by an export that finished after this manifest was read
+                continue
+            tables.append(pq.read_table(pa.BufferReader(data)))
+        table = pa.concat_tables(tables) if tables else snapshot_schema().empty_table()
+        _cache[store.location] = (manifest["exported_at"], table)
+        return table
+
+
+def spending_by(table, group: str, years: Optional[List[int]] = None, username: Optional[str] = None) -> List[dict]:
+    """Total spending and receipt count per year and month, vendor or category."""
+    if years:
+        table = table.filter(pc.is_in(table["year"], value_set=pa.array(years, pa.int32())))
+    if username:
+        table = table.filter(pc.equal(table["receipt_username"], username))
+
+    keys = GROUP_COLUMNS[group]
+    grouped = table.group_by(keys).aggregate([("total", "sum"), ("receipt_id", "count")])
+    grouped = grouped.sort_by([(key, "ascending") for key in keys])
+    return [{**{key: row[key] for key in keys}, "total": round(row["total_sum"], 2), "num_receipts": row["receipt_id_count"]} for row in grouped.to_pylist()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the receipts table to year-partitioned Parquet snapshots")
+    parser.add_argument("--segments", type=int, default=SNAPSHOT_SCAN_SEGMENTS, help="Parallel scan segments")
+    parser.add_argument("--dir", help="Export to this local directory instead of the configured snapshot location")
+    args = parser.parse_args()
+
+    if not available():
+        raise SystemExit("pyarrow is not installed: pip install -r requirements-analytics.txt")
+    if receipt_db is None:
+        raise SystemExit("RECEIPT_TABLE and AWS credentials must be configured")
+    print(export_snapshot(LocalSnapshotStore(args.dir) if args.dir else None, args.segments))
+
+
+if __name__ == "__main__":
+    main()
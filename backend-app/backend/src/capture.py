@@ -0,0 +1,175 @@
+"""
+Traffic capture for offline replay with src.replay. TrafficCaptureMiddleware hands each
+sampled request to a TrafficRecorder, which appends it to a JSONL file as one line:
+
+    {"ts": 1718000000.123, "method": "GET", "route": "/receipts/view/{receipt_id}",
+     "path_params": {"receipt_id": "~3f9c0a1e"}, "query": [], "user": 17, "headers": {...},
+     "if_match": false, "content_type": null, "request_bytes": 0, "body": null,
+     "status": 200, "response_type": "application/json", "response_bytes": 4187,
+     "duration_ms": 12.4, "aws_calls": {"dynamodb.GetItem": 1}}
+
+Nothing that identifies a user or a receipt is written. Usernames become one of
+TRAFFIC_CAPTURE_USER_BUCKETS buckets, and every string becomes a keyed pseudonym ("~" and
+8 hex digits) that is stable across the capture, so repeated requests for one receipt
+replay against one receipt. The only strings kept are the enum values in CAPTURED_VALUES
+(statuses, OCR policies, on_duplicate modes), which replay needs to take the same code
+paths, and query parameters that are numbers or dates (year=2024). JSON bodies are kept as
+their sanitised shape, uploads only as size and file type.
+
+AWS calls are counted per request through a context variable: boto3 clients are
+instrumented with instrument_aws_client, and the src.local_aws stand-ins count their
+own calls. Calls made by background tasks count towards the request that started them.
+"""
+
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import parse_qsl
+
+# JSON bodies larger than this are recorded without their shape
+BODY_MAX_BYTES = 64 * 1024
+# Enough of a multipart body to read the file part's headers
+MULTIPART_HEAD_BYTES = 4096
+
+PSEUDONYM_PATTERN = re.compile(r"^~[0-9a-f]{8}$")
+# Query parameters like year=2024, month=3, years=2023,2024 or date=2024-03-01
+CAPTURED_QUERY_PATTERN = re.compile(r"^(\d{1,4}(,\d{1,4})*|\d{4}-\d{2}-\d{2})$")
+# Enum values the API accepts: receipt and OCR statuses, OCR policies, on_duplicate modes
+# and admin aggregate groupings. Any other string could be a name, note or number.
+CAPTURED_VALUES = frozenset(
+    {
+        "pending",
+        "approved",
+        "rejected",
+        "processing",
+        "completed",
+        "failed",
+        "textract",
+        "local",
+        "local_first",
+        "flag",
+        "reject",
+        "year",
+        "month",
+        "vendor",
+        "category",
+        "true",
+        "false",
+        "",
+    }
+)
+UPLOAD_FILENAME_PATTERN = re.compile(rb'filename="[^"\r\n]*?(\.[A-Za-z0-9]{1,5})"')
+UPLOAD_CONTENT_TYPE_PATTERN = re.compile(rb"content-type:\s*([\w.+-]+/[\w.+-]+)", re.IGNORECASE)
+
+_aws_calls: ContextVar[Optional[Dict[str, int]]] = ContextVar("aws_calls", default=None)
+_aws_calls_lock = threading.Lock()
+
+
+def count_aws_call(service: str, operation: str):
+    """Count an AWS call against the request being captured or replayed, if any."""
+    calls = _aws_calls.get()
+    if calls is not None:
+        key = f"{service}.{operation}"
+        # Worker threads of one request share its counter
+        with _aws_calls_lock:
+            calls[key] = calls.get(key, 0) + 1
+
+
+@contextmanager
+def counting_aws_calls() -> Iterator[Dict[str, int]]:
+    """Count the AWS calls made inside the block, including from threads and tasks it starts."""
+    calls: Dict[str, int] = {}
+    token = _aws_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _aws_calls.reset(token)
+
+
+def _count_client_call(model, **kwargs):
+    count_aws_call(model.service_model.service_name, model.name)
+
+
+def instrument_aws_client(client):
+    """Count every call a boto3 client (or resource.meta.client) makes."""
+    client.meta.events.register("before-call", _count_client_call)
+
+
+class TrafficRecorder:
+    """Sanitises captured requests and appends them to a JSONL file."""
+
+    def __init__(self, path: str, secret: str, user_buckets: int = 64, sample_rate: float = 1.0):
+        self.path = path
+        self.user_buckets = user_buckets
+        self.sample_rate = sample_rate
+        self._key = secret.encode("utf-8")
+        self._file = None
+        self._lock = threading.Lock()
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def _digest(self, value: str) -> str:
+        return hmac.new(self._key, value.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def pseudonym(self, value: str) -> str:
+        return "~" + self._digest(value)[:8]
+
+    def user_bucket(self, username: Optional[str]) -> Optional[int]:
+        if not username:
+            return None
+        return int(self._digest(username)[:8], 16) % self.user_buckets
+
+    def sanitize(self, value: Any) -> Any:
+        """Keep the structure, numbers and CAPTURED_VALUES; pseudonymise every other string."""
+        if isinstance(value, dict):
+            return {str(name): self.sanitize(item) for name, item in value.items()}
+        if isinstance(value, list):
+            return [self.sanitize(item) for item in value]
+        if isinstance(value, str):
+            return value if value in CAPTURED_VALUES else self.pseudonym(value)
+        return value
+
+    def sanitize_query(self, query_string: bytes) -> List[List[str]]:
+        return [[name, value if CAPTURED_QUERY_PATTERN.match(value) else self.sanitize(value)] for name, value in parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)]
+
+    def body_shape(self, content_type: str, head: bytes, complete: bool) -> Optional[dict]:
+        """
+        What replay needs to rebuild a request body: {"json": sanitised document} or
+        {"upload": {"extension", "content_type"}} for a multipart file upload.
+        """
+        media_type = content_type.split(";")[0].strip().lower()
+        if media_type.endswith("json") and complete and head:
+            try:
+                return {"json": self.sanitize(json.loads(head))}
+            except ValueError:
+                return None
+        if media_type == "multipart/form-data":
+            extension = UPLOAD_FILENAME_PATTERN.search(head)
+            part_type = UPLOAD_CONTENT_TYPE_PATTERN.search(head)
+            return {
+                "upload": {
+                    "extension": extension.group(1).decode().lower() if extension else None,
+                    "content_type": part_type.group(1).decode().lower() if part_type else None,
+                }
+            }
+        return None
+
+    def write(self, entry: dict):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1, encoding="utf-8")
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,6 +1,10 @@
+import asyncio
+import hashlib
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 import boto3
 import httpx
@@ -25,6 +29,91 @@ BLACKLIST_TOKEN_TABLE = os.getenv("BLACKLIST_TOKEN_TABLE", "")
 S3_BUCKET = os.getenv("S3_BUCKET", "")
 REDIRECT_URI = os.getenv("REDIRECT_URI", "")
 ALLOW_ORIGINS = os.getenv("ALLOW_ORIGINS", "http://localhost:3000")
+# GSI on the receipts table for date range queries:
+#   partition key receipt_period   (S) "<username>#<tax year>#<month>", e.g. "alice#2024#03"
+#   sort key      receipt_date_key (S) "<receipt date YYYY-MM-DD>#<receipt_id>"
+# projecting (INCLUDE) the attributes in RECEIPT_PERIOD_INDEX_ATTRIBUTES; a GSI cannot read
+# other attributes from the table, so list rows and total-claims need all of them.
+RECEIPT_PERIOD_INDEX = os.getenv("RECEIPT_PERIOD_INDEX", "receipt_period-index")
+RECEIPT_PERIOD_INDEX_ATTRIBUTES = [
+    "receipt_upload_datetime",
+    "receipt_filename",
+    "receipt_status",
+    "receipt_size",
+    "receipt_date",
+    "receipt_summary",
+    "version",
+    "duplicate_of",
+    "possible_duplicate_of",
+]
+# OCR maps larger than this are stored as compressed JSON in S3 instead of inline
+OCR_INLINE_MAX_BYTES = int(os.getenv("OCR_INLINE_MAX_BYTES", "2048"))
+# Upload preprocessing: longest side of the image sent to OCR, JPEG quality and pool size
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "2000"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+# Async Textract jobs (multi-page PDFs): poll interval and how long the server keeps polling
+TEXTRACT_POLL_INTERVAL_SECONDS = float(os.getenv("TEXTRACT_POLL_INTERVAL_SECONDS", "2"))
+TEXTRACT_JOB_TIMEOUT_SECONDS = float(os.getenv("TEXTRACT_JOB_TIMEOUT_SECONDS", "300"))
+# OCR engine policy for uploads (textract, local or local_first, see src.ocr) and the
+# mean field confidence below which local_first falls back to Textract
+OCR_ENGINE_POLICY = os.getenv("OCR_ENGINE_POLICY", "textract")
+OCR_LOCAL_MIN_CONFIDENCE = float(os.getenv("OCR_LOCAL_MIN_CONFIDENCE", "80"))
+# Receipt event stream (/receipts/events): keep-alive comment interval and events buffered per
+# connection before the oldest are dropped for a slow client
+EVENT_KEEPALIVE_SECONDS = float(os.getenv("EVENT_KEEPALIVE_SECONDS", "15"))
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+# Table-wide scans (src.scan): parallel Segment/TotalSegments workers and retries of a page
+# throttled by DynamoDB before giving up
+SCAN_SEGMENTS = int(os.getenv("SCAN_SEGMENTS", "4"))
+SCAN_MAX_RETRIES = int(os.getenv("SCAN_MAX_RETRIES", "8"))
+# Responses smaller than this are sent uncompressed (src.middleware.CompressionMiddleware)
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+# Duplicate upload detection (src.duplicates): most differing bits between the image hashes
+# of two photos of one receipt, and how long a user's loaded hashes are trusted
+DUPLICATE_HASH_MAX_DISTANCE = int(os.getenv("DUPLICATE_HASH_MAX_DISTANCE", "8"))
+DUPLICATE_INDEX_TTL_SECONDS = float(os.getenv("DUPLICATE_INDEX_TTL_SECONDS", "300"))
+# Decoded id_token profiles kept for /auth/me
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "1024"))
+# How long the tokens from a refresh are handed to other tabs refreshing with the same
+# (by then blacklisted) refresh token
+REFRESH_RESULT_TTL_SECONDS = float(os.getenv("REFRESH_RESULT_TTL_SECONDS", "10"))
+# Cognito group whose members can use the /admin endpoints
+ADMIN_GROUP = os.getenv("ADMIN_GROUP", "admin")
+# Columnar receipt snapshots for admin analytics (src.analytics): key prefix in S3_BUCKET for
+# the year-partitioned Parquet files (shared by all instances), local directory used instead
+# when the prefix is empty or no bucket is configured, parallel scan segments used to export
+# them and how often the maintenance scheduler refreshes them
+SNAPSHOT_S3_PREFIX = os.getenv("SNAPSHOT_S3_PREFIX", "snapshots/")
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_SCAN_SEGMENTS = int(os.getenv("SNAPSHOT_SCAN_SEGMENTS", "4"))
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "86400"))
+# Maintenance jobs (src.maintenance): whether the app runs the scheduler itself, how often
+# each job runs, capacity budgets and how old an unreferenced S3 object must be to be deleted
+MAINTENANCE_SCHEDULER_ENABLED = os.getenv("MAINTENANCE_SCHEDULER_ENABLED", "").lower() in ("1", "true", "yes")
+MAINTENANCE_S3_ORPHANS_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_S3_ORPHANS_INTERVAL_SECONDS", "86400"))
+MAINTENANCE_BLACKLIST_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_BLACKLIST_INTERVAL_SECONDS", "3600"))
+MAINTENANCE_AGGREGATES_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_AGGREGATES_INTERVAL_SECONDS", "86400"))
+MAINTENANCE_READ_UNITS_PER_SECOND = float(os.getenv("MAINTENANCE_READ_UNITS_PER_SECOND", "20"))
+MAINTENANCE_WRITE_UNITS_PER_SECOND = float(os.getenv("MAINTENANCE_WRITE_UNITS_PER_SECOND", "10"))
+MAINTENANCE_S3_REQUESTS_PER_SECOND = float(os.getenv("MAINTENANCE_S3_REQUESTS_PER_SECOND", "5"))
+MAINTENANCE_ORPHAN_MIN_AGE_SECONDS = float(os.getenv("MAINTENANCE_ORPHAN_MIN_AGE_SECONDS", "3600"))
+MAINTENANCE_PROGRESS_SECONDS = float(os.getenv("MAINTENANCE_PROGRESS_SECONDS", "30"))
+# Set to use the in-process stand-ins of src.local_aws instead of AWS services that are not configured
+LOCAL_AWS = os.getenv("LOCAL_AWS", "").lower() in ("1", "true", "yes")
+# Traffic capture for src.replay (src.capture): JSONL file to append sanitised request shapes
+# and timings to (empty disables capture), fraction of requests recorded and how many buckets
+# usernames are hashed into
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE_RATE", "1.0"))
+TRAFFIC_CAPTURE_USER_BUCKETS = int(os.getenv("TRAFFIC_CAPTURE_USER_BUCKETS", "64"))
+# Idempotency-Key support for uploads (src.idempotency): table with partition key
+# idempotency_key (S) and TTL on expires_at (empty ignores the header), how long responses
+# are kept, how long an unfinished upload holds its key and how long a retry waits for it
+IDEMPOTENCY_TABLE = os.getenv("IDEMPOTENCY_TABLE", "")
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "120"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "20"))
 
 # Handle ALLOW_ORIGIN parsing safely
 if ALLOW_ORIGINS and ALLOW_ORIGINS != "*":
@@ -56,6 +145,11 @@ if CLIENT_ID and COGNITO_USER_POOL_ID:
 
 # Cache JWKS
 _jwks = None
+# Decoded id_token profiles by token, least recently used first
+_profile_cache: "OrderedDict[str, Dict]" = OrderedDict()
+# Token refreshes in progress and recent results, by refresh token hash
+_refresh_inflight: Dict[str, "asyncio.Task"] = {}
+_refresh_results: Dict[str, Tuple[float, Tuple]] = {}
 
 async def get_jwks():
     global _jwks
@@ -104,13 +198,18 @@ async def verify_cognito_jwt(token: str) -> Dict:
             detail=f"Token validation error: {e}",
         )
 
-async def get_current_user(request: Request):
+def request_token(request: Request) -> Optional[str]:
+    """The access token from the Authorization header or the access_token cookie."""
     auth = request.headers.get("Authorization")
     token = None
     if auth and auth.startswith("Bearer "):
         token = auth.split(" ")[1]
     if not token:
         token = request.cookies.get("access_token")
+    return token
+
+async def get_current_user(request: Request):
+    token = request_token(request)
     if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -123,12 +222,29 @@ async def get_current_user(request: Request):
             detail="Token has expired. Please log in again.",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return await verify_cognito_jwt(token)
+    payload = await verify_cognito_jwt(token)
+    # TokenExpiryMiddleware turns this into the X-Token-Expires-In response header
+    request.state.token_expires_at = payload.get("exp")
+    # TrafficCaptureMiddleware records which user bucket the request came from
+    request.state.username = payload.get("username")
+    return payload
+
+async def get_admin_user(request: Request):
+    """Like get_current_user, but only for members of the ADMIN_GROUP Cognito group."""
+    user = await get_current_user(request)
+    if ADMIN_GROUP not in user.get("cognito:groups", []):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return user
 
 async def get_current_user_profile(request: Request):
     id_token = request.cookies.get("id_token")
     if not id_token:
         raise HTTPException(status_code=401, detail="No ID token found")
+    # The same id_token comes with every request until it expires, so decode it once
+    cached = _profile_cache.get(id_token)
+    if cached is not None and cached.get("exp", 0) > time.time():
+        _profile_cache.move_to_end(id_token)
+        return cached
     decoded = jwt.decode(
         id_token,
         key="",  # type: ignore
@@ -138,6 +254,9 @@ async def get_current_user_profile(request: Request):
             "verify_at_hash": False,
         },
     )
+    _profile_cache[id_token] = decoded
+    while len(_profile_cache) > PROFILE_CACHE_SIZE:
+        _profile_cache.popitem(last=False)
     return decoded
 
 async def blacklist_token(token: str, expires_in: int = 3600, token_type: str = "access"):
@@ -219,12 +338,60 @@ async def generate_new_tokens(refresh_token: str):
         print(f"Failed to generate new tokens: {e}")
         return None, None
 
+def token_expires_in(token: str) -> Optional[int]:
+    """Seconds until a JWT expires (0 once it has), None when it has no exp claim."""
+    try:
+        exp = jwt.get_unverified_claims(token).get("exp")
+    except Exception:
+        return None
+    return max(0, int(exp - time.time())) if exp else None
+
+async def _refresh_once(refresh_token: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    if await is_token_blacklisted(refresh_token, token_type="refresh"):
+        return None, None, "Refresh token is blacklisted"
+    new_access_token, new_refresh_token = await generate_new_tokens(refresh_token)
+    if not new_access_token:
+        return None, None, "Failed to refresh token"
+    # Without rotation Cognito keeps the refresh token valid, so only a replaced one is blacklisted
+    if new_refresh_token != refresh_token:
+        await blacklist_token(refresh_token, token_type="refresh")
+    return new_access_token, new_refresh_token, None
+
+def _refresh_done(key: str, task: "asyncio.Task"):
+    _refresh_inflight.pop(key, None)
+    now = time.monotonic()
+    for expired in [k for k, (expires, _) in _refresh_results.items() if expires <= now]:
+        del _refresh_results[expired]
+    if not task.cancelled() and task.exception() is None and task.result()[2] is None:
+        _refresh_results[key] = (now + REFRESH_RESULT_TTL_SECONDS, task.result())
+
+async def refresh_tokens(refresh_token: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Exchange a refresh token for new tokens, coalescing the refreshes several tabs start at
+    once: concurrent calls with the same token share one Cognito request, and calls within
+    REFRESH_RESULT_TTL_SECONDS after it get the same tokens instead of failing on the
+    blacklisted old token. Coalescing is per process.
+    Returns (access_token, refresh_token, error); error is None on success.
+    """
+    key = hashlib.sha256(refresh_token.encode("utf-8")).hexdigest()
+    cached = _refresh_results.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    task = _refresh_inflight.get(key)
+    if task is None:
+        # A task, so a client disconnecting does not cancel the refresh the others wait for
+        task = asyncio.ensure_future(_refresh_once(refresh_token))
+        _refresh_inflight[key] = task
+        task.add_done_callback(lambda done: _refresh_done(key, done))
+    return await asyncio.shield(task)
+
 # Initialize AWS resources only if credentials are provided
 s3 = None
 receipt_bucket = None
 dynamo = None
 receipt_db = None
 blacklist_token_db = None
+idempotency_db = None
 receipt_textract = None
 
 if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY and S3_BUCKET:
@@ -249,6 +416,8 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY and RECEIPT_TABLE:
         )
         receipt_db = dynamo.Table(str(RECEIPT_TABLE))
         blacklist_token_db = dynamo.Table(str(BLACKLIST_TOKEN_TABLE))
+        if IDEMPOTENCY_TABLE:
+            idempotency_db = dynamo.Table(str(IDEMPOTENCY_TABLE))
     except Exception as e:
         print(f"Failed to initialize DynamoDB: {e}")
 
@@ -262,3 +431,28 @@ if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
         )
     except Exception as e:
         print(f"Failed to initialize Textract: {e}")
+
+if TRAFFIC_CAPTURE_PATH:
+    from src.capture import instrument_aws_client
+
+    for client in (s3.meta.client if s3 else None, dynamo.meta.client if dynamo else None, receipt_textract):
+        if client is not None:
+            instrument_aws_client(client)
+
+if LOCAL_AWS and receipt_textract is None:
+    from src.local_aws import FakeTextract
+
+    receipt_textract = FakeTextract()
+
+if LOCAL_AWS and receipt_db is None:
+    from src.local_aws import FakeDynamo, FakeTable
+
+    receipt_db = FakeTable("receipt_username", "receipt_id", indexes={RECEIPT_PERIOD_INDEX: ("receipt_period", "receipt_date_key")}, projections={RECEIPT_PERIOD_INDEX: RECEIPT_PERIOD_INDEX_ATTRIBUTES}, name=RECEIPT_TABLE or "receipts")
+    blacklist_token_db = FakeTable("token_jti", name=BLACKLIST_TOKEN_TABLE or "blacklist_tokens")
+    idempotency_db = FakeTable("idempotency_key", name=IDEMPOTENCY_TABLE or "idempotency")
+    dynamo = FakeDynamo(receipt_db, blacklist_token_db, idempotency_db)
+
+if LOCAL_AWS and receipt_bucket is None:
+    from src.local_aws import FakeBucket
+
+    receipt_bucket = FakeBucket(S3_BUCKET or "local-receipts")
@@ -0,0 +1,257 @@
+"""
+Duplicate detection for receipt uploads. Three signals, strongest first:
+
+    content_sha256   the same file was uploaded before
+    image_hash       64-bit difference hash (dHash) of the photo; re-shot, recompressed or
+                     slightly shifted photos of one receipt differ in a few bits
+    ocr_fingerprint  normalised vendor, receipt date and total, for photos of the same paper
+                     receipt that look different (angle, lighting, crop)
+
+The file and image hashes are known before OCR, so a likely duplicate can be refused
+without paying for Textract. Only a content match is certain enough to leave the upload
+out of total-claims on its own (duplicate_of): photos of different paper receipts can be
+within a few bits of each other, and repeat purchases share vendor, date and total.
+Image and OCR matches are stored as a possible_duplicate_of hint for the user to
+confirm.
+
+Each user's hashes are held in a DuplicateIndex: exact matches by dict, image hashes in
+a multi-index hash searched by Hamming distance in sub-linear time. A user's index is
+loaded from the receipts table on first use in the process and kept current by uploads
+and deletes; it is reloaded after DUPLICATE_INDEX_TTL_SECONDS to pick up receipts
+written by other instances.
+"""
+
+import hashlib
+import io
+import itertools
+import re
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, Generic, List, Optional, Set, Tuple, TypeVar
+
+from boto3.dynamodb.conditions import Key
+
+from src.config import DUPLICATE_HASH_MAX_DISTANCE, DUPLICATE_INDEX_TTL_SECONDS
+from src.preprocessing import ImageTooLargeError, run_image_work
+from src.utils import parse_amount, parse_receipt_date, projection, query_all
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+DUPLICATE_ATTRIBUTES = ["receipt_id", "content_sha256", "image_hash", "ocr_fingerprint"]
+HASH_SIZE = 8
+
+V = TypeVar("V")
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_dhash(data: bytes) -> Optional[int]:
+    """
+    64-bit dHash: the image shrunk to 9x8 grayscale, one bit per horizontally adjacent pair
+    of pixels for whether brightness increases. None when the data is not an image Pillow
+    can read or Pillow is not installed; ImageTooLargeError over Pillow's decompression
+    bomb limit. Runs in the process pool.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEGs decode straight to a fraction of their size, which is all a 9x8 hash needs
+            image.draft("L", (HASH_SIZE * 16, HASH_SIZE * 16))
+            image = ImageOps.exif_transpose(image).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+            pixels = list(image.getdata())
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            bits = (bits << 1) | (right > left)
+    return bits
+
+
+async def image_hash_upload(data: bytes) -> Optional[int]:
+    return await run_image_work(image_dhash, data)
+
+
+def format_image_hash(image_hash: int) -> str:
+    """The hash as stored in the item's image_hash attribute: 16 hex digits."""
+    return f"{image_hash:016x}"
+
+
+def duplicate_attributes(match: Optional[dict]) -> Tuple[Optional[str], Optional[str]]:
+    """(duplicate_of, possible_duplicate_of) for a DuplicateIndex.find match."""
+    if match is None:
+        return None, None
+    if match["match"] == "content":
+        return match["receipt_id"], None
+    return None, match["receipt_id"]
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def ocr_fingerprint(summary: dict) -> Optional[str]:
+    """vendor|YYYY-MM-DD|total from a receipt_summary, None unless the date and total are known."""
+    receipt_date = parse_receipt_date(summary.get("date"))
+    total = parse_amount(summary.get("total")) if summary.get("total") is not None else None
+    if not receipt_date or total is None:
+        return None
+    vendor = re.sub(r"[^A-Z0-9]", "", str(summary.get("vendor", "")).upper())
+    return f"{vendor}|{receipt_date}|{total.quantize(Decimal('0.01'))}"
+
+
+class MultiIndexHash(Generic[V]):
+    """
+    64-bit hashes indexed for Hamming-distance search by four 16-bit chunks. A hash within
+    distance d of a query has, by pigeonhole, some chunk within d // 4 bits of the query's
+    chunk, so a search looks up the query's chunks with up to d // 4 bits flipped and
+    compares only the hashes found there. For d = 8 that is 4 x 137 bucket lookups, however
+    many hashes are stored; a BK-tree barely prunes at that radius in 64 bits.
+    """
+
+    chunks = 4
+    chunk_bits = 16
+
+    def __init__(self):
+        self.tables: List[Dict[int, List[Tuple[int, V]]]] = [{} for _ in range(self.chunks)]
+        self.size = 0
+        self._flip_masks: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _chunk(self, key: int, index: int) -> int:
+        return (key >> (index * self.chunk_bits)) & ((1 << self.chunk_bits) - 1)
+
+    def flip_masks(self, radius: int) -> List[int]:
+        """Every chunk-sized mask with at most radius bits set."""
+        if radius not in self._flip_masks:
+            self._flip_masks[radius] = [sum(1 << bit for bit in bits) for count in range(radius + 1) for bits in itertools.combinations(range(self.chunk_bits), count)]
+        return self._flip_masks[radius]
+
+    def add(self, key: int, value: V):
+        self.size += 1
+        for index, table in enumerate(self.tables):
+            table.setdefault(self._chunk(key, index), []).append((key, value))
+
+    def search(self, key: int, max_distance: int) -> List[Tuple[int, V]]:
+        """(distance, value) of every entry within max_distance of key, nearest first."""
+        masks = self.flip_masks(max_distance // self.chunks)
+        found = {}
+        for index, table in enumerate(self.tables):
+            chunk = self._chunk(key, index)
+            for mask in masks:
+                for candidate, value in table.get(chunk ^ mask, ()):
+                    distance = hamming_distance(key, candidate)
+                    if distance <= max_distance:
+                        found[(candidate, value)] = distance
+        return sorted(((distance, value) for (_, value), distance in found.items()), key=lambda match: match[0])
+
+
+class UserDuplicates:
+    """One user's receipt hashes. Deleted receipts are skipped rather than removed from the tree."""
+
+    def __init__(self):
+        self.content: Dict[str, str] = {}
+        self.fingerprints: Dict[str, str] = {}
+        self.image_hashes: MultiIndexHash[str] = MultiIndexHash()
+        self.removed: Set[str] = set()
+        self.loaded_at = time.monotonic()
+
+    def add(self, receipt_id: str, content_sha256: Optional[str] = None, image_hash: Optional[int] = None, fingerprint: Optional[str] = None):
+        self.removed.discard(receipt_id)
+        if content_sha256:
+            self._claim(self.content, content_sha256, receipt_id)
+        if fingerprint:
+            self._claim(self.fingerprints, fingerprint, receipt_id)
+        if image_hash is not None:
+            self.image_hashes.add(image_hash, receipt_id)
+
+    def _claim(self, receipt_ids: Dict[str, str], key: str, receipt_id: str):
+        # The first receipt with a hash is the original, unless it has been deleted since
+        current = receipt_ids.get(key)
+        if current is None or current in self.removed:
+            receipt_ids[key] = receipt_id
+
+    def find(self, content_sha256: Optional[str], image_hash: Optional[int], fingerprint: Optional[str], max_distance: int) -> Optional[dict]:
+        receipt_id = self.content.get(content_sha256) if content_sha256 else None
+        if receipt_id and receipt_id not in self.removed:
+            return {"receipt_id": receipt_id, "match": "content"}
+        if image_hash is not None:
+            for distance, receipt_id in self.image_hashes.search(image_hash, max_distance):
+                if receipt_id not in self.removed:
+                    return {"receipt_id": receipt_id, "match": "image", "distance": distance}
+        receipt_id = self.fingerprints.get(fingerprint) if fingerprint else None
+        if receipt_id and receipt_id not in self.removed:
+            return {"receipt_id": receipt_id, "match": "ocr"}
+        return None
+
+
+class DuplicateIndex:
+    """Per-user duplicate lookups, loaded lazily from the receipts table."""
+
+    def __init__(self, max_distance: int = DUPLICATE_HASH_MAX_DISTANCE, ttl_seconds: float = DUPLICATE_INDEX_TTL_SECONDS, table=None):
+        self.max_distance = max_distance
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+        self._users: Dict[str, UserDuplicates] = {}
+        self._lock = threading.Lock()
+
+    def load(self, username: str) -> UserDuplicates:
+        projection_expression, projection_names = projection(DUPLICATE_ATTRIBUTES)
+        items = query_all(
+            self.table,
+            KeyConditionExpression=Key("receipt_username").eq(username),
+            ProjectionExpression=projection_expression,
+            ExpressionAttributeNames=projection_names,
+        )
+        user = UserDuplicates()
+        for item in items:
+            image_hash = item.get("image_hash")
+            user.add(item["receipt_id"], item.get("content_sha256"), int(image_hash, 16) if image_hash else None, item.get("ocr_fingerprint"))
+        return user
+
+    def user(self, username: str) -> UserDuplicates:
+        with self._lock:
+            user = self._users.get(username)
+        if user is None or time.monotonic() - user.loaded_at > self.ttl_seconds:
+            user = self.load(username)
+            with self._lock:
+                self._users[username] = user
+        return user
+
+    def find(self, username: str, content_sha256: Optional[str] = None, image_hash: Optional[int] = None, fingerprint: Optional[str] = None) -> Optional[dict]:
+        """The receipt an upload most likely duplicates: {"receipt_id", "match"} (plus "distance" for image matches), or None."""
+        try:
+            return self.user(username).find(content_sha256, image_hash, fingerprint, self.max_distance)
+        except Exception as e:
+            # Duplicate detection is advisory; an upload must not fail because of it
+            print(f"Error checking for duplicate receipts: {e}")
+            return None
+
+    def add(self, username: str, receipt_id: str, content_sha256: Optional[str] = None, image_hash: Optional[int] = None, fingerprint: Optional[str] = None):
+        with self._lock:
+            user = self._users.get(username)
+        if user is not None:
+            user.add(receipt_id, content_sha256, image_hash, fingerprint)
+
+    def remove(self, username: str, receipt_id: str):
+        with self._lock:
+            user = self._users.get(username)
+        if user is not None:
+            user.removed.add(receipt_id)
+
+
+duplicate_index = DuplicateIndex()
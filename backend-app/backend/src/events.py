@@ -0,0 +1,145 @@
+"""
+Per-user receipt events (upload progress, OCR completion, status changes) for the
+/receipts/events Server-Sent Events stream, so the frontend does not have to poll
+/receipts/view.
+
+Handlers call publish_receipt_event; the broker fans events out to the user's open
+streams. The default InMemoryBroker only reaches clients connected to the same
+process. With several workers or instances, install a broker backed by a shared
+channel (e.g. Redis pub/sub) with set_broker at startup.
+"""
+
+import asyncio
+import itertools
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from src.config import EVENT_QUEUE_SIZE
+
+UPLOAD_PROGRESS = "upload_progress"
+OCR_COMPLETED = "ocr_completed"
+STATUS_CHANGED = "status_changed"
+RECEIPT_UPDATED = "receipt_updated"
+RECEIPT_DELETED = "receipt_deleted"
+
+
+class EventBroker(ABC):
+    """
+    Interface for event brokers: publish to a user's open subscriptions. A broker delivers
+    an event by calling Subscription.deliver on each subscription it has attached.
+    """
+
+    @abstractmethod
+    def publish(self, username: str, event: dict) -> None:
+        """Send an event to every subscription the user has open, in any process the broker reaches."""
+
+    @abstractmethod
+    def attach(self, subscription: "Subscription") -> None:
+        """Start delivering the subscription's user's events to it."""
+
+    @abstractmethod
+    def detach(self, subscription: "Subscription") -> None:
+        """Stop delivering events to the subscription."""
+
+    def subscribe(self, username: str) -> "Subscription":
+        return Subscription(self, username)
+
+
+class Subscription:
+    """A user's stream of events from a broker. Use as an async context manager."""
+
+    def __init__(self, broker: EventBroker, username: str, queue_size: int = EVENT_QUEUE_SIZE):
+        self.broker = broker
+        self.username = username
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def __aenter__(self) -> "Subscription":
+        self.loop = asyncio.get_running_loop()
+        self.broker.attach(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.broker.detach(self)
+
+    def deliver(self, event: dict):
+        """Queue an event from any thread or loop."""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.loop is running_loop:
+            self.put(event)
+        elif self.loop is not None and not self.loop.is_closed():
+            # Published from a worker thread or another loop
+            self.loop.call_soon_threadsafe(self.put, event)
+
+    def put(self, event: dict):
+        # Called on the subscriber's loop; a slow client loses its oldest events, not new ones
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Next event, or None when timeout passes first."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InMemoryBroker(EventBroker):
+    """Fans events out to the subscriptions open in this process."""
+
+    def __init__(self):
+        self.subscriptions: Dict[str, Set[Subscription]] = {}
+
+    def attach(self, subscription: Subscription) -> None:
+        self.subscriptions.setdefault(subscription.username, set()).add(subscription)
+
+    def detach(self, subscription: Subscription) -> None:
+        subscriptions = self.subscriptions.get(subscription.username)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.username]
+
+    def publish(self, username: str, event: dict) -> None:
+        for subscription in list(self.subscriptions.get(username, ())):
+            subscription.deliver(event)
+
+
+broker: EventBroker = InMemoryBroker()
+_event_ids = itertools.count(1)
+
+
+def set_broker(new_broker: EventBroker):
+    global broker
+    broker = new_broker
+
+
+def subscribe_receipt_events(username: str) -> Subscription:
+    """The user's stream of receipt events from the installed broker."""
+    return broker.subscribe(username)
+
+
+def publish_receipt_event(username: str, event_type: str, receipt_id: str, **data):
+    """Publish a receipt event to the user's streams. Never raises, so a broker failure cannot fail the write that triggered it."""
+    event = {
+        "id": next(_event_ids),
+        "type": event_type,
+        "receipt_id": receipt_id,
+        "timestamp": datetime.now().isoformat(),
+        **data,
+    }
+    try:
+        broker.publish(username, event)
+    except Exception as e:
+        print(f"Error publishing {event_type} event for receipt {receipt_id}: {e}")
+
+
+def format_sse(event: dict) -> str:
+    """Encode an event as a Server-Sent Events message; the browser dispatches it by its type."""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
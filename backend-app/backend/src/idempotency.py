@@ -0,0 +1,202 @@
+"""
+Idempotency-Key support for POST /receipts/upload. Clients retry uploads on timeouts
+while the first attempt is still waiting on Textract; with the same Idempotency-Key the
+retry gets the first attempt's response instead of storing and OCRing the file again.
+
+Keys are claimed with a conditional put to IDEMPOTENCY_TABLE:
+
+    idempotency_key  (S) partition key "<username>#<Idempotency-Key>"
+    status           in_progress, then completed
+    request_hash     the upload and its options; a key reused for another upload is refused (422)
+    owner            token of the request holding the claim
+    locked_until     when an in_progress claim counts as abandoned (its request died) and
+                     may be taken over
+    response_status, response_body (gzipped)   the response of a completed upload
+    expires_at       DynamoDB TTL attribute, IDEMPOTENCY_TTL_SECONDS after the claim
+
+A retry arriving while the upload is in flight attaches to it: in the same process it
+awaits the same task, otherwise it polls the record for up to IDEMPOTENCY_WAIT_SECONDS
+and then answers 409 with Retry-After. Responses below 500 are stored; server errors
+and exceptions release the claim, so a retry runs the upload again.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse, Response
+
+from src.config import IDEMPOTENCY_LOCK_SECONDS, IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_WAIT_SECONDS, idempotency_db
+from src.utils import deserialize_item
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+POLL_SECONDS = 0.5
+# Stored responses must fit in an item with the rest of the record
+MAX_STORED_RESPONSE_BYTES = 350 * 1024
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def request_fingerprint(*parts) -> str:
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class IdempotentRequests:
+    """Runs each (user, Idempotency-Key) request once and hands its response to retries."""
+
+    def __init__(
+        self,
+        table=None,
+        ttl_seconds: int = IDEMPOTENCY_TTL_SECONDS,
+        lock_seconds: int = IDEMPOTENCY_LOCK_SECONDS,
+        wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS,
+        poll_seconds: float = POLL_SECONDS,
+    ):
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.lock_seconds = lock_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self._inflight: Dict[str, Tuple[str, asyncio.Task]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.table is not None
+
+    def claimable(self, record: Optional[dict], now: float) -> bool:
+        return record is None or record.get("expires_at", 0) < now or (record.get("status") == "in_progress" and record.get("locked_until", 0) < now)
+
+    def claim(self, record_key: str, request_hash: str, owner: str) -> Optional[dict]:
+        """Claim the key for this request. Returns None once claimed, else the record holding it."""
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    "idempotency_key": record_key,
+                    "status": "in_progress",
+                    "request_hash": request_hash,
+                    "owner": owner,
+                    "locked_until": now + self.lock_seconds,
+                    "expires_at": now + self.ttl_seconds,
+                },
+                # Expired records may not have been removed by TTL yet
+                ConditionExpression="attribute_not_exists(idempotency_key) OR expires_at < :now OR (#status = :in_progress AND locked_until < :now)",
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={":now": now, ":in_progress": "in_progress"},
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+            return None
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            return deserialize_item(e.response.get("Item")) or self.read(record_key) or {}
+
+    def read(self, record_key: str) -> Optional[dict]:
+        return self.table.get_item(Key={"idempotency_key": record_key}, ConsistentRead=True).get("Item")
+
+    def complete(self, record_key: str, owner: str, status_code: int, body: bytes):
+        compressed = gzip.compress(body)
+        if len(compressed) > MAX_STORED_RESPONSE_BYTES:
+            print(f"Idempotent response for {record_key} is too large to store ({len(compressed)} bytes)")
+            self.release(record_key, owner)
+            return
+        try:
+            self.table.update_item(
+                Key={"idempotency_key": record_key},
+                UpdateExpression="SET #status = :completed, response_status = :status_code, response_body = :body REMOVE locked_until",
+                # A claim taken over after its lock expired belongs to the other request now
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#status": "status", "#owner": "owner"},
+                ExpressionAttributeValues={":completed": "completed", ":status_code": status_code, ":body": compressed, ":owner": owner},
+            )
+        except ClientError as e:
+            print(f"Error storing idempotent response: {e}")
+
+    def release(self, record_key: str, owner: str):
+        try:
+            self.table.delete_item(
+                Key={"idempotency_key": record_key},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={":owner": owner},
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                print(f"Error releasing Idempotency-Key: {e}")
+
+    def _forget(self, record_key: str, task: asyncio.Task):
+        if self._inflight.get(record_key, (None, None))[1] is task:
+            del self._inflight[record_key]
+
+    def stored_response(self, record: dict) -> Response:
+        body = gzip.decompress(bytes(record["response_body"]))
+        return Response(body, status_code=int(record["response_status"]), media_type="application/json", headers={REPLAYED_HEADER: "true"})
+
+    async def run_owned(self, record_key: str, owner: str, work: Callable[[], Awaitable[Response]]) -> Response:
+        try:
+            response = await work()
+        except HTTPException as e:
+            if e.status_code < 500:
+                # Stored as FastAPI renders it, so a retry sees the same error
+                self.complete(record_key, owner, e.status_code, JSONResponse({"detail": e.detail}).body)
+            else:
+                self.release(record_key, owner)
+            raise
+        except BaseException:
+            self.release(record_key, owner)
+            raise
+        if response.status_code < 500:
+            self.complete(record_key, owner, response.status_code, response.body)
+        else:
+            self.release(record_key, owner)
+        return response
+
+    async def run(self, username: str, key: str, request_hash: str, work: Callable[[], Awaitable[Response]]) -> Response:
+        """
+        The response of work() for the first request with this key; later requests with the
+        same key and request_hash get that response (Idempotent-Replayed: true) without
+        running work. A different request_hash is refused with 422.
+        """
+        record_key = f"{username}#{key}"
+        inflight = self._inflight.get(record_key)
+        if inflight is None:
+            owner = uuid.uuid4().hex
+            deadline = time.monotonic() + self.wait_seconds
+            try:
+                record = self.claim(record_key, request_hash, owner)
+                while record is not None:
+                    if record.get("request_hash") != request_hash:
+                        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different upload")
+                    if record.get("status") == "completed":
+                        return self.stored_response(record)
+                    # In flight in another process: wait for its response, or for its claim to lapse
+                    if time.monotonic() >= deadline:
+                        raise HTTPException(status_code=409, detail="An upload with this Idempotency-Key is still in progress", headers={"Retry-After": str(max(1, round(self.wait_seconds / 4)))})
+                    await asyncio.sleep(self.poll_seconds)
+                    record = self.read(record_key)
+                    if self.claimable(record, time.time()):
+                        record = self.claim(record_key, request_hash, owner)
+            except ClientError as e:
+                # The upload must not fail because the idempotency table did
+                print(f"Error claiming Idempotency-Key: {e}")
+                return await work()
+
+            # A task, so a client disconnecting does not cancel the upload retries attach to
+            task = asyncio.ensure_future(self.run_owned(record_key, owner, work))
+            self._inflight[record_key] = (request_hash, task)
+            task.add_done_callback(lambda done: self._forget(record_key, done))
+            return await asyncio.shield(task)
+
+        # In flight in this process
+        inflight_hash, task = inflight
+        if inflight_hash != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different upload")
+        response = await asyncio.shield(task)
+        return Response(response.body, status_code=response.status_code, media_type=response.media_type, headers={REPLAYED_HEADER: "true"})
+
+
+idempotent_uploads = IdempotentRequests(idempotency_db)
@@ -0,0 +1,857 @@
+"""
+In-process stand-ins for the AWS services the app uses, for running and testing
+the receipt flows offline. They implement only the calls and response shapes the
+app relies on. Enabled with LOCAL_AWS=1 for services that are not configured.
+Every call is counted for src.capture, like calls made through instrumented boto3 clients.
+"""
+
+import copy
+import io
+import json
+import math
+import re
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from boto3.dynamodb import conditions
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+from src.capture import count_aws_call
+
+# DynamoDB returns at most 1 MB of items per Query/Scan page
+DYNAMO_PAGE_BYTES = 1024 * 1024
+
+
+def _field(field_type: str, label: str, value: str, page: int) -> dict:
+    return {
+        "Type": {"Text": field_type, "Confidence": 99.0},
+        "LabelDetection": {"Text": label, "Confidence": 99.0},
+        "ValueDetection": {"Text": value, "Confidence": 98.5},
+        "PageNumber": page,
+    }
+
+
+# A two page invoice: vendor and date on the first page, totals on the last
+SAMPLE_EXPENSE_PAGES = [
+    {
+        "SummaryFields": [
+            _field("VENDOR_NAME", "Vendor", "KEDAI BUKU SRI MAJU", 1),
+            _field("INVOICE_RECEIPT_DATE", "Date:", "14/03/2024", 1),
+            _field("INVOICE_RECEIPT_ID", "Invoice No", "000123", 1),
+        ],
+        "LineItemGroups": [],
+    },
+    {
+        "SummaryFields": [
+            _field("SUBTOTAL", "Subtotal", "16.60", 2),
+            _field("TAX", "SST 6%", "1.00", 2),
+            _field("TOTAL", "TOTAL", "17.60", 2),
+        ],
+        "LineItemGroups": [],
+    },
+]
+
+
+class InvalidJobIdException(Exception):
+    pass
+
+
+class FakeTextract:
+    """
+    Stand-in for the Textract client's expense APIs. Every document yields the same
+    canned pages. Async jobs report IN_PROGRESS for the first polls_until_done polls,
+    then return one ExpenseDocument per page, page_size per GetExpenseAnalysis call.
+    """
+
+    class exceptions:
+        InvalidJobIdException = InvalidJobIdException
+
+    def __init__(self, pages: Optional[List[dict]] = None, polls_until_done: int = 1, page_size: int = 1, fail_jobs: bool = False):
+        self.pages = pages if pages is not None else SAMPLE_EXPENSE_PAGES
+        self.polls_until_done = polls_until_done
+        self.page_size = page_size
+        self.fail_jobs = fail_jobs
+        self.jobs: Dict[str, dict] = {}
+        self.calls: Dict[str, int] = {"analyze_expense": 0, "start_expense_analysis": 0, "get_expense_analysis": 0}
+
+    def _documents(self) -> List[dict]:
+        documents = []
+        for index, page in enumerate(self.pages, start=1):
+            document = copy.deepcopy(page)
+            document["ExpenseIndex"] = index
+            documents.append(document)
+        return documents
+
+    def _call(self, operation: str):
+        self.calls[operation] += 1
+        count_aws_call("textract", _api_name(operation))
+
+    def analyze_expense(self, Document: dict) -> dict:
+        self._call("analyze_expense")
+        # The synchronous API only reads the first page
+        return {"DocumentMetadata": {"Pages": 1}, "ExpenseDocuments": self._documents()[:1]}
+
+    def start_expense_analysis(self, DocumentLocation: dict, **kwargs) -> dict:
+        self._call("start_expense_analysis")
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {"polls": 0, "location": DocumentLocation}
+        return {"JobId": job_id}
+
+    def get_expense_analysis(self, JobId: str, MaxResults: int = None, NextToken: str = None) -> dict:
+        self._call("get_expense_analysis")
+        job = self.jobs.get(JobId)
+        if job is None:
+            raise InvalidJobIdException(f"Unknown job {JobId}")
+
+        if NextToken is None:
+            job["polls"] += 1
+        if job["polls"] <= self.polls_until_done:
+            return {"JobStatus": "IN_PROGRESS"}
+        if self.fail_jobs:
+            return {"JobStatus": "FAILED", "StatusMessage": "Unsupported document"}
+
+        documents = self._documents()
+        start = int(NextToken or 0)
+        end = start + min(MaxResults or self.page_size, self.page_size)
+        response = {
+            "JobStatus": "SUCCEEDED",
+            "DocumentMetadata": {"Pages": len(documents)},
+            "ExpenseDocuments": documents[start:end],
+        }
+        if end < len(documents):
+            response["NextToken"] = str(end)
+        return response
+
+
+def _api_name(operation: str) -> str:
+    """put_item -> PutItem, as botocore names operations."""
+    return "".join(part.capitalize() for part in operation.split("_"))
+
+
+def _item_bytes(item: dict) -> int:
+    return len(json.dumps(item, default=str))
+
+
+def _condition_value(operand, item: dict):
+    if isinstance(operand, conditions.AttributeBase):
+        return item.get(operand.name)
+    return operand
+
+
+def evaluate_condition(condition, item: dict) -> bool:
+    """Evaluate a boto3 Key/Attr condition object against an item."""
+    values = condition.get_expression()["values"]
+    if isinstance(condition, conditions.And):
+        return all(evaluate_condition(value, item) for value in values)
+    if isinstance(condition, conditions.Or):
+        return any(evaluate_condition(value, item) for value in values)
+    if isinstance(condition, conditions.Not):
+        return not evaluate_condition(values[0], item)
+    if isinstance(condition, conditions.AttributeExists):
+        return values[0].name in item
+    if isinstance(condition, conditions.AttributeNotExists):
+        return values[0].name not in item
+
+    left = _condition_value(values[0], item)
+    if left is None:
+        return False
+    if isinstance(condition, conditions.Equals):
+        return left == values[1]
+    if isinstance(condition, conditions.NotEquals):
+        return left != values[1]
+    if isinstance(condition, conditions.LessThan):
+        return left < values[1]
+    if isinstance(condition, conditions.LessThanEquals):
+        return left <= values[1]
+    if isinstance(condition, conditions.GreaterThan):
+        return left > values[1]
+    if isinstance(condition, conditions.GreaterThanEquals):
+        return left >= values[1]
+    if isinstance(condition, conditions.BeginsWith):
+        return str(left).startswith(values[1])
+    if isinstance(condition, conditions.Between):
+        return values[1] <= left <= values[2]
+    if isinstance(condition, conditions.In):
+        return left in values[1]
+    raise NotImplementedError(f"Condition {type(condition).__name__} is not supported by FakeTable")
+
+
+_MISSING = object()
+
+_EXPRESSION_TOKEN = re.compile(r"\s*(<>|<=|>=|[=<>(),.+-]|#\w+|:\w+|\w+)")
+_COMPARATORS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def _validation_error(message: str) -> ClientError:
+    return ClientError({"Error": {"Code": "ValidationException", "Message": message}}, "Expression")
+
+
+def _resolve(item: dict, path: List[str]):
+    value = item
+    for name in path:
+        if not isinstance(value, dict) or name not in value:
+            return _MISSING
+        value = value[name]
+    return value
+
+
+def _parent(item: dict, path: List[str]) -> dict:
+    parent = _resolve(item, path[:-1])
+    if not isinstance(parent, dict):
+        raise _validation_error("The document path provided in the update expression is invalid for update")
+    return parent
+
+
+def _compare(comparator: Callable, left, right) -> bool:
+    if left is _MISSING or right is _MISSING:
+        return False
+    try:
+        return comparator(left, right)
+    except TypeError:
+        return False
+
+
+class _Expression:
+    """
+    Parser for DynamoDB's string expressions as the app writes them: conditions (comparisons,
+    BETWEEN, IN, AND/OR/NOT, attribute_exists, attribute_not_exists, begins_with, contains,
+    size) and update expressions (SET with if_not_exists, list_append and +/-, REMOVE, ADD,
+    DELETE), with #name and :value placeholders and dotted map paths. Operands compile to
+    functions of the item.
+    """
+
+    def __init__(self, text: str, names: Optional[dict] = None, values: Optional[dict] = None):
+        self.text = text
+        self.names = names or {}
+        self.values = values or {}
+        self.tokens = []
+        position, text = 0, text.strip()
+        while position < len(text):
+            match = _EXPRESSION_TOKEN.match(text, position)
+            if match is None:
+                raise _validation_error(f"Invalid expression: {self.text}")
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+
+    def peek(self, offset: int = 0) -> Optional[str]:
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise _validation_error(f"Invalid expression: {self.text}")
+        self.position += 1
+        return token
+
+    def keyword(self, word: str) -> bool:
+        if (self.peek() or "").upper() == word:
+            self.position += 1
+            return True
+        return False
+
+    def function(self, *names: str) -> Optional[str]:
+        token = (self.peek() or "").lower()
+        if token in names and self.peek(1) == "(":
+            self.position += 2
+            return token
+        return None
+
+    def name(self) -> str:
+        token = self.take()
+        if token.startswith("#"):
+            if token not in self.names:
+                raise _validation_error(f"Unknown attribute name placeholder {token}")
+            return self.names[token]
+        return token
+
+    def path(self) -> List[str]:
+        path = [self.name()]
+        while self.peek() == ".":
+            self.take()
+            path.append(self.name())
+        return path
+
+    def operand(self) -> Callable[[dict], Any]:
+        token = self.peek() or ""
+        if token.startswith(":"):
+            self.take()
+            if token not in self.values:
+                raise _validation_error(f"Unknown attribute value placeholder {token}")
+            value = self.values[token]
+            return lambda item: value
+        if self.function("size"):
+            path = self.path()
+            self.take(")")
+
+            def size(item):
+                value = _resolve(item, path)
+                return _MISSING if value is _MISSING else len(value)
+
+            return size
+        path = self.path()
+        return lambda item: _resolve(item, path)
+
+    def condition(self) -> Callable[[dict], bool]:
+        """The whole expression as a condition."""
+        condition = self._or()
+        if self.peek() is not None:
+            raise _validation_error(f"Invalid expression: {self.text}")
+        return condition
+
+    def _or(self):
+        terms = [self._and()]
+        while self.keyword("OR"):
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else lambda item: any(term(item) for term in terms)
+
+    def _and(self):
+        terms = [self._not()]
+        while self.keyword("AND"):
+            terms.append(self._not())
+        return terms[0] if len(terms) == 1 else lambda item: all(term(item) for term in terms)
+
+    def _not(self):
+        if self.keyword("NOT"):
+            term = self._not()
+            return lambda item: not term(item)
+        return self._primary()
+
+    def _primary(self):
+        if self.peek() == "(":
+            self.take()
+            term = self._or()
+            self.take(")")
+            return term
+
+        function = self.function("attribute_exists", "attribute_not_exists", "begins_with", "contains")
+        if function in ("attribute_exists", "attribute_not_exists"):
+            path = self.path()
+            self.take(")")
+            exists = function == "attribute_exists"
+            return lambda item: (_resolve(item, path) is not _MISSING) == exists
+        if function:
+            left = self.operand()
+            self.take(",")
+            right = self.operand()
+            self.take(")")
+            if function == "begins_with":
+                return lambda item: _compare(lambda a, b: isinstance(a, str) and a.startswith(b), left(item), right(item))
+            return lambda item: _compare(lambda a, b: b in a, left(item), right(item))
+
+        left = self.operand()
+        if self.keyword("BETWEEN"):
+            low = self.operand()
+            self.take("AND")
+            high = self.operand()
+            return lambda item: _compare(lambda a, b: b[0] <= a <= b[1], left(item), (low(item), high(item)))
+        if self.keyword("IN"):
+            self.take("(")
+            options = [self.operand()]
+            while self.peek() == ",":
+                self.take()
+                options.append(self.operand())
+            self.take(")")
+            return lambda item: any(_compare(_COMPARATORS["="], left(item), option(item)) for option in options)
+        comparator = _COMPARATORS.get(self.take())
+        if comparator is None:
+            raise _validation_error(f"Invalid expression: {self.text}")
+        right = self.operand()
+        return lambda item: _compare(comparator, left(item), right(item))
+
+    def update(self) -> List[Tuple[str, List[str], Optional[Callable[[dict], Any]]]]:
+        """The whole expression as update actions: (SET|REMOVE|ADD|DELETE, path, value)."""
+        actions = []
+        while self.peek() is not None:
+            clause = self.take().upper()
+            if clause not in ("SET", "REMOVE", "ADD", "DELETE"):
+                raise _validation_error(f"Invalid update expression: {self.text}")
+            while True:
+                path = self.path()
+                if clause == "SET":
+                    self.take("=")
+                    value = self._set_value()
+                else:
+                    value = None if clause == "REMOVE" else self.operand()
+                actions.append((clause, path, value))
+                if self.peek() != ",":
+                    break
+                self.take()
+        return actions
+
+    def _set_value(self):
+        left = self._set_operand()
+        if self.peek() in ("+", "-"):
+            sign = 1 if self.take() == "+" else -1
+            right = self._set_operand()
+            return lambda item: left(item) + sign * right(item)
+        return left
+
+    def _set_operand(self):
+        function = self.function("if_not_exists", "list_append")
+        if function == "if_not_exists":
+            path = self.path()
+            self.take(",")
+            default = self._set_operand()
+            self.take(")")
+
+            def if_not_exists(item):
+                value = _resolve(item, path)
+                return default(item) if value is _MISSING else value
+
+            return if_not_exists
+        if function == "list_append":
+            first = self._set_operand()
+            self.take(",")
+            second = self._set_operand()
+            self.take(")")
+            return lambda item: list(first(item)) + list(second(item))
+        return self.operand()
+
+
+def _condition_matcher(condition, kwargs: dict) -> Callable[[dict], bool]:
+    """A boto3 condition object or a string expression (with its placeholders in kwargs) as a predicate."""
+    if isinstance(condition, str):
+        return _Expression(condition, kwargs.get("ExpressionAttributeNames"), kwargs.get("ExpressionAttributeValues")).condition()
+    return lambda item: evaluate_condition(condition, item)
+
+
+def apply_update(item: dict, actions: List[Tuple[str, List[str], Optional[Callable[[dict], Any]]]]) -> dict:
+    """Apply parsed update actions to item in place. Values are computed from the item as it was."""
+    before = copy.deepcopy(item)
+    for clause, path, value in actions:
+        if clause == "REMOVE":
+            _parent(item, path).pop(path[-1], None)
+            continue
+        operand = value(before)
+        if operand is _MISSING:
+            raise _validation_error("The provided expression refers to an attribute that does not exist in the item")
+        current = _resolve(item, path)
+        if clause == "ADD":
+            if isinstance(operand, (set, frozenset)):
+                operand = set(operand) | (set(current) if current is not _MISSING else set())
+            elif current is not _MISSING:
+                operand = current + operand
+        elif clause == "DELETE":
+            operand = set(current) - set(operand) if current is not _MISSING else set()
+        _parent(item, path)[path[-1]] = operand
+    return item
+
+
+def _condition_failed(operation: str, item: Optional[dict], return_values: Optional[str]) -> ClientError:
+    response = {"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}}
+    if item is not None and return_values == "ALL_OLD":
+        # Like the service, the current item comes back in low-level typed form
+        serializer = TypeSerializer()
+        response["Item"] = {name: serializer.serialize(value) for name, value in item.items()}
+    return ClientError(response, operation)
+
+
+def _throughput_error(operation: str) -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "The level of configured provisioned throughput for the table was exceeded"}},
+        operation,
+    )
+
+
+class FakeBatchWriter:
+    def __init__(self, table: "FakeTable"):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item: dict):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key: dict):
+        self.table.delete_item(Key=Key)
+
+
+class FakeTable:
+    """
+    Stand-in for a boto3 DynamoDB Table resource: put/get/update/delete, Query (also on
+    global secondary indexes) and Scan with Segment/TotalSegments, 1 MB pages, LastEvaluatedKey,
+    projections, and conditions as boto3 condition objects or string expressions, including
+    conditional writes that fail with ConditionalCheckFailedException and
+    ReturnValuesOnConditionCheckFailure. latency adds a delay to every call,
+    and read_capacity (units per second) raises ProvisionedThroughputExceededException
+    once the burst allowance is used up, so scan concurrency and backoff can be measured
+    offline. projections lists the non-key attributes an index holds (INCLUDE); like a GSI,
+    queries on it return only those, and indexes without an entry project ALL.
+    """
+
+    def __init__(
+        self,
+        partition_key: str,
+        sort_key: Optional[str] = None,
+        indexes: Optional[Dict[str, Tuple[str, Optional[str]]]] = None,
+        projections: Optional[Dict[str, List[str]]] = None,
+        latency: float = 0.0,
+        read_capacity: Optional[float] = None,
+        page_bytes: int = DYNAMO_PAGE_BYTES,
+        name: str = "",
+    ):
+        self.name = name
+        # meta.client is the FakeDynamo the table is attached to, if any
+        self.meta = SimpleNamespace(client=None)
+        self.partition_key = partition_key
+        self.sort_key = sort_key
+        self.indexes = indexes or {}
+        self.projections = projections or {}
+        self.latency = latency
+        self.read_capacity = read_capacity
+        self.page_bytes = page_bytes
+        self.items: Dict[Tuple, dict] = {}
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._read_tokens = read_capacity or 0.0
+        self._refilled_at = time.monotonic()
+        self.key_schema = [{"AttributeName": partition_key, "KeyType": "HASH"}]
+        if sort_key:
+            self.key_schema.append({"AttributeName": sort_key, "KeyType": "RANGE"})
+
+    def _key(self, item: dict) -> Tuple:
+        return (item[self.partition_key], item[self.sort_key]) if self.sort_key else (item[self.partition_key],)
+
+    def _key_dict(self, item: dict, index: Optional[str] = None) -> dict:
+        names = [self.partition_key] + ([self.sort_key] if self.sort_key else [])
+        if index:
+            names += [name for name in self.indexes[index] if name]
+        return {name: item[name] for name in names}
+
+    def _index_item(self, item: dict, index: str) -> dict:
+        if index not in self.projections:
+            return item
+        projected = self._key_dict(item, index)
+        projected.update({name: item[name] for name in self.projections[index] if name in item})
+        return projected
+
+    def _call(self, operation: str):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        count_aws_call("dynamodb", _api_name(operation))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _consume_reads(self, operation: str, size: int) -> float:
+        # Eventually consistent reads: half a unit per 4 KB
+        units = max(0.5, math.ceil(size / 4096) * 0.5)
+        if self.read_capacity is not None:
+            # A token bucket holding up to one second of capacity, like DynamoDB's burst allowance
+            with self._lock:
+                now = time.monotonic()
+                self._read_tokens = min(self.read_capacity, self._read_tokens + (now - self._refilled_at) * self.read_capacity)
+                self._refilled_at = now
+                if self._read_tokens <= 0:
+                    raise _throughput_error(operation)
+                self._read_tokens -= units
+        return units
+
+    @staticmethod
+    def _project(item: dict, projection_expression: Optional[str], names: Optional[dict]) -> dict:
+        if not projection_expression:
+            return copy.deepcopy(item)
+        names = names or {}
+        attributes = [names.get(name.strip(), name.strip()) for name in projection_expression.split(",")]
+        return {name: copy.deepcopy(item[name]) for name in attributes if name in item}
+
+    def _write(self, operation: str, key: dict, kwargs: dict, change: Callable[[Optional[dict]], Optional[dict]]) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Replace the item at key with change(copy of the current item or None) if the
+        ConditionExpression in kwargs holds; a None result deletes it. Returns (old, new).
+        """
+        with self._lock:
+            current = self.items.get(self._key(key))
+            condition = kwargs.get("ConditionExpression")
+            if condition is not None and not _condition_matcher(condition, kwargs)(current or {}):
+                raise _condition_failed(operation, current, kwargs.get("ReturnValuesOnConditionCheckFailure"))
+            new = change(copy.deepcopy(current))
+            if new is None:
+                self.items.pop(self._key(key), None)
+            else:
+                self.items[self._key(key)] = new
+        return current, new
+
+    def put_item(self, Item: dict, ReturnValues: Optional[str] = None, **kwargs):
+        self._call("put_item")
+        old, _ = self._write("PutItem", Item, kwargs, lambda current: copy.deepcopy(Item))
+        return {"Attributes": old} if ReturnValues == "ALL_OLD" and old else {}
+
+    def get_item(self, Key: dict, ProjectionExpression: Optional[str] = None, ExpressionAttributeNames: Optional[dict] = None, **kwargs):
+        self._call("get_item")
+        item = self.items.get(self._key(Key))
+        if item is None:
+            return {}
+        self._consume_reads("GetItem", _item_bytes(item))
+        return {"Item": self._project(item, ProjectionExpression, ExpressionAttributeNames)}
+
+    def update_item(self, Key: dict, UpdateExpression: str, ReturnValues: Optional[str] = None, **kwargs):
+        self._call("update_item")
+        actions = _Expression(UpdateExpression, kwargs.get("ExpressionAttributeNames"), kwargs.get("ExpressionAttributeValues")).update()
+        old, new = self._write("UpdateItem", Key, kwargs, lambda current: apply_update(current or copy.deepcopy(Key), actions))
+        old = old or {}
+        # UPDATED_* return the updated top-level attributes, where the service returns the updated paths
+        updated = {path[0] for _, path, _ in actions}
+        attributes = {
+            "ALL_OLD": old,
+            "ALL_NEW": new,
+            "UPDATED_OLD": {name: old[name] for name in updated if name in old},
+            "UPDATED_NEW": {name: new[name] for name in updated if name in new},
+        }.get(ReturnValues)
+        return {"Attributes": copy.deepcopy(attributes)} if attributes else {}
+
+    def delete_item(self, Key: dict, ReturnValues: Optional[str] = None, **kwargs):
+        self._call("delete_item")
+        old, _ = self._write("DeleteItem", Key, kwargs, lambda current: None)
+        return {"Attributes": old} if ReturnValues == "ALL_OLD" and old else {}
+
+    def batch_writer(self, **kwargs) -> FakeBatchWriter:
+        return FakeBatchWriter(self)
+
+    def _page(self, operation: str, candidates: List[Tuple[Any, dict]], kwargs: dict, index: Optional[str] = None, descending: bool = False) -> dict:
+        """Read candidates (sorted by key) after ExclusiveStartKey, up to Limit items or page_bytes."""
+        start_key = kwargs.get("ExclusiveStartKey")
+        if start_key is not None:
+            start = self._sort_key(start_key, index)
+            candidates = [candidate for candidate in candidates if (candidate[0] < start if descending else candidate[0] > start)]
+
+        items, size, scanned = [], 0, 0
+        last_item = None
+        matches = _condition_matcher(kwargs["FilterExpression"], kwargs) if kwargs.get("FilterExpression") is not None else None
+        for _, item in candidates:
+            if kwargs.get("Limit") and scanned >= kwargs["Limit"]:
+                break
+            if size and size + _item_bytes(item) > self.page_bytes:
+                break
+            size += _item_bytes(item)
+            scanned += 1
+            last_item = item
+            if matches is None or matches(item):
+                items.append(self._project(item, kwargs.get("ProjectionExpression"), kwargs.get("ExpressionAttributeNames")))
+
+        units = self._consume_reads(operation, size)
+        response = {"Items": items, "Count": len(items), "ScannedCount": scanned}
+        if last_item is not None and scanned < len(candidates):
+            response["LastEvaluatedKey"] = self._key_dict(last_item, index)
+        if kwargs.get("ReturnConsumedCapacity") in ("TOTAL", "INDEXES"):
+            response["ConsumedCapacity"] = {"CapacityUnits": units}
+        return response
+
+    def _sort_key(self, item: dict, index: Optional[str] = None) -> Tuple:
+        key = self._key(item)
+        if index:
+            partition_key, sort_key = self.indexes[index]
+            key = (item[partition_key], item[sort_key] if sort_key else None) + key
+        return tuple(str(part) for part in key)
+
+    def scan(self, **kwargs):
+        self._call("scan")
+        total_segments = kwargs.get("TotalSegments", 1)
+        segment = kwargs.get("Segment", 0)
+        with self._lock:
+            items = list(self.items.values())
+        # Like DynamoDB, a segment holds the items whose partition key hashes to it
+        candidates = sorted((self._sort_key(item), item) for item in items if zlib.crc32(str(item[self.partition_key]).encode()) % total_segments == segment)
+        return self._page("Scan", candidates, kwargs)
+
+    def query(self, KeyConditionExpression, IndexName: Optional[str] = None, ScanIndexForward: bool = True, **kwargs):
+        self._call("query")
+        if IndexName is not None and IndexName not in self.indexes:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": f"Index {IndexName} does not exist"}}, "Query")
+        with self._lock:
+            items = list(self.items.values())
+        if IndexName:
+            items = [self._index_item(item, IndexName) for item in items if all(name in item for name in self.indexes[IndexName] if name)]
+        matches = _condition_matcher(KeyConditionExpression, kwargs)
+        candidates = sorted(((self._sort_key(item, IndexName), item) for item in items if matches(item)), reverse=not ScanIndexForward)
+        return self._page("Query", candidates, kwargs, IndexName, descending=not ScanIndexForward)
+
+
+class TransactionCanceledException(ClientError):
+    pass
+
+
+class FakeDynamo:
+    """
+    Stand-in for the DynamoDB calls that span FakeTables: BatchGetItem as the resource
+    makes it (plain values) and TransactWriteItems as the client makes it (typed values),
+    which the app reaches through table.meta.client. All conditions of a transaction are
+    checked before any of its writes is applied.
+    """
+
+    class exceptions:
+        TransactionCanceledException = TransactionCanceledException
+
+    def __init__(self, *tables: FakeTable):
+        self.tables = {table.name: table for table in tables}
+        self.calls: Dict[str, int] = {}
+        for table in tables:
+            table.meta.client = self
+
+    def Table(self, name: str) -> FakeTable:
+        return self.tables[name]
+
+    def _call(self, operation: str):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        count_aws_call("dynamodb", _api_name(operation))
+
+    def batch_get_item(self, RequestItems: dict) -> dict:
+        self._call("batch_get_item")
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            found = [table.items.get(table._key(key)) for key in request["Keys"]]
+            responses[name] = [table._project(item, request.get("ProjectionExpression"), request.get("ExpressionAttributeNames")) for item in found if item is not None]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def transact_write_items(self, TransactItems: List[dict]) -> dict:
+        self._call("transact_write_items")
+        deserializer = TypeDeserializer()
+        operations = []
+        for entry in TransactItems:
+            ((action, request),) = entry.items()
+            request = dict(request)
+            for field in ("Key", "Item", "ExpressionAttributeValues"):
+                if field in request:
+                    request[field] = {name: deserializer.deserialize(value) for name, value in request[field].items()}
+            operations.append((action, self.tables[request["TableName"]], request))
+
+        reasons = []
+        for action, table, request in operations:
+            current = table.items.get(table._key(request.get("Key") or request["Item"]))
+            condition = request.get("ConditionExpression")
+            holds = condition is None or _condition_matcher(condition, request)(current or {})
+            reasons.append({"Code": "None"} if holds else {"Code": "ConditionalCheckFailed", "Message": "The conditional request failed"})
+        if any(reason["Code"] != "None" for reason in reasons):
+            raise TransactionCanceledException({"Error": {"Code": "TransactionCanceledException", "Message": "Transaction cancelled"}, "CancellationReasons": reasons}, "TransactWriteItems")
+
+        for action, table, request in operations:
+            if action == "Put":
+                table._write("TransactWriteItems", request["Item"], {}, lambda current, item=request["Item"]: copy.deepcopy(item))
+            elif action == "Delete":
+                table._write("TransactWriteItems", request["Key"], {}, lambda current: None)
+            elif action == "Update":
+                actions = _Expression(request["UpdateExpression"], request.get("ExpressionAttributeNames"), request.get("ExpressionAttributeValues")).update()
+                table._write("TransactWriteItems", request["Key"], {}, lambda current, key=request["Key"], actions=actions: apply_update(current or copy.deepcopy(key), actions))
+        return {}
+
+
+class FakeObject:
+    def __init__(self, bucket: "FakeBucket", key: str):
+        self.bucket = bucket
+        self.key = key
+
+    def get(self, **kwargs) -> dict:
+        self.bucket._call("get_object")
+        stored = self.bucket.stored.get(self.key)
+        if stored is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, "GetObject")
+        response = {"Body": io.BytesIO(stored["Body"]), "ContentLength": len(stored["Body"]), "LastModified": stored["LastModified"]}
+        response.update({name: stored[name] for name in ("ContentType", "ContentEncoding") if stored.get(name)})
+        return response
+
+    def delete(self) -> dict:
+        self.bucket._call("delete_object")
+        self.bucket.stored.pop(self.key, None)
+        return {}
+
+
+class FakeObjectCollection:
+    """bucket.objects: filter(Prefix=...), page_size(n), pages() and iteration over object summaries."""
+
+    def __init__(self, bucket: "FakeBucket", prefix: str = "", page_size: int = 1000):
+        self.bucket = bucket
+        self.prefix = prefix
+        self._page_size = page_size
+
+    def all(self) -> "FakeObjectCollection":
+        return self
+
+    def filter(self, Prefix: str = "", **kwargs) -> "FakeObjectCollection":
+        return FakeObjectCollection(self.bucket, Prefix, self._page_size)
+
+    def page_size(self, count: int) -> "FakeObjectCollection":
+        return FakeObjectCollection(self.bucket, self.prefix, count)
+
+    def pages(self):
+        keys = sorted(key for key in list(self.bucket.stored) if key.startswith(self.prefix))
+        for start in range(0, max(len(keys), 1), self._page_size):
+            self.bucket._call("list_objects_v2")
+            page = []
+            for key in keys[start : start + self._page_size]:
+                stored = self.bucket.stored.get(key)
+                if stored is not None:
+                    page.append(SimpleNamespace(key=key, size=len(stored["Body"]), last_modified=stored["LastModified"]))
+            yield page
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
+
+
+class FakeBucket:
+    """
+    Stand-in for a boto3 S3 Bucket resource holding objects in memory: upload_fileobj,
+    put_object, Object(key).get()/delete(), delete_objects and object listing.
+    latency adds a delay to every call.
+    """
+
+    def __init__(self, name: str = "local-receipts", latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.stored: Dict[str, dict] = {}
+        self.calls: Dict[str, int] = {}
+        self.objects = FakeObjectCollection(self)
+        self._lock = threading.Lock()
+
+    def _call(self, operation: str):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        count_aws_call("s3", _api_name(operation))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _store(self, key: str, body, content_type: Optional[str] = None, content_encoding: Optional[str] = None):
+        if hasattr(body, "read"):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.stored[key] = {"Body": bytes(body), "ContentType": content_type, "ContentEncoding": content_encoding, "LastModified": datetime.now(timezone.utc)}
+
+    def upload_fileobj(self, Fileobj, Key: str, ExtraArgs: Optional[dict] = None, **kwargs):
+        self._call("put_object")
+        extra_args = ExtraArgs or {}
+        self._store(Key, Fileobj, extra_args.get("ContentType"), extra_args.get("ContentEncoding"))
+
+    def put_object(self, Key: str, Body=b"", ContentType: Optional[str] = None, ContentEncoding: Optional[str] = None, **kwargs) -> dict:
+        self._call("put_object")
+        self._store(Key, Body, ContentType, ContentEncoding)
+        return {"ETag": f'"{uuid.uuid4().hex}"'}
+
+    def Object(self, key: str) -> FakeObject:
+        return FakeObject(self, key)
+
+    def delete_objects(self, Delete: dict) -> dict:
+        self._call("delete_objects")
+        keys = [entry["Key"] for entry in Delete.get("Objects", [])]
+        for key in keys:
+            self.stored.pop(key, None)
+        return {} if Delete.get("Quiet") else {"Deleted": [{"Key": key} for key in keys]}
@@ -0,0 +1,348 @@
+"""
+Background maintenance jobs and their scheduler:
+
+    s3_orphans          delete S3 objects under receipts/, optimized/ and ocr/ that no receipt references
+    blacklist           purge blacklisted tokens past their expires_at
+    receipt_aggregates  rebuild missing or stale derived receipt attributes (summary, date index keys, item_size)
+    snapshot            refresh the columnar analytics snapshot (src.analytics), when pyarrow is installed
+
+Every job reads and writes in pages, paced to the MAINTENANCE_*_PER_SECOND capacity budgets,
+and prints its progress. The scheduler runs in the app when MAINTENANCE_SCHEDULER_ENABLED is
+set (run it in one instance only), or as a standalone worker:
+
+    python -m src.maintenance [JOB ...] [--dry-run] [--loop]
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from boto3.dynamodb.conditions import Attr, Key
+
+from src import analytics
+from src.config import (
+    MAINTENANCE_AGGREGATES_INTERVAL_SECONDS,
+    MAINTENANCE_BLACKLIST_INTERVAL_SECONDS,
+    MAINTENANCE_ORPHAN_MIN_AGE_SECONDS,
+    MAINTENANCE_PROGRESS_SECONDS,
+    MAINTENANCE_READ_UNITS_PER_SECOND,
+    MAINTENANCE_S3_ORPHANS_INTERVAL_SECONDS,
+    MAINTENANCE_S3_REQUESTS_PER_SECOND,
+    MAINTENANCE_WRITE_UNITS_PER_SECOND,
+    SCAN_SEGMENTS,
+    SNAPSHOT_INTERVAL_SECONDS,
+    SNAPSHOT_SCAN_SEGMENTS,
+    blacklist_token_db,
+    receipt_bucket,
+    receipt_db,
+)
+from src.migrate_ocr import migrate_item, needs_migration
+from src.scan import ParallelScan
+from src.utils import S3_DELETE_OBJECTS_LIMIT, delete_s3_objects, projection
+
+ORPHAN_PREFIXES = ("receipts/", "optimized/", "ocr/")
+RECEIPT_S3_ATTRIBUTES = ["receipt_s3_path", "receipt_optimized_s3_path", "textract_s3_path"]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Throttle:
+    """Paces work to an average of rate units per second, allowing up to one second of burst."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.available_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, units: float):
+        if self.rate <= 0 or units <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now - 1) + units / self.rate
+            delay = self.available_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class JobProgress:
+    """Counters for a job run, printed every MAINTENANCE_PROGRESS_SECONDS and at the end."""
+
+    def __init__(self, job: str, stop_event: Optional[threading.Event] = None, report_every: float = MAINTENANCE_PROGRESS_SECONDS):
+        self.job = job
+        self.stop_event = stop_event
+        self.report_every = report_every
+        self.counts: Dict[str, int] = {}
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def add(self, **counts: int):
+        """Add to the counters. Jobs call this once per page, which is where a stop request takes effect."""
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+        if time.monotonic() - self.reported >= self.report_every:
+            self.report()
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise JobCancelled(self.job)
+
+    def report(self, state: str = "running"):
+        self.reported = time.monotonic()
+        print(f"[maintenance] {self.job} {state} after {self.reported - self.started:.0f}s: {self.counts}")
+
+    def finish(self) -> Dict[str, int]:
+        self.report("finished")
+        return dict(self.counts)
+
+
+def read_pages(operation: Callable, throttle: Throttle, **kwargs) -> Iterator[List[dict]]:
+    """Yield the pages of a DynamoDB query, pacing reads by the capacity each page consumed."""
+    kwargs["ReturnConsumedCapacity"] = "TOTAL"
+    while True:
+        response = operation(**kwargs)
+        throttle.consume(response.get("ConsumedCapacity", {}).get("CapacityUnits", 1))
+        yield response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def referenced_s3_keys(username: str, read_throttle: Throttle) -> Set[str]:
+    """Every S3 key a user's receipts point to."""
+    projection_expression, projection_names = projection(RECEIPT_S3_ATTRIBUTES)
+    keys = set()
+    for page in read_pages(
+        receipt_db.query,
+        read_throttle,
+        KeyConditionExpression=Key("receipt_username").eq(username),
+        ProjectionExpression=projection_expression,
+        ExpressionAttributeNames=projection_names,
+    ):
+        keys.update(item[attribute] for item in page for attribute in RECEIPT_S3_ATTRIBUTES if item.get(attribute))
+    return keys
+
+
+def reconcile_s3_orphans(dry_run: bool = False, stop_event: Optional[threading.Event] = None, min_age_seconds: float = MAINTENANCE_ORPHAN_MIN_AGE_SECONDS) -> Dict[str, int]:
+    """
+    Delete objects under the receipt prefixes that no receipt references, e.g. originals left
+    behind when a delete could not remove them. Listing is streamed a page at a time; keys are
+    grouped by user (<prefix><username>/...), so only one user's references are held at once.
+    Objects newer than min_age_seconds are kept, since uploads write to S3 before the receipt.
+    """
+    progress = JobProgress("s3_orphans", stop_event)
+    read_throttle = Throttle(MAINTENANCE_READ_UNITS_PER_SECOND)
+    s3_throttle = Throttle(MAINTENANCE_S3_REQUESTS_PER_SECOND)
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=min_age_seconds)
+
+    for prefix in ORPHAN_PREFIXES:
+        current_user, referenced = None, set()
+        for page in receipt_bucket.objects.filter(Prefix=prefix).page_size(S3_DELETE_OBJECTS_LIMIT).pages():
+            s3_throttle.consume(1)
+            orphans = []
+            recent = 0
+            for s3_object in page:
+                username = s3_object.key[len(prefix) :].split("/", 1)[0]
+                if s3_object.last_modified > cutoff:
+                    recent += 1
+                    continue
+                if username != current_user:
+                    current_user, referenced = username, referenced_s3_keys(username, read_throttle)
+                if s3_object.key not in referenced:
+                    orphans.append(s3_object.key)
+
+            failed = {}
+            if orphans and not dry_run:
+                failed = delete_s3_objects(orphans)
+                s3_throttle.consume(1)
+            progress.add(listed=len(page), recent=recent, orphaned=len(orphans), deleted=0 if dry_run else len(orphans) - len(failed), failed=len(failed))
+    return progress.finish()
+
+
+def purge_expired_blacklist(dry_run: bool = False, stop_event: Optional[threading.Event] = None, now: Optional[int] = None) -> Dict[str, int]:
+    """
+    Delete blacklist rows whose expires_at has passed; the token itself is rejected as expired
+    by then. Enabling DynamoDB TTL on expires_at does the same for free, with up to days of delay.
+    """
+    progress = JobProgress("blacklist", stop_event)
+    read_throttle = Throttle(MAINTENANCE_READ_UNITS_PER_SECOND)
+    write_throttle = Throttle(MAINTENANCE_WRITE_UNITS_PER_SECOND)
+    now = int(now if now is not None else time.time())
+
+    key_names = [key["AttributeName"] for key in blacklist_token_db.key_schema]
+    projection_expression, projection_names = projection(key_names)
+    for page in ParallelScan(
+        blacklist_token_db,
+        SCAN_SEGMENTS,
+        throttle=read_throttle,
+        FilterExpression=Attr("expires_at").lt(now),
+        ProjectionExpression=projection_expression,
+        ExpressionAttributeNames=projection_names,
+    ):
+        if page and not dry_run:
+            with blacklist_token_db.batch_writer() as batch:
+                for item in page:
+                    batch.delete_item(Key={name: item[name] for name in key_names})
+            write_throttle.consume(len(page))
+        progress.add(expired=len(page), deleted=0 if dry_run else len(page))
+    return progress.finish()
+
+
+def rebuild_receipt_aggregates(dry_run: bool = False, stop_event: Optional[threading.Event] = None) -> Dict[str, int]:
+    """Rewrite receipts whose summary, date index keys or item_size are missing or stale (see src.migrate_ocr)."""
+    progress = JobProgress("receipt_aggregates", stop_event)
+    read_throttle = Throttle(MAINTENANCE_READ_UNITS_PER_SECOND)
+    write_throttle = Throttle(MAINTENANCE_WRITE_UNITS_PER_SECOND)
+
+    for page in ParallelScan(receipt_db, SCAN_SEGMENTS, throttle=read_throttle):
+        results: Dict[str, int] = {}
+        for item in page:
+            if not needs_migration(item):
+                continue
+            result = "stale" if dry_run else migrate_item(item)
+            results[result] = results.get(result, 0) + 1
+            if not dry_run:
+                write_throttle.consume(1)
+        progress.add(scanned=len(page), **results)
+    return progress.finish()
+
+
+def refresh_snapshot(dry_run: bool = False, stop_event: Optional[threading.Event] = None) -> Dict[str, int]:
+    """Export the analytics snapshot (src.analytics) from a throttled scan; a dry run only counts the rows."""
+    progress = JobProgress("snapshot", stop_event)
+    read_throttle = Throttle(MAINTENANCE_READ_UNITS_PER_SECOND)
+
+    rows = []
+    for page in analytics.scan_snapshot_pages(SNAPSHOT_SCAN_SEGMENTS, throttle=read_throttle):
+        page_rows = [row for row in map(analytics.snapshot_row, page) if row]
+        rows.extend(page_rows)
+        progress.add(scanned=len(page), rows=len(page_rows))
+    if not dry_run:
+        stats = analytics.export_snapshot(rows=rows)
+        del stats["rows"]
+        progress.add(**stats)
+    return progress.finish()
+
+
+class MaintenanceJob:
+    def __init__(self, name: str, run: Callable[..., Dict[str, int]], interval_seconds: float, available: Callable[[], bool]):
+        self.name = name
+        self.run = run
+        self.interval_seconds = interval_seconds
+        self.available = available
+        self.last_started: Optional[float] = None
+        self.last_result: Optional[Dict[str, int]] = None
+        self.last_error: Optional[str] = None
+
+
+def default_jobs() -> Dict[str, MaintenanceJob]:
+    return {
+        job.name: job
+        for job in (
+            MaintenanceJob("s3_orphans", reconcile_s3_orphans, MAINTENANCE_S3_ORPHANS_INTERVAL_SECONDS, lambda: receipt_bucket is not None and receipt_db is not None),
+            MaintenanceJob("blacklist", purge_expired_blacklist, MAINTENANCE_BLACKLIST_INTERVAL_SECONDS, lambda: blacklist_token_db is not None),
+            MaintenanceJob("receipt_aggregates", rebuild_receipt_aggregates, MAINTENANCE_AGGREGATES_INTERVAL_SECONDS, lambda: receipt_db is not None),
+            MaintenanceJob("snapshot", refresh_snapshot, SNAPSHOT_INTERVAL_SECONDS, lambda: analytics.available() and receipt_db is not None),
+        )
+    }
+
+
+class MaintenanceScheduler:
+    """
+    Runs each job every interval_seconds, one at a time in a worker thread so the event loop
+    stays free. Jobs whose AWS resources are not configured are skipped.
+    """
+
+    def __init__(self, jobs: Optional[Dict[str, MaintenanceJob]] = None, dry_run: bool = False):
+        self.jobs = jobs if jobs is not None else default_jobs()
+        self.dry_run = dry_run
+        self.stop_event = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def due_jobs(self, now: float) -> List[MaintenanceJob]:
+        return [job for job in self.jobs.values() if job.available() and (job.last_started is None or now - job.last_started >= job.interval_seconds)]
+
+    def seconds_until_next(self, now: float) -> float:
+        waits = [job.interval_seconds - (now - job.last_started) for job in self.jobs.values() if job.available() and job.last_started is not None]
+        return max(1.0, min(waits, default=60.0))
+
+    async def run_job(self, job: MaintenanceJob):
+        job.last_started = time.monotonic()
+        try:
+            job.last_result = await asyncio.to_thread(job.run, self.dry_run, self.stop_event)
+            job.last_error = None
+        except JobCancelled:
+            print(f"[maintenance] {job.name} stopped")
+        except Exception as e:
+            job.last_error = str(e)
+            print(f"[maintenance] {job.name} failed: {e}")
+
+    async def run_forever(self):
+        try:
+            while not self.stop_event.is_set():
+                for job in self.due_jobs(time.monotonic()):
+                    if self.stop_event.is_set():
+                        return
+                    await self.run_job(job)
+                await asyncio.sleep(self.seconds_until_next(time.monotonic()))
+        except asyncio.CancelledError:
+            # The worker thread cannot be cancelled; have the job stop at its next page
+            self.stop_event.set()
+            raise
+
+    def start(self):
+        self.stop_event.clear()
+        self.task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        """Ask the running job to stop at its next page and wait for the scheduler to exit."""
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def status(self) -> Dict[str, dict]:
+        return {name: {"last_result": job.last_result, "last_error": job.last_error} for name, job in self.jobs.items()}
+
+
+scheduler = MaintenanceScheduler()
+
+
+def main():
+    jobs = default_jobs()
+    parser = argparse.ArgumentParser(description="Run maintenance jobs once, or keep running them on their schedule with --loop")
+    parser.add_argument("jobs", nargs="*", help=f"Jobs to run: {', '.join(jobs)} (default: all)")
+    parser.add_argument("--dry-run", action="store_true", help="Only count what would be deleted or rewritten")
+    parser.add_argument("--loop", action="store_true", help="Run as a worker, repeating each job at its interval")
+    args = parser.parse_args()
+
+    unknown = set(args.jobs) - set(jobs)
+    if unknown:
+        parser.error(f"unknown jobs: {', '.join(sorted(unknown))}")
+
+    selected = {name: job for name, job in jobs.items() if not args.jobs or name in args.jobs}
+    unavailable = [name for name, job in selected.items() if not job.available()]
+    if unavailable:
+        raise SystemExit(f"AWS resources for {', '.join(unavailable)} are not configured")
+
+    if args.loop:
+        worker = MaintenanceScheduler(selected, dry_run=args.dry_run)
+        try:
+            asyncio.run(worker.run_forever())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    for job in selected.values():
+        job.run(args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import time
+import zlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.capture import BODY_MAX_BYTES, MULTIPART_HEAD_BYTES, TrafficRecorder, counting_aws_calls
+from src.config import COMPRESSION_MIN_BYTES, SECRET_KEY, TRAFFIC_CAPTURE_PATH, TRAFFIC_CAPTURE_SAMPLE_RATE, TRAFFIC_CAPTURE_USER_BUCKETS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "application/x-msgpack", "application/javascript", "application/xml")
+
+
+class AuthSessionMiddleware:
+    """
+    SessionMiddleware for the /auth routes only. The session just carries the OAuth
+    state from /auth/login to /auth/authorize, so other requests skip verifying (and
+    re-signing) the session cookie the browser sends along with them.
+    """
+
+    def __init__(self, app: ASGIApp, path_prefix: str = "/auth", **session_options):
+        self.app = app
+        self.session_app = SessionMiddleware(app, **session_options)
+        self.path_prefix = path_prefix.rstrip("/")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get("path", "")
+        if scope["type"] in ("http", "websocket") and (path == self.path_prefix or path.startswith(self.path_prefix + "/")):
+            await self.session_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+class TokenExpiryMiddleware:
+    """
+    Adds X-Token-Expires-In (seconds) to responses of authenticated requests, from the
+    expiry get_current_user records for the access token, so clients can refresh ahead
+    of expiry instead of after a 401.
+    """
+
+    def __init__(self, app: ASGIApp, header_name: str = "x-token-expires-in"):
+        self.app = app
+        self.header_name = header_name.lower().encode("latin-1")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_expiry(message: Message):
+            if message["type"] == "http.response.start":
+                expires_at = scope.get("state", {}).get("token_expires_at")
+                if expires_at:
+                    expires_in = max(0, int(expires_at - time.time()))
+                    message["headers"] = [*message.get("headers", []), (self.header_name, str(expires_in).encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_with_expiry)
+
+
+class GzipCompressor:
+    def __init__(self, level: int = 6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality: int = 4):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred of br (when the brotli package is installed) and gzip under Accept-Encoding, None for neither."""
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        weight = 1.0
+        if params.strip().startswith("q="):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                weight = 0.0
+        if coding.strip():
+            weights[coding.strip().lower()] = weight
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    candidates = [(weights.get(coding, weights.get("*", 0.0)), -index, coding) for index, coding in enumerate(supported)]
+    weight, _, coding = max(candidates)
+    return coding if weight > 0 else None
+
+
+def is_compressible(headers: Headers) -> bool:
+    if "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    # Event streams must reach the browser as each event is sent, not when a compressor flushes
+    if content_type == "text/event-stream":
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES or content_type.endswith("+json")
+
+
+class CompressionMiddleware:
+    """
+    Compresses text and JSON/MessagePack responses of at least minimum_size bytes with
+    brotli or gzip, as negotiated with Accept-Encoding. Whole responses keep an exact
+    Content-Length; streamed ones are compressed chunk by chunk. Images (already
+    compressed), event streams and encoded responses pass through unchanged.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_BYTES, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def compressor(self, encoding: str):
+        return BrotliCompressor(self.brotli_quality) if encoding == "br" else GzipCompressor(self.gzip_level)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message: Message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                # The first body message decides, once the size of a whole response is known
+                headers = MutableHeaders(raw=start_message.setdefault("headers", []))
+                if not is_compressible(headers):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                headers.add_vary_header("Accept-Encoding")
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                compressor = self.compressor(encoding)
+                headers["Content-Encoding"] = encoding
+                if not more_body:
+                    compressed = compressor.compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(compressed))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                del headers["Content-Length"]
+                await send(start_message)
+
+            compressed = compressor.compress(body)
+            if not more_body:
+                compressed += compressor.finish()
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+class TrafficCaptureMiddleware:
+    """
+    Records the shape and timing of sampled HTTP requests for replay with src.replay:
+    route template, user bucket, request and response sizes, status, duration until the
+    last body byte and the AWS calls made. See src.capture for what is kept. Add it
+    outermost, so sizes and durations are the ones clients see.
+    """
+
+    def __init__(self, app: ASGIApp, recorder: Optional[TrafficRecorder] = None):
+        self.app = app
+        self.recorder = recorder or TrafficRecorder(TRAFFIC_CAPTURE_PATH, SECRET_KEY, TRAFFIC_CAPTURE_USER_BUCKETS, TRAFFIC_CAPTURE_SAMPLE_RATE)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.recorder.sampled():
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_type = headers.get("content-type", "")
+        media_type = content_type.split(";")[0].strip().lower()
+        keep_bytes = BODY_MAX_BYTES if media_type.endswith("json") else MULTIPART_HEAD_BYTES if media_type == "multipart/form-data" else 0
+        request = {"bytes": 0, "head": bytearray()}
+        response = {"status": 500, "type": None, "bytes": 0, "finished": None}
+
+        async def capture_receive() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                request["bytes"] += len(body)
+                if len(request["head"]) < keep_bytes:
+                    request["head"].extend(body[: keep_bytes - len(request["head"])])
+            return message
+
+        async def capture_send(message: Message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["type"] = Headers(raw=message.get("headers", [])).get("content-type")
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response["finished"] = time.perf_counter()
+            await send(message)
+
+        captured_at = time.time()
+        started = time.perf_counter()
+        with counting_aws_calls() as aws_calls:
+            try:
+                await self.app(scope, capture_receive, capture_send)
+            finally:
+                finished = response["finished"] or time.perf_counter()
+                self.record(scope, headers, media_type, request, response, finished - started, captured_at, aws_calls)
+
+    def record(self, scope: Scope, headers: Headers, media_type: str, request: dict, response: dict, duration: float, captured_at: float, aws_calls: dict):
+        recorder = self.recorder
+        route = scope.get("route")
+        keep_bytes = BODY_MAX_BYTES if media_type.endswith("json") else MULTIPART_HEAD_BYTES
+        entry = {
+            "ts": round(captured_at, 3),
+            "method": scope["method"],
+            # None when no route matched; the raw path may hold identifiers
+            "route": getattr(route, "path_format", None),
+            "path_params": recorder.sanitize({name: str(value) for name, value in scope.get("path_params", {}).items()}) if route else {},
+            "query": recorder.sanitize_query(scope.get("query_string", b"")),
+            "user": recorder.user_bucket(scope.get("state", {}).get("username")),
+            "headers": {name: headers[name] for name in ("accept", "accept-encoding") if name in headers},
+            "if_match": "if-match" in headers,
+            "content_type": media_type or None,
+            "request_bytes": request["bytes"],
+            "body": recorder.body_shape(media_type, bytes(request["head"]), complete=request["bytes"] <= keep_bytes),
+            "status": response["status"],
+            "response_type": response["type"],
+            "response_bytes": response["bytes"],
+            "duration_ms": round(duration * 1000, 3),
+            "aws_calls": dict(aws_calls),
+        }
+        try:
+            recorder.write(entry)
+        except OSError as e:
+            # Capture is diagnostic; the request has been served either way
+            print(f"Error writing traffic capture: {e}")
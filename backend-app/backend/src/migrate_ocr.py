@@ -0,0 +1,80 @@
+"""
+Convert existing receipts to the tiered OCR layout: add the compact receipt_summary,
+move textract_data maps larger than OCR_INLINE_MAX_BYTES to S3 and add the receipt
+date keys of the period index (falling back to the upload date). Receipts whose date
+keys no longer match their receipt date are rebuilt too.
+
+    python -m src.migrate_ocr [--dry-run] [--limit N] [--segments N] [--checkpoint FILE]
+"""
+
+import argparse
+import os
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from src.config import OCR_INLINE_MAX_BYTES, SCAN_SEGMENTS, receipt_db
+from src.scan import ParallelScan, ScanCheckpoint
+from src.utils import estimate_attribute_size, receipt_period, receipt_textract_data, replace_receipt_ocr
+
+
+def needs_migration(item: dict) -> bool:
+    if "receipt_summary" not in item or "receipt_period" not in item or "item_size" not in item:
+        return True
+    if item.get("receipt_date") and item["receipt_period"] != receipt_period(item["receipt_username"], item["receipt_date"]):
+        return True
+    return "textract_data" in item and estimate_attribute_size(item["textract_data"]) > OCR_INLINE_MAX_BYTES
+
+
+def migrate_item(item: dict) -> str:
+    """Rewrite one receipt in the current layout. Returns "migrated", "skipped_modified" or "failed"."""
+    try:
+        replace_receipt_ocr(
+            item["receipt_username"],
+            item["receipt_id"],
+            receipt_textract_data(item),
+            expected_version=int(item.get("version", 0)),
+            fallback_date=item.get("receipt_date") or item.get("receipt_upload_datetime", "")[:10] or None,
+        )
+        return "migrated"
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+            # Changed since it was scanned; a rerun picks it up if it still needs migrating
+            return "skipped_modified"
+        print(f"Failed to migrate receipt {item['receipt_id']}: {e}")
+        return "failed"
+
+
+def migrate(dry_run: bool = False, limit: int = None, total_segments: int = SCAN_SEGMENTS, checkpoint: Optional[ScanCheckpoint] = None) -> dict:
+    stats = {"scanned": 0, "migrated": 0, "skipped_modified": 0, "failed": 0}
+    for page in ParallelScan(receipt_db, total_segments, checkpoint):
+        for item in page:
+            stats["scanned"] += 1
+            if not needs_migration(item):
+                continue
+            if limit is not None and stats["migrated"] >= limit:
+                return stats
+            stats["migrated" if dry_run else migrate_item(item)] += 1
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move receipt OCR data to the summary + S3 layout")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the receipts that would be migrated")
+    parser.add_argument("--limit", type=int, default=None, help="Migrate at most this many receipts")
+    parser.add_argument("--segments", type=int, default=SCAN_SEGMENTS, help="Parallel scan segments")
+    parser.add_argument("--checkpoint", help="Save scan progress to this file and resume from it when it exists")
+    args = parser.parse_args()
+
+    if receipt_db is None:
+        raise SystemExit("RECEIPT_TABLE and AWS credentials must be configured")
+
+    checkpoint = ScanCheckpoint.load(args.checkpoint, args.segments) if args.checkpoint else None
+    stats = migrate(dry_run=args.dry_run, limit=args.limit, total_segments=args.segments, checkpoint=checkpoint)
+    print(stats)
+    if checkpoint and checkpoint.finished:
+        os.remove(args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
-from typing import Dict, Optional
+import sys
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+# Most receipt IDs accepted by one batch request
+BATCH_RECEIPT_LIMIT = 1000
 
 
 class ReceiptStatusUpdate(BaseModel):
@@ -11,3 +17,204 @@ class ReceiptStatusUpdate(BaseModel):
 class ReceiptUpdate(BaseModel):
     receipt_status: Optional[str] = None
     textract_data: Optional[Dict[str, str]] = None
+
+
+class ReceiptBatchStatusUpdate(BaseModel):
+    receipt_ids: List[str] = Field(..., max_items=BATCH_RECEIPT_LIMIT)
+    new_status: str
+
+
+class ReceiptBatchDelete(BaseModel):
+    receipt_ids: List[str] = Field(..., max_items=BATCH_RECEIPT_LIMIT)
+
+
+class ReceiptMergePatch(BaseModel):
+    # application/merge-patch+json: a null textract value removes that field
+    receipt_status: Optional[str] = None
+    textract_data: Optional[Dict[str, Optional[str]]] = None
+
+
+class ReceiptPatchOperation(BaseModel):
+    # application/json-patch+json operation on /receipt_status or /textract_data/<field>
+    op: str
+    path: str
+    value: Optional[str] = None
+
+
+def _int(value) -> Optional[int]:
+    return None if value is None else int(value)
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # Usernames, statuses and categories repeat across receipts; share one string each
+    return None if value is None else sys.intern(value)
+
+
+@dataclass(slots=True)
+class ReceiptSummary:
+    """The compact receipt_summary map kept in every receipt item."""
+
+    total: Optional[Decimal] = None
+    date: Optional[str] = None
+    vendor: Optional[str] = None
+    category: Optional[str] = None
+
+    @classmethod
+    def from_item(cls, summary: Optional[Dict[str, Any]]) -> Optional["ReceiptSummary"]:
+        if summary is None:
+            return None
+        get = summary.get
+        return cls(get("total"), get("date"), get("vendor"), _intern(get("category")))
+
+    def to_item(self) -> Dict[str, Any]:
+        item = {"total": self.total, "date": self.date, "vendor": self.vendor, "category": self.category}
+        return {key: value for key, value in item.items() if value is not None}
+
+
+# Attributes of a receipt item that Receipt has fields for; any others are kept in Receipt.extra
+RECEIPT_ITEM_ATTRIBUTES = (
+    "receipt_username",
+    "receipt_id",
+    "receipt_filename",
+    "receipt_status",
+    "receipt_upload_datetime",
+    "receipt_size",
+    "receipt_date",
+    "receipt_summary",
+    "version",
+    "receipt_s3_path",
+    "receipt_optimized_s3_path",
+    "receipt_optimized_size",
+    "textract_data",
+    "textract_s3_path",
+    "ocr_status",
+    "ocr_engine",
+    "ocr_confidence",
+    "ocr_pages",
+    "textract_job_id",
+    "receipt_period",
+    "receipt_date_key",
+    "item_size",
+    "content_sha256",
+    "image_hash",
+    "ocr_fingerprint",
+    "duplicate_of",
+    "possible_duplicate_of",
+)
+_ITEM_ATTRIBUTE_SET = frozenset(RECEIPT_ITEM_ATTRIBUTES)
+
+
+@dataclass(slots=True)
+class Receipt:
+    """
+    A receipt as stored in the receipts table. from_item and to_item convert from and to
+    the DynamoDB item; numbers are ints except ocr_confidence, which stays a Decimal.
+    Items read with a projection leave the other fields None. Attributes without a field
+    are kept in extra, so converting back does not drop them.
+    """
+
+    receipt_username: Optional[str]
+    receipt_id: str
+    receipt_filename: Optional[str] = None
+    receipt_status: Optional[str] = None
+    receipt_upload_datetime: Optional[str] = None
+    receipt_size: Optional[int] = None
+    receipt_date: Optional[str] = None
+    receipt_summary: Optional[ReceiptSummary] = None
+    version: int = 0
+    receipt_s3_path: Optional[str] = None
+    receipt_optimized_s3_path: Optional[str] = None
+    receipt_optimized_size: Optional[int] = None
+    textract_data: Optional[Dict[str, Any]] = None
+    textract_s3_path: Optional[str] = None
+    ocr_status: Optional[str] = None
+    ocr_engine: Optional[str] = None
+    ocr_confidence: Optional[Decimal] = None
+    ocr_pages: Optional[int] = None
+    textract_job_id: Optional[str] = None
+    receipt_period: Optional[str] = None
+    receipt_date_key: Optional[str] = None
+    item_size: Optional[int] = None
+    content_sha256: Optional[str] = None
+    image_hash: Optional[str] = None
+    ocr_fingerprint: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    possible_duplicate_of: Optional[str] = None
+    extra: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def from_item(cls, item: Dict[str, Any]) -> "Receipt":
+        get = item.get
+        receipt = cls(
+            _intern(get("receipt_username")),
+            get("receipt_id"),
+            get("receipt_filename"),
+            _intern(get("receipt_status")),
+            get("receipt_upload_datetime"),
+            _int(get("receipt_size")),
+            get("receipt_date"),
+            ReceiptSummary.from_item(get("receipt_summary")),
+            int(get("version") or 0),
+            get("receipt_s3_path"),
+            get("receipt_optimized_s3_path"),
+            _int(get("receipt_optimized_size")),
+            get("textract_data"),
+            get("textract_s3_path"),
+            _intern(get("ocr_status")),
+            _intern(get("ocr_engine")),
+            get("ocr_confidence"),
+            _int(get("ocr_pages")),
+            get("textract_job_id"),
+            get("receipt_period"),
+            get("receipt_date_key"),
+            _int(get("item_size")),
+            get("content_sha256"),
+            get("image_hash"),
+            get("ocr_fingerprint"),
+            get("duplicate_of"),
+            get("possible_duplicate_of"),
+        )
+        if not item.keys() <= _ITEM_ATTRIBUTE_SET:
+            receipt.extra = {name: value for name, value in item.items() if name not in _ITEM_ATTRIBUTE_SET}
+        return receipt
+
+    def to_item(self) -> Dict[str, Any]:
+        """The DynamoDB item, without the attributes that are None."""
+        item = {name: getattr(self, name) for name in RECEIPT_ITEM_ATTRIBUTES}
+        if self.receipt_summary is not None:
+            item["receipt_summary"] = self.receipt_summary.to_item()
+        item = {name: value for name, value in item.items() if value is not None}
+        item.update(self.extra or {})
+        return item
+
+    @property
+    def total(self) -> Decimal:
+        if self.receipt_summary is None or self.receipt_summary.total is None:
+            return Decimal(0)
+        return self.receipt_summary.total
+
+    @property
+    def s3_keys(self) -> List[str]:
+        """The receipt's S3 objects: the original upload, the OCR copy and offloaded OCR data."""
+        return [key for key in (self.receipt_s3_path, self.receipt_optimized_s3_path, self.textract_s3_path) if key]
+
+    def sort_key(self):
+        """Newest receipt date first, by upload time within a day (with reverse=True)."""
+        return (self.receipt_date or "", self.receipt_upload_datetime or "")
+
+    def list_row(self) -> Dict[str, Any]:
+        """The /receipts/view row, with the attributes of RECEIPT_LIST_ATTRIBUTES the item has."""
+        row = {
+            "receipt_id": self.receipt_id,
+            "receipt_filename": self.receipt_filename,
+            "receipt_status": self.receipt_status,
+            "receipt_upload_datetime": self.receipt_upload_datetime,
+            "receipt_size": self.receipt_size,
+            "receipt_date": self.receipt_date,
+            "receipt_summary": self.receipt_summary.to_item() if self.receipt_summary is not None else None,
+            "duplicate_of": self.duplicate_of,
+            "possible_duplicate_of": self.possible_duplicate_of,
+        }
+        row = {name: value for name, value in row.items() if value is not None}
+        row["version"] = self.version
+        return row
@@ -0,0 +1,211 @@
+"""
+OCR engines for receipt uploads. Every engine returns an AnalyzeExpense-shaped
+response, so parse_textract_expense and parse_textract_expense_fields work on
+any of them.
+
+    textract     Amazon Textract AnalyzeExpense (paid, network); local if Textract is not configured
+    local        Tesseract on the server CPU, in the process pool; never calls Textract
+    local_first  local, falling back to Textract when confidence is low or no total is found
+"""
+
+import asyncio
+import io
+import re
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from src.config import OCR_ENGINE_POLICY, OCR_LOCAL_MIN_CONFIDENCE, receipt_bucket, receipt_textract
+from src.preprocessing import get_executor
+from src.utils import TOTAL_LABELS, normalize_label
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+OCR_POLICIES = ("textract", "local", "local_first")
+
+AMOUNT_PATTERN = re.compile(r"^(?P<label>.*?)[\s:.]*(?:RM|\$)?\s*(?P<amount>-?\d{1,3}(?:,\d{3})*\.\d{2}|-?\d+\.\d{2})\s*$", re.IGNORECASE)
+DATE_PATTERN = re.compile(r"\b(\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}-\d{2}-\d{2})\b")
+
+
+def _field(field_type: str, label: str, value: str, confidence: float) -> dict:
+    return {
+        "Type": {"Text": field_type, "Confidence": confidence},
+        "LabelDetection": {"Text": label, "Confidence": confidence},
+        "ValueDetection": {"Text": value, "Confidence": confidence},
+        "PageNumber": 1,
+    }
+
+
+def _amount_type(label: str) -> str:
+    normalized = normalize_label(label)
+    if normalized in TOTAL_LABELS:
+        return "TOTAL"
+    if normalized == "SUBTOTAL":
+        return "SUBTOTAL"
+    if any(tax in normalized for tax in ("TAX", "SST", "GST")):
+        return "TAX"
+    return "OTHER"
+
+
+def expense_response_from_lines(lines: List[Tuple[str, float]]) -> dict:
+    """
+    Turn OCR'd text lines with their confidence (0-100) into AnalyzeExpense-style summary
+    fields: "label ... amount" and "label: value" lines become fields, the first date is
+    the receipt date and the first line with text is taken as the vendor.
+    """
+    fields = []
+    seen_types = set()
+
+    def add(field_type: str, label: str, value: str, confidence: float):
+        if field_type != "OTHER":
+            if field_type in seen_types:
+                field_type = "OTHER"
+            seen_types.add(field_type)
+        fields.append(_field(field_type, label, value, confidence))
+
+    for text, confidence in lines:
+        text = text.strip()
+        if not text:
+            continue
+        if "VENDOR_NAME" not in seen_types and re.search(r"[A-Za-z]{3}", text) and not AMOUNT_PATTERN.match(text):
+            add("VENDOR_NAME", "Vendor", text, confidence)
+            continue
+
+        date_match = DATE_PATTERN.search(text)
+        if date_match and "INVOICE_RECEIPT_DATE" not in seen_types:
+            add("INVOICE_RECEIPT_DATE", "Date", date_match.group(1), confidence)
+            continue
+
+        amount_match = AMOUNT_PATTERN.match(text)
+        if amount_match and amount_match.group("label").strip():
+            label = amount_match.group("label").strip()
+            add(_amount_type(label), label, amount_match.group("amount"), confidence)
+        elif ":" in text:
+            label, value = (part.strip() for part in text.split(":", 1))
+            if label and value:
+                add("OTHER", label, value, confidence)
+
+    return {"DocumentMetadata": {"Pages": 1}, "ExpenseDocuments": [{"ExpenseIndex": 1, "SummaryFields": fields, "LineItemGroups": []}]}
+
+
+def tesseract_expense_analysis(data: bytes) -> dict:
+    """Run Tesseract over an image and build an AnalyzeExpense-style response. Runs in a worker process."""
+    with Image.open(io.BytesIO(data)) as image:
+        words = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+
+    lines = {}
+    for index, word in enumerate(words["text"]):
+        confidence = float(words["conf"][index])
+        if not word.strip() or confidence < 0:
+            continue
+        key = (words["block_num"][index], words["par_num"][index], words["line_num"][index])
+        lines.setdefault(key, []).append((word, confidence))
+
+    return expense_response_from_lines([(" ".join(w for w, _ in line), sum(c for _, c in line) / len(line)) for _, line in sorted(lines.items())])
+
+
+def expense_confidence(response: dict) -> float:
+    """Mean value confidence of the summary fields, 0 when nothing was found."""
+    confidences = [field.get("ValueDetection", {}).get("Confidence", 0.0) for document in response.get("ExpenseDocuments", []) for field in document.get("SummaryFields", [])]
+    return sum(confidences) / len(confidences) if confidences else 0.0
+
+
+def has_total(response: dict) -> bool:
+    return any(field.get("Type", {}).get("Text") == "TOTAL" for document in response.get("ExpenseDocuments", []) for field in document.get("SummaryFields", []))
+
+
+class OcrEngine(ABC):
+    """An OCR engine producing AnalyzeExpense-shaped responses; name is its OCR_POLICIES name."""
+
+    name = ""
+
+    @abstractmethod
+    def available(self) -> bool:
+        """Whether the engine can be used in this process."""
+
+    @abstractmethod
+    async def analyze(self, data: bytes, s3_key: str) -> dict:
+        """OCR an upload, given as bytes and as the S3 key it is stored under."""
+
+
+class TextractEngine(OcrEngine):
+    name = "textract"
+
+    def available(self) -> bool:
+        return receipt_textract is not None
+
+    async def analyze(self, data: bytes, s3_key: str) -> dict:
+        return await run_in_threadpool(receipt_textract.analyze_expense, Document={"S3Object": {"Bucket": receipt_bucket.name, "Name": s3_key}})
+
+
+class TesseractEngine(OcrEngine):
+    name = "local"
+
+    def __init__(self):
+        self._available: Optional[bool] = None
+
+    def available(self) -> bool:
+        # Checking runs `tesseract --version`; the binary does not come or go while the process runs
+        if self._available is None:
+            self._available = self._find_tesseract()
+        return self._available
+
+    def _find_tesseract(self) -> bool:
+        if pytesseract is None:
+            return False
+        try:
+            pytesseract.get_tesseract_version()
+            return True
+        except Exception:
+            return False
+
+    async def analyze(self, data: bytes, s3_key: str) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), tesseract_expense_analysis, data)
+
+
+textract_engine = TextractEngine()
+local_engine = TesseractEngine()
+
+
+def select_engines(policy: Optional[str] = None) -> List[OcrEngine]:
+    """
+    The available engines for a policy (OCR_ENGINE_POLICY by default), in the order to
+    try them. Except under the local policy, an unavailable engine falls back to the other
+    one. Raises 400 for an unknown policy and 503 when no engine is available, so uploads
+    can check before storing anything.
+    """
+    policy = policy or OCR_ENGINE_POLICY
+    if policy not in OCR_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Unknown OCR engine: {policy}")
+
+    if policy == "textract":
+        engines = [textract_engine, local_engine]
+    elif policy == "local":
+        engines = [local_engine]
+    else:
+        engines = [local_engine, textract_engine]
+    engines = [engine for engine in engines if engine.available()]
+    if not engines:
+        raise HTTPException(status_code=503, detail="No OCR engine is available")
+    return engines
+
+
+async def run_ocr(data: bytes, s3_key: str, policy: Optional[str] = None) -> Tuple[dict, str]:
+    """
+    Extract expense fields from an uploaded image with the engines select_engines picks
+    for the policy. Returns (AnalyzeExpense-style response, name of the engine that produced it).
+    """
+    policy = policy or OCR_ENGINE_POLICY
+    engines = select_engines(policy)
+    response = await engines[0].analyze(data, s3_key)
+    if policy == "local_first" and engines[0] is local_engine and len(engines) > 1:
+        if expense_confidence(response) < OCR_LOCAL_MIN_CONFIDENCE or not has_total(response):
+            return await textract_engine.analyze(data, s3_key), textract_engine.name
+    return response, engines[0].name
@@ -0,0 +1,80 @@
+import asyncio
+import io
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+
+from src.config import IMAGE_JPEG_QUALITY, IMAGE_MAX_DIMENSION, IMAGE_PREPROCESS_WORKERS
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+_executor = None
+
+
+class ImageTooLargeError(Exception):
+    """An upload that decodes to more pixels than Pillow's decompression bomb limit allows."""
+
+
+def preprocess_image(data: bytes, max_dimension: int = IMAGE_MAX_DIMENSION, quality: int = IMAGE_JPEG_QUALITY) -> Optional[Tuple[bytes, str]]:
+    """
+    Prepare a receipt photo for OCR: rotate it upright from its EXIF orientation,
+    downscale so the longest side is at most max_dimension, convert to grayscale and
+    re-encode as JPEG without metadata.
+    Returns (image bytes, content type), or None when the upload is not an image
+    Pillow can read (e.g. a PDF), Pillow is not installed, or nothing would be saved.
+    Raises ImageTooLargeError for images over Pillow's decompression bomb limit.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("L")
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+            output = io.BytesIO()
+            # A freshly converted image carries no EXIF/ICC data, so none is written
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        print(f"Skipping image preprocessing: {e}")
+        return None
+
+    optimized = output.getvalue()
+    if len(optimized) >= len(data):
+        return None
+    return optimized, "image/jpeg"
+
+
+def get_executor() -> Executor:
+    """
+    The pool for CPU-bound image work: worker processes, or threads where processes cannot
+    be started (AWS Lambda has no /dev/shm for the pool's semaphores).
+    """
+    global _executor
+    if _executor is None:
+        try:
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+        except (OSError, NotImplementedError, ImportError) as e:
+            print(f"Process pool unavailable, using threads for image work: {e}")
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+    return _executor
+
+
+async def run_image_work(function, data: bytes):
+    """Run an image function in the pool; 413 when the image is over the decompression bomb limit."""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_executor(), function, data)
+    except ImageTooLargeError:
+        raise HTTPException(status_code=413, detail="Image dimensions are too large")
+
+
+async def preprocess_upload(data: bytes) -> Optional[Tuple[bytes, str]]:
+    """Run preprocess_image in the pool so decoding large photos does not block the event loop."""
+    return await run_image_work(preprocess_image, data)
@@ -0,0 +1,352 @@
+"""
+Replay traffic captured with TRAFFIC_CAPTURE_PATH (see src.capture) against the app in
+process and report latency per route, so two builds can be compared offline.
+
+    python -m src.replay capture.jsonl [--speed 2] [--concurrency 64] [--aws-latency-ms 5]
+                                       [--output report.json] [--compare baseline.json]
+
+The app runs on the src.local_aws stand-ins (configured AWS credentials are ignored) and
+requests go through httpx's ASGITransport at their captured offsets divided by --speed;
+--speed 0 sends them as fast as --concurrency allows. Before the first request the
+stand-ins are seeded with --receipts-per-user receipts for each captured user bucket, and
+every pseudonym in a request becomes one of that user's receipt IDs, so requests for one
+receipt in the capture are requests for one seeded receipt. Uploads are noise images (or
+PDFs) of the captured size. --aws-latency-ms adds a delay to every DynamoDB and S3 call,
+so a change in how many calls a route makes shows in its latency.
+
+Authentication is replaced by a dependency override. /auth routes (which call Cognito),
+event streams and requests that matched no route are skipped, and If-Match headers are
+dropped, since seeded receipts are at other versions than the captured ones.
+
+To compare builds, replay one capture on each: save the first report with --output and
+pass it to the second run with --compare for the p50, p95 and AWS call deltas per route.
+"""
+
+import argparse
+import asyncio
+import importlib
+import io
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+import httpx
+from fastapi import HTTPException, Request
+
+from src.capture import PSEUDONYM_PATTERN, counting_aws_calls
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+REPLAY_USER_HEADER = "x-replay-user"
+SKIPPED_ROUTE_PREFIXES = ("/auth",)
+IMAGE_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".webp": "WEBP", ".gif": "GIF"}
+VENDORS = ["AEON BIG", "GUARDIAN PHARMACY", "POPULAR BOOKSTORE", "SHELL TTDI", "KLINIK MEDIVIRON", "MR DIY"]
+
+
+def load_capture(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as capture:
+        records = [json.loads(line) for line in capture if line.strip()]
+    return sorted(records, key=lambda record: record["ts"])
+
+
+def skip_reason(record: dict) -> Optional[str]:
+    if record.get("route") is None:
+        return "no route"
+    if record["route"].startswith(SKIPPED_ROUTE_PREFIXES):
+        return "auth"
+    if (record.get("response_type") or "").startswith("text/event-stream"):
+        return "event stream"
+    if (record.get("content_type") or "").endswith("json") and record.get("request_bytes") and not record.get("body"):
+        return "body not captured"
+    return None
+
+
+def replay_username(bucket: Optional[int]) -> Optional[str]:
+    return None if bucket is None else f"replay-user-{bucket}"
+
+
+def route_key(record: dict) -> str:
+    return f"{record['method']} {record['route']}"
+
+
+def resolve(value, receipt_ids: List[str]):
+    """Replace the pseudonyms in a captured value with the user's seeded receipt IDs."""
+    if isinstance(value, dict):
+        return {name: resolve(item, receipt_ids) for name, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item, receipt_ids) for item in value]
+    if isinstance(value, str) and receipt_ids and PSEUDONYM_PATTERN.match(value):
+        return receipt_ids[int(value[1:], 16) % len(receipt_ids)]
+    return value
+
+
+def synthetic_upload(size: int, extension: str, seed: int) -> bytes:
+    """A file of about size bytes: a noise image Pillow can decode, or a PDF-headed blob."""
+    rng = random.Random(seed)
+    image_format = IMAGE_FORMATS.get(extension)
+    if image_format is None or Image is None:
+        header = b"%PDF-1.4\n" if extension == ".pdf" else b""
+        return header + rng.randbytes(max(0, size - len(header)))
+    # Grayscale noise compresses to about a byte per pixel
+    side = max(16, int(math.sqrt(size)))
+    image = Image.frombytes("L", (side, side), rng.randbytes(side * side))
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+def build_request(record: dict, receipt_ids: List[str], index: int) -> dict:
+    """httpx.AsyncClient.request arguments for a captured request."""
+    path_params = resolve(record.get("path_params") or {}, receipt_ids)
+    headers = dict(record.get("headers") or {})
+    username = replay_username(record.get("user"))
+    if username:
+        headers[REPLAY_USER_HEADER] = username
+    request = {
+        "method": record["method"],
+        "url": record["route"].format(**{name: quote(str(value), safe="") for name, value in path_params.items()}),
+        "params": [tuple(pair) for pair in resolve(record.get("query") or [], receipt_ids)],
+        "headers": headers,
+    }
+
+    body = record.get("body") or {}
+    if "json" in body:
+        request["content"] = json.dumps(resolve(body["json"], receipt_ids)).encode("utf-8")
+        headers["content-type"] = record["content_type"]
+    elif "upload" in body:
+        extension = body["upload"].get("extension") or ".jpg"
+        content_type = body["upload"].get("content_type") or "application/octet-stream"
+        request["files"] = {"file": (f"replay-{index}{extension}", synthetic_upload(record.get("request_bytes", 0), extension, index), content_type)}
+    return request
+
+
+async def replay_user(request: Request) -> dict:
+    """Stands in for get_current_user and get_admin_user: the user named by the replay header."""
+    from src.config import ADMIN_GROUP
+
+    username = request.headers.get(REPLAY_USER_HEADER)
+    if not username:
+        raise HTTPException(status_code=401, detail="Not authenticated. Missing Access Token.")
+    request.state.username = username
+    return {"username": username, "cognito:groups": [ADMIN_GROUP]}
+
+
+def load_app(app_path: str, aws_latency: float = 0.0):
+    """Import the app (module:attribute) on the local AWS stand-ins, with authentication replaced."""
+    os.environ["LOCAL_AWS"] = "1"
+    # Empty rather than unset, so load_dotenv does not fill them in from .env
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "TRAFFIC_CAPTURE_PATH"):
+        os.environ[name] = ""
+    module_name, _, attribute = app_path.partition(":")
+    app = getattr(importlib.import_module(module_name), attribute or "app")
+
+    from src import config
+    from src.local_aws import FakeBucket, FakeTable
+
+    if not isinstance(config.receipt_db, FakeTable) or not isinstance(config.receipt_bucket, FakeBucket):
+        raise SystemExit("The app was configured before LOCAL_AWS was set; run the replay in its own process")
+    for stand_in in (config.receipt_db, config.blacklist_token_db, config.receipt_bucket):
+        stand_in.latency = aws_latency
+    app.dependency_overrides[config.get_current_user] = replay_user
+    app.dependency_overrides[config.get_admin_user] = replay_user
+    return app
+
+
+def seed_receipts(usernames: List[str], per_user: int, seed: int = 1) -> Dict[str, List[str]]:
+    """Write per_user receipts with images and OCR data for each user to the stand-ins. Returns their IDs by user."""
+    from src.config import receipt_bucket, receipt_db
+    from src.models.receipts import Receipt
+    from src.ocr import expense_response_from_lines
+    from src.utils import parse_textract_expense, parse_textract_expense_fields, receipt_ocr_attributes
+
+    rng = random.Random(seed)
+    image = synthetic_upload(20_000, ".jpg", seed)
+    receipt_ids = {}
+    for username in usernames:
+        receipt_ids[username] = []
+        for index in range(per_user):
+            receipt_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            receipt_date = f"{rng.choice([2023, 2024, 2025])}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            lines = [(rng.choice(VENDORS), 99.0), (f"Date: {receipt_date[8:]}/{receipt_date[5:7]}/{receipt_date[:4]}", 98.0), (f"TOTAL {rng.uniform(5, 500):.2f}", 99.0)]
+            response = expense_response_from_lines(lines)
+            ocr_attributes, _ = receipt_ocr_attributes(username, receipt_id, parse_textract_expense(response), parse_textract_expense_fields(response), fallback_date=receipt_date)
+
+            s3_key = f"receipts/{username}/receipt_{index}.jpg"
+            receipt_bucket.put_object(Key=s3_key, Body=image, ContentType="image/jpeg")
+            receipt = Receipt(
+                username,
+                receipt_id,
+                receipt_filename=f"receipt_{index}.jpg",
+                receipt_status=rng.choice(["pending", "approved", "rejected"]),
+                receipt_upload_datetime=f"{receipt_date}T12:00:00",
+                receipt_size=len(image),
+                receipt_s3_path=s3_key,
+                version=1,
+                ocr_status="completed",
+                ocr_engine="textract",
+            )
+            receipt_db.put_item(Item={**receipt.to_item(), **ocr_attributes})
+            receipt_ids[username].append(receipt_id)
+    return receipt_ids
+
+
+async def replay(app, records: List[dict], receipt_ids: Dict[str, List[str]], speed: float = 1.0, concurrency: int = 64) -> List[dict]:
+    """Send the records to the app at their captured offsets divided by speed. Returns one result per record."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    first_ts = records[0]["ts"] if records else 0.0
+    started = loop.time()
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://replay") as client:
+
+        async def send(index: int, record: dict) -> dict:
+            if speed > 0:
+                await asyncio.sleep(max(0.0, started + (record["ts"] - first_ts) / speed - loop.time()))
+            request = build_request(record, receipt_ids.get(replay_username(record.get("user")), []), index)
+            async with semaphore:
+                with counting_aws_calls() as aws_calls:
+                    request_started = time.perf_counter()
+                    response = await client.request(**request)
+                    elapsed = time.perf_counter() - request_started
+            return {
+                "route": route_key(record),
+                "status": response.status_code,
+                "captured_status": record.get("status"),
+                "ms": elapsed * 1000,
+                "captured_ms": record.get("duration_ms"),
+                "aws_calls": sum(aws_calls.values()),
+                "captured_aws_calls": sum((record.get("aws_calls") or {}).values()),
+            }
+
+        return await asyncio.gather(*(send(index, record) for index, record in enumerate(records)))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def route_stats(results: List[dict]) -> dict:
+    latencies = sorted(result["ms"] for result in results)
+    captured = sorted(result["captured_ms"] for result in results if result["captured_ms"] is not None)
+    return {
+        "requests": len(results),
+        "errors": sum(result["status"] >= 500 for result in results),
+        "status_changed": sum(result["status"] != result["captured_status"] for result in results),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "captured_p50_ms": round(percentile(captured, 0.50), 3) if captured else None,
+        "aws_calls": round(statistics.fmean(result["aws_calls"] for result in results), 2),
+        "captured_aws_calls": round(statistics.fmean(result["captured_aws_calls"] for result in results), 2),
+    }
+
+
+def summarize(results: List[dict]) -> dict:
+    by_route = defaultdict(list)
+    for result in results:
+        by_route[result["route"]].append(result)
+    return {"all": route_stats(results), "routes": {route: route_stats(rows) for route, rows in sorted(by_route.items())}}
+
+
+def build_label() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(report: dict):
+    print(f"{report['label']}: {report['all']['requests']} requests in {report['wall_seconds']:.1f} s at {report['speed']}x")
+    if report["skipped"]:
+        print("skipped: " + ", ".join(f"{count} {reason}" for reason, count in sorted(report["skipped"].items())))
+    print(f"{'route':<48} {'reqs':>6} {'5xx':>5} {'changed':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'captured p50':>12} {'aws/req':>8}")
+    for route, stats in [*report["routes"].items(), ("all", report["all"])]:
+        captured = f"{stats['captured_p50_ms']:.1f}" if stats["captured_p50_ms"] is not None else "-"
+        print(f"{route:<48} {stats['requests']:>6} {stats['errors']:>5} {stats['status_changed']:>7} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {captured:>12} {stats['aws_calls']:>8.2f}")
+
+
+def change(before: float, after: float) -> str:
+    relative = f" ({(after / before - 1) * 100:+.0f}%)" if before else ""
+    return f"{before:.1f} -> {after:.1f}{relative}"
+
+
+def print_comparison(baseline: dict, report: dict):
+    print(f"\n{baseline['label']} -> {report['label']}")
+    print(f"{'route':<48} {'p50 ms':>24} {'p95 ms':>24} {'aws/req':>14}")
+    for route in [*sorted(set(baseline["routes"]) | set(report["routes"])), "all"]:
+        before = baseline["all"] if route == "all" else baseline["routes"].get(route)
+        after = report["all"] if route == "all" else report["routes"].get(route)
+        if before is None or after is None:
+            print(f"{route:<48} only in {report['label'] if before is None else baseline['label']}")
+            continue
+        print(f"{route:<48} {change(before['p50_ms'], after['p50_ms']):>24} {change(before['p95_ms'], after['p95_ms']):>24} {before['aws_calls']:>6.2f} -> {after['aws_calls']:<5.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="JSONL file written by TrafficCaptureMiddleware")
+    parser.add_argument("--speed", type=float, default=1.0, help="Multiple of the captured request rate; 0 sends as fast as --concurrency allows")
+    parser.add_argument("--concurrency", type=int, default=64, help="Most requests in flight at once")
+    parser.add_argument("--receipts-per-user", type=int, default=50, help="Receipts seeded for each captured user bucket")
+    parser.add_argument("--aws-latency-ms", type=float, default=0.0, help="Delay added to every DynamoDB and S3 call")
+    parser.add_argument("--limit", type=int, default=None, help="Replay at most this many requests")
+    parser.add_argument("--app", default="main:app", help="The ASGI app as module:attribute")
+    parser.add_argument("--label", default=None, help="Name of this build in the report (default: the git commit)")
+    parser.add_argument("--output", help="Save the report as JSON")
+    parser.add_argument("--compare", help="A report saved with --output to print the deltas against")
+    args = parser.parse_args()
+
+    skipped = Counter()
+    records = []
+    for record in load_capture(args.capture):
+        reason = skip_reason(record)
+        if reason:
+            skipped[reason] += 1
+        else:
+            records.append(record)
+    records = records[: args.limit] if args.limit else records
+    if not records:
+        raise SystemExit("No replayable requests in the capture")
+
+    app = load_app(args.app, args.aws_latency_ms / 1000)
+    usernames = sorted({replay_username(record["user"]) for record in records if record.get("user") is not None})
+    receipt_ids = seed_receipts(usernames, args.receipts_per_user)
+
+    started = time.perf_counter()
+    results = asyncio.run(replay(app, records, receipt_ids, args.speed, args.concurrency))
+    report = {
+        "label": args.label or build_label(),
+        "capture": args.capture,
+        "speed": args.speed,
+        "concurrency": args.concurrency,
+        "aws_latency_ms": args.aws_latency_ms,
+        "receipts_per_user": args.receipts_per_user,
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "skipped": dict(skipped),
+        **summarize(results),
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline:
+            print_comparison(json.load(baseline), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Response classes for the large receipt payloads (/receipts/view, /receipts/view/{id}).
+
+Handlers return negotiated_response(request, content) instead of a dict, which skips
+FastAPI's jsonable_encoder pass and encodes the DynamoDB items directly: with orjson as
+compact JSON, or as MessagePack for clients sending Accept: application/msgpack when the
+msgpack package is installed. Decimal values are encoded the way FastAPI does, integral
+ones as integers and the rest as floats.
+"""
+
+import json
+from decimal import Decimal
+from typing import Any, Mapping, Optional
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def encode_default(value: Any):
+    """Encode the types DynamoDB items hold that JSON and MessagePack do not know."""
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("utf-8", errors="replace")
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class CompactJSONResponse(JSONResponse):
+    """JSON without whitespace, encoded with orjson (the standard json module without it)."""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, default=encode_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class MessagePackResponse(Response):
+    media_type = "application/msgpack"
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=encode_default, use_bin_type=True)
+
+
+def accepts_msgpack(request: Request) -> bool:
+    if msgpack is None:
+        return False
+    accept = request.headers.get("accept", "")
+    return any(media_type.split(";")[0].strip() in MSGPACK_MEDIA_TYPES for media_type in accept.split(","))
+
+
+def negotiated_response(request: Request, content: Any, status_code: int = 200, headers: Optional[Mapping[str, str]] = None) -> Response:
+    """MessagePack when the client asks for it and it is available, compact JSON otherwise."""
+    response_class = MessagePackResponse if accepts_msgpack(request) else CompactJSONResponse
+    response = response_class(content, status_code=status_code, headers=headers)
+    # The representation depends on Accept, so caches must keep them apart
+    response.headers.append("Vary", "Accept")
+    return response
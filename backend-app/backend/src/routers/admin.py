@@ -0,0 +1,53 @@
+from typing import Optional
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from src import analytics
+from src.config import get_admin_user, receipt_db
+
+admin_router = APIRouter(prefix="/admin")
+
+
+def require_analytics():
+    if not analytics.available():
+        raise HTTPException(status_code=503, detail="Analytics are not installed (pyarrow is missing)")
+
+
+@admin_router.post("/snapshots", dependencies=[Depends(require_analytics)])
+async def create_snapshot(background_tasks: BackgroundTasks, user=Depends(get_admin_user)):
+    """Start an incremental export of the receipts table to the columnar snapshot."""
+    if receipt_db is None:
+        raise HTTPException(status_code=503, detail="Receipt table is not configured")
+    background_tasks.add_task(run_in_threadpool, analytics.export_snapshot)
+    return JSONResponse({"message": "Snapshot export started"}, status_code=202)
+
+
+@admin_router.get("/snapshots", dependencies=[Depends(require_analytics)])
+async def get_snapshot(user=Depends(get_admin_user)):
+    """Describe the current snapshot: when it was exported and the rows per year."""
+    return analytics.read_manifest()
+
+
+@admin_router.get("/analytics/spending", dependencies=[Depends(require_analytics)])
+async def spending(
+    user=Depends(get_admin_user),
+    by: str = Query("month", description="Group by year, month, vendor or category"),
+    years: Optional[str] = Query(None, description="Comma-separated years, e.g. 2023,2024 (default: all)"),
+    username: Optional[str] = Query(None, description="Only this user's receipts"),
+):
+    """Spending and receipt counts across users and years, computed from the latest snapshot."""
+    if by not in analytics.GROUP_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"by must be one of: {', '.join(analytics.GROUP_COLUMNS)}")
+    try:
+        year_list = [int(year) for year in years.split(",") if year.strip()] if years else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="years must be comma-separated integers")
+
+    table = await run_in_threadpool(analytics.load_snapshot)
+    if table is None:
+        raise HTTPException(status_code=404, detail="No snapshot has been exported yet")
+
+    manifest = analytics.read_manifest()
+    return {"by": by, "exported_at": manifest.get("exported_at"), "results": analytics.spending_by(table, by, year_list, username)}
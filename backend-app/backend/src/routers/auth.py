@@ -4,10 +4,10 @@ from fastapi.responses import JSONResponse, RedirectResponse
 from src.config import (
     REDIRECT_URI,
     blacklist_token,
-    generate_new_tokens,
     get_current_user_profile,
-    is_token_blacklisted,
     oauth,
+    refresh_tokens,
+    token_expires_in,
 )
 
 auth_router = APIRouter(prefix="/auth")
@@ -52,17 +52,14 @@ async def refresh_token(request: Request):
     if not refresh_token:
         return JSONResponse({"error": "No refresh token provided"}, status_code=401)
 
-    if await is_token_blacklisted(refresh_token, token_type="refresh"):
-        return JSONResponse({"error": "Refresh token is blacklisted"}, status_code=401)
-
-    new_access_token, new_refresh_token = await generate_new_tokens(refresh_token)
-
-    if not new_access_token:
-        return JSONResponse({"error": "Failed to refresh token"}, status_code=401)
-
-    await blacklist_token(refresh_token, token_type="refresh")
+    new_access_token, new_refresh_token, error = await refresh_tokens(refresh_token)
+    if error:
+        return JSONResponse({"error": error}, status_code=401)
 
     response = JSONResponse({"message": "Token refreshed", "access_token": new_access_token})
+    expires_in = token_expires_in(new_access_token)
+    if expires_in is not None:
+        response.headers["X-Token-Expires-In"] = str(expires_in)
     response.set_cookie("access_token", new_access_token, httponly=True, secure=False)
     response.set_cookie("refresh_token", new_refresh_token, httponly=True, secure=False)
     return response
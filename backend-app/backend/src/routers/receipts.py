@@ -1,178 +1,434 @@
 import io
+import time
 import uuid
 from datetime import datetime
+from decimal import Decimal
+from typing import Optional
 
 from boto3.dynamodb.conditions import Key
-from fastapi import APIRouter, Depends, File, HTTPException, Path, Query, UploadFile
+from botocore.exceptions import ClientError
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Header, HTTPException, Path, Query, Request, Response, UploadFile
 from fastapi.responses import JSONResponse, StreamingResponse
-
-from src.config import get_current_user, receipt_bucket, receipt_db, receipt_textract
-from src.models.receipts import ReceiptStatusUpdate, ReceiptUpdate
-from src.utils import get_unique_filename, parse_textract_expense
+from starlette.concurrency import run_in_threadpool
+
+from src.config import EVENT_KEEPALIVE_SECONDS, get_current_user, is_token_blacklisted, receipt_bucket, receipt_db, request_token
+from src.duplicates import content_hash, duplicate_attributes, duplicate_index, format_image_hash, image_hash_upload, ocr_fingerprint
+from src.events import OCR_COMPLETED, RECEIPT_DELETED, RECEIPT_UPDATED, STATUS_CHANGED, UPLOAD_PROGRESS, format_sse, publish_receipt_event, subscribe_receipt_events
+from src.idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, idempotent_uploads, request_fingerprint
+from src.models.receipts import Receipt, ReceiptBatchDelete, ReceiptBatchStatusUpdate, ReceiptStatusUpdate, ReceiptUpdate
+from src.ocr import OCR_POLICIES, expense_confidence, run_ocr, select_engines, textract_engine
+from src.preprocessing import preprocess_upload
+from src.responses import negotiated_response
+from src.textract import complete_expense_job, is_pdf, start_expense_job, track_expense_job
+from src.utils import (
+    RECEIPT_INLINE_ITEM_MAX,
+    RECEIPT_LIST_ATTRIBUTES,
+    apply_merge_patch,
+    batch_get_receipts,
+    batch_update_status,
+    compile_receipt_patch,
+    conditional_write_error,
+    delete_s3_objects,
+    deserialize_item,
+    get_unique_filename,
+    normalize_receipt_patch,
+    parse_if_match,
+    parse_textract_expense,
+    parse_textract_expense_fields,
+    projection,
+    query_all,
+    query_receipts_by_date,
+    receipt_etag,
+    receipt_ocr_attributes,
+    receipt_textract_data,
+    receipt_write_condition,
+    replace_receipt_ocr,
+)
 
 receipts_router = APIRouter(prefix="/receipts")
 
 
 @receipts_router.post("/upload")
-async def upload_receipts(file: UploadFile = File(...), user=Depends(get_current_user)):
+async def upload_receipts(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    user=Depends(get_current_user),
+    ocr_engine: Optional[str] = Query(None, description="OCR engine policy: textract, local or local_first"),
+    on_duplicate: str = Query("flag", description="flag: store a likely duplicate marked with duplicate_of or possible_duplicate_of; reject: refuse it with 409 before OCR"),
+    idempotency_key: Optional[str] = Header(None, description="Client-chosen key; retries with the same key get the first attempt's response"),
+):
+    """
+    Upload a receipt and extract its text. Uploads that are likely duplicates of one of
+    the user's receipts, by file content or image hash, are detected before OCR and either
+    flagged or rejected; after OCR the vendor/date/total fingerprint is checked as well.
+    An upload of the same file is flagged duplicate_of and left out of total-claims until
+    the flag is cleared. Image and fingerprint matches only set possible_duplicate_of,
+    which does not change totals until the user confirms it.
+    With an Idempotency-Key header a retried upload returns the first attempt's response,
+    waiting for it if it is still in progress, instead of storing and OCRing the file
+    again; reusing a key for a different upload is refused with 422.
+    """
+    if ocr_engine is not None and ocr_engine not in OCR_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Unknown OCR engine: {ocr_engine}")
+    if on_duplicate not in ("flag", "reject"):
+        raise HTTPException(status_code=400, detail="on_duplicate must be flag or reject")
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+
+    file_data = await file.read()
+    content_sha256 = content_hash(file_data)
+    if not idempotency_key or not idempotent_uploads.enabled:
+        return await store_upload(background_tasks, user, file.filename, file_data, content_sha256, ocr_engine, on_duplicate)
+
+    request_hash = request_fingerprint(content_sha256, file.filename, ocr_engine, on_duplicate)
+    return await idempotent_uploads.run(
+        user["username"],
+        idempotency_key,
+        request_hash,
+        lambda: store_upload(background_tasks, user, file.filename, file_data, content_sha256, ocr_engine, on_duplicate),
+    )
+
+
+async def store_upload(
+    background_tasks: BackgroundTasks,
+    user: dict,
+    filename: str,
+    file_data: bytes,
+    content_sha256: str,
+    ocr_engine: Optional[str],
+    on_duplicate: str,
+) -> JSONResponse:
+    """Store, deduplicate and OCR one upload for upload_receipts."""
+    file_size = len(file_data)
+    pdf = is_pdf(file_data)
+
+    # Duplicate checks that need no OCR, so a rejected duplicate costs no Textract call
+    image_hash = None if pdf else await image_hash_upload(file_data)
+    duplicate = duplicate_index.find(user["username"], content_sha256=content_sha256, image_hash=image_hash)
+    if duplicate and on_duplicate == "reject":
+        raise HTTPException(status_code=409, detail={"message": "Likely duplicate of an existing receipt", "duplicate_of": duplicate})
+
+    # Refuse uploads that cannot be OCR'd before storing anything
+    if pdf:
+        # PDFs can span several pages, which only the async Textract API handles
+        if not textract_engine.available() or ocr_engine == "local":
+            raise HTTPException(status_code=503, detail="PDF receipts need Textract, which is not available")
+    else:
+        select_engines(ocr_engine)
+
     # Generate unique filename
-    unique_filename = get_unique_filename(user["username"], file.filename)
+    unique_filename = get_unique_filename(user["username"], filename)
 
     # Use the unique filename for S3 key
     s3_key = f"receipts/{user['username']}/{unique_filename}"
 
-    # Calculate file size
-    file.file.seek(0, 2)  # Move to end of file
-    file_size = file.file.tell()
-    file.file.seek(0)  # Reset to start
-
-    receipt_bucket.upload_fileobj(file.file, s3_key)
-
-    # Call Textract to extract text from the uploaded receipt
-    response = receipt_textract.analyze_expense(Document={"S3Object": {"Bucket": receipt_bucket.name, "Name": s3_key}})
-    extracted_data = parse_textract_expense(response)
+    receipt_id = str(uuid.uuid4())
     upload_datetime = datetime.now().isoformat()
 
-    item = {
-        "receipt_username": user["username"],
-        "receipt_id": str(uuid.uuid4()),
-        "receipt_s3_path": s3_key,
-        "receipt_filename": unique_filename,  # Store the unique filename
-        "receipt_status": "pending",
-        "receipt_upload_datetime": upload_datetime,
+    # Keep the original as uploaded
+    receipt_bucket.upload_fileobj(io.BytesIO(file_data), s3_key)
+    publish_receipt_event(user["username"], UPLOAD_PROGRESS, receipt_id, stage="stored", receipt_filename=unique_filename)
+
+    receipt = Receipt(
+        user["username"],
+        receipt_id,
+        receipt_s3_path=s3_key,
+        receipt_filename=unique_filename,  # Store the unique filename
+        receipt_status="pending",
+        receipt_upload_datetime=upload_datetime,
+        receipt_size=file_size,
+        version=1,
+        content_sha256=content_sha256,
+        image_hash=format_image_hash(image_hash) if image_hash is not None else None,
+    )
+    result = {
+        "receipt_id": receipt_id,
+        "s3_key": s3_key,
         "receipt_size": file_size,
-        "textract_data": extracted_data,
+        "original_filename": filename,
+        "stored_filename": unique_filename,
+        "filename_changed": filename != unique_filename,
     }
-    receipt_db.put_item(Item=item)
-
-    return JSONResponse(
-        {
-            "message": "File uploaded and processed",
-            "s3_key": s3_key,
-            "extracted": extracted_data,
-            "receipt_size": file_size,
-            "original_filename": file.filename,
-            "stored_filename": unique_filename,
-            "filename_changed": file.filename != unique_filename,
-        }
+
+    if pdf:
+        # The OCR data is filled in when the job finishes, see track_expense_job
+        try:
+            job_id = start_expense_job(s3_key)
+        except Exception:
+            delete_s3_objects([s3_key])
+            raise
+        ocr_attributes, _ = receipt_ocr_attributes(user["username"], receipt_id, {}, fallback_date=upload_datetime[:10])
+        receipt.ocr_status, receipt.ocr_engine, receipt.textract_job_id = "processing", textract_engine.name, job_id
+        receipt.duplicate_of, receipt.possible_duplicate_of = duplicate_attributes(duplicate)
+        receipt_db.put_item(Item={**receipt.to_item(), **ocr_attributes})
+        duplicate_index.add(user["username"], receipt_id, content_sha256)
+        publish_receipt_event(user["username"], UPLOAD_PROGRESS, receipt_id, stage="ocr_started", ocr_status="processing")
+
+        background_tasks.add_task(track_expense_job, user["username"], receipt_id, job_id)
+        return JSONResponse(
+            {"message": "File uploaded, text extraction in progress", "ocr_status": "processing", "extracted": {}, **duplicate_result(duplicate), **result},
+            status_code=202,
+        )
+
+    # Store an upright, downscaled grayscale copy for OCR under its own key
+    optimized_s3_key = None
+    try:
+        optimized = await preprocess_upload(file_data)
+        if optimized:
+            optimized_data, optimized_content_type = optimized
+            optimized_s3_key = f"optimized/{user['username']}/{receipt_id}.jpg"
+            receipt_bucket.put_object(Key=optimized_s3_key, Body=optimized_data, ContentType=optimized_content_type)
+            receipt.receipt_optimized_s3_path = optimized_s3_key
+            receipt.receipt_optimized_size = len(optimized_data)
+            publish_receipt_event(user["username"], UPLOAD_PROGRESS, receipt_id, stage="preprocessed")
+
+        # Extract text from the uploaded receipt with the engine(s) the policy picks
+        response, used_engine = await run_ocr(optimized_data if optimized_s3_key else file_data, optimized_s3_key or s3_key, ocr_engine)
+    except Exception:
+        # No receipt refers to the stored copies yet
+        delete_s3_objects(receipt.s3_keys)
+        raise
+    extracted_data = parse_textract_expense(response)
+
+    # Summary stays in the item; large OCR maps go to S3
+    ocr_attributes, _ = receipt_ocr_attributes(
+        user["username"],
+        receipt_id,
+        extracted_data,
+        parse_textract_expense_fields(response),
+        fallback_date=upload_datetime[:10],
+    )
+    receipt.ocr_status, receipt.ocr_engine, receipt.ocr_confidence = "completed", used_engine, Decimal(str(round(expense_confidence(response), 2)))
+
+    # A different photo of the same paper receipt reads as the same vendor, date and total
+    receipt.ocr_fingerprint = ocr_fingerprint(ocr_attributes["receipt_summary"])
+    if not duplicate and receipt.ocr_fingerprint:
+        duplicate = duplicate_index.find(user["username"], fingerprint=receipt.ocr_fingerprint)
+    receipt.duplicate_of, receipt.possible_duplicate_of = duplicate_attributes(duplicate)
+
+    receipt_db.put_item(Item={**receipt.to_item(), **ocr_attributes})
+    duplicate_index.add(user["username"], receipt_id, content_sha256, image_hash, receipt.ocr_fingerprint)
+    publish_receipt_event(user["username"], OCR_COMPLETED, receipt_id, ocr_status="completed", ocr_engine=used_engine, version=1)
+
+    return JSONResponse({"message": "File uploaded and processed", "ocr_status": "completed", "ocr_engine": used_engine, "extracted": extracted_data, **duplicate_result(duplicate), **result})
+
+
+def duplicate_result(duplicate: Optional[dict]) -> dict:
+    """The upload response's duplicate_of and possible_duplicate_of: the DuplicateIndex match, or None."""
+    certain = duplicate is not None and duplicate["match"] == "content"
+    return {"duplicate_of": duplicate if certain else None, "possible_duplicate_of": duplicate if duplicate is not None and not certain else None}
+
+
+@receipts_router.get("/ocr/{receipt_id}")
+async def get_ocr_status(
+    user=Depends(get_current_user),
+    receipt_id: str = Path(..., description="The ID of the receipt to check"),
+):
+    """
+    Report a receipt's text extraction status. For a PDF still processing, checks its
+    Textract job once and stores the merged result if it has finished.
+    """
+    receipt = read_ocr_state(user["username"], receipt_id)
+    ocr_status = receipt.ocr_status or "completed"
+    if ocr_status == "processing":
+        try:
+            ocr_status = await run_in_threadpool(complete_expense_job, user["username"], receipt_id, receipt.textract_job_id, receipt.version)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                print(f"Error collecting Textract job: {e}")
+                raise HTTPException(status_code=500, detail="Error checking text extraction status")
+            # Collected concurrently by the background task; report what is stored now
+            receipt = read_ocr_state(user["username"], receipt_id, consistent=True)
+            ocr_status = receipt.ocr_status or "completed"
+
+    return {"receipt_id": receipt_id, "ocr_status": ocr_status, "ocr_pages": receipt.ocr_pages}
+
+
+def read_ocr_state(username: str, receipt_id: str, consistent: bool = False) -> Receipt:
+    """The receipt's OCR status, Textract job, page count and version; 404 when it does not exist."""
+    projection_expression, projection_names = projection(["ocr_status", "textract_job_id", "ocr_pages", "version"])
+    result = receipt_db.get_item(
+        Key={"receipt_username": username, "receipt_id": receipt_id},
+        ProjectionExpression=projection_expression,
+        ExpressionAttributeNames=projection_names,
+        ConsistentRead=consistent,
     )
+    if not result.get("Item"):
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    return Receipt.from_item(result["Item"])
+
+
+@receipts_router.get("/events")
+async def receipt_events(request: Request, user=Depends(get_current_user)):
+    """
+    Stream the user's receipt events (upload progress, OCR completion, status changes,
+    updates and deletes) as Server-Sent Events. Use with EventSource(url, { withCredentials: true })
+    so the access token cookie is sent. Events missed while disconnected are not replayed;
+    re-fetch /receipts/view after reconnecting. The token is checked again every
+    EVENT_KEEPALIVE_SECONDS and the stream ends once it has expired or been logged out;
+    the browser then reconnects with its current token or gets a 401.
+    """
+    token = request_token(request)
+
+    async def session_valid() -> bool:
+        if user.get("exp") is not None and user["exp"] <= time.time():
+            return False
+        return not (token and await is_token_blacklisted(token))
+
+    async def stream():
+        async with subscribe_receipt_events(user["username"]) as subscription:
+            yield "retry: 5000\n\n"
+            next_check = time.monotonic() + EVENT_KEEPALIVE_SECONDS
+            while not await request.is_disconnected():
+                event = await subscription.get(timeout=EVENT_KEEPALIVE_SECONDS)
+                if time.monotonic() >= next_check:
+                    if not await session_valid():
+                        return
+                    next_check = time.monotonic() + EVENT_KEEPALIVE_SECONDS
+                # A comment line keeps proxies from closing an idle connection
+                yield format_sse(event) if event else ": keep-alive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @receipts_router.get("/view")
 async def view_receipts(
+    request: Request,
     user=Depends(get_current_user),
     year: int = Query(None, description="Year to filter receipts (e.g., 2024)"),
     month: int = Query(None, description="Month to filter receipts (1-12)"),
     day: int = Query(None, description="Day to filter receipts (1-31)"),
 ):
-    # Build the date prefix for filtering
-    date_prefix = None
-    if year and month and day:
-        date_prefix = f"{year:04d}-{month:02d}-{day:02d}"
-    elif year and month:
-        date_prefix = f"{year:04d}-{month:02d}"
-    elif year:
-        date_prefix = f"{year:04d}"
-
-    key_expr = Key("receipt_username").eq(user["username"])
-    if date_prefix:
-        key_expr = key_expr & Key("receipt_upload_datetime").begins_with(date_prefix)
+    if (month and not year) or (day and not month):
+        raise HTTPException(status_code=400, detail="month requires year and day requires month")
+
+    if year:
+        # Tight range query on the receipt date index
+        receipts = [Receipt.from_item(item) for item in query_receipts_by_date(user["username"], year, month, day, attributes=RECEIPT_LIST_ATTRIBUTES)]
+    else:
+        # List rows only need the metadata and summary, not the OCR data
+        projection_expression, projection_names = projection(RECEIPT_LIST_ATTRIBUTES)
+        items = query_all(
+            KeyConditionExpression=Key("receipt_username").eq(user["username"]),
+            ProjectionExpression=projection_expression,
+            ExpressionAttributeNames=projection_names,
+        )
+        receipts = [Receipt.from_item(item) for item in items]
+        del items
 
-    response = receipt_db.query(KeyConditionExpression=key_expr)
-    items = response.get("Items", [])
-    items.sort(key=lambda x: str(x.get("receipt_upload_datetime", "")), reverse=True)
-    return items
+    receipts.sort(key=Receipt.sort_key, reverse=True)
+    return negotiated_response(request, [receipt.list_row() for receipt in receipts])
 
 
 @receipts_router.post("/status")
-async def update_status(data: ReceiptStatusUpdate, user=Depends(get_current_user)):
-    response = receipt_db.update_item(
-        Key={"receipt_username": user["username"], "receipt_id": data.receipt_id},
-        UpdateExpression="SET receipt_status = :new_status",
-        ExpressionAttributeValues={":new_status": data.new_status},
-        ReturnValues="UPDATED_NEW",
-    )
-    return {"message": "Status updated", "attributes": response.get("Attributes", {})}
-
-
-@receipts_router.get("/total-claims")
-async def total_claims(
+async def update_status(
+    data: ReceiptStatusUpdate,
+    response: Response,
     user=Depends(get_current_user),
-    year: int = Query(..., description="Year to filter receipts (e.g., 2025)"),
+    if_match: Optional[str] = Header(None),
 ):
-    # Scan all receipts for the user
-    response = receipt_db.scan(
-        FilterExpression="receipt_username = :username",
-        ExpressionAttributeValues={":username": user["username"]},
-    )
-    items = response.get("Items", [])
-
-    total = 0.0
-
-    normalized_total_keys = {"TOTAL", "AMOUNT", "GRANDTOTAL", "TOTALTOPAY"}
+    condition, attr_names, attr_values = receipt_write_condition(parse_if_match(if_match))
+    try:
+        result = receipt_db.update_item(
+            Key={"receipt_username": user["username"], "receipt_id": data.receipt_id},
+            UpdateExpression="SET receipt_status = :new_status ADD #version :one",
+            ConditionExpression=condition,
+            ExpressionAttributeNames={**attr_names, "#version": "version"},
+            ExpressionAttributeValues={**attr_values, ":new_status": data.new_status, ":one": 1},
+            ReturnValues="UPDATED_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError as e:
+        raise conditional_write_error(e, "Error updating receipt status")
 
-    chars_to_remove = ["=", ":", "-", "$", ".", ",", " "]
+    attributes = result.get("Attributes", {})
+    response.headers["ETag"] = receipt_etag(attributes.get("version"))
+    publish_receipt_event(user["username"], STATUS_CHANGED, data.receipt_id, receipt_status=data.new_status, version=attributes.get("version"))
+    return {"message": "Status updated", "attributes": attributes}
 
-    for item in items:
-        # Filter by year
-        upload_datetime = item.get("receipt_upload_datetime", "")
-        if not upload_datetime.startswith(str(year)):
-            continue
 
-        textract_data: dict = item.get("textract_data", {})
+@receipts_router.post("/status/batch")
+async def update_status_batch(data: ReceiptBatchStatusUpdate, user=Depends(get_current_user)):
+    """
+    Update the status of many receipts at once.
+    Returns a per-receipt result of "updated", "not_found" or "failed" (the receipt's
+    transaction was cancelled for another reason and can be retried).
+    """
+    receipt_ids = list(dict.fromkeys(data.receipt_ids))
+    if not receipt_ids:
+        raise HTTPException(status_code=400, detail="No receipt IDs provided")
 
-        claim_str = None
+    try:
+        results = batch_update_status(user["username"], receipt_ids, data.new_status)
+    except Exception as e:
+        print(f"Error updating receipt statuses: {e}")
+        raise HTTPException(status_code=500, detail="Error updating receipt statuses")
 
-        for textract_key, value in textract_data.items():
-            cleaned_textract_key = str(textract_key).upper()  # Start with uppercase
-            for char_to_remove in chars_to_remove:
-                cleaned_textract_key = cleaned_textract_key.replace(char_to_remove, "")
-            cleaned_textract_key = cleaned_textract_key.strip()
+    for receipt_id in receipt_ids:
+        if results.get(receipt_id) == "updated":
+            publish_receipt_event(user["username"], STATUS_CHANGED, receipt_id, receipt_status=data.new_status)
 
-            if cleaned_textract_key in normalized_total_keys:
-                claim_str = value
+    return {
+        "message": "Statuses updated",
+        "new_status": data.new_status,
+        "results": [{"receipt_id": receipt_id, "result": results.get(receipt_id, "failed")} for receipt_id in receipt_ids],
+    }
 
-        if claim_str:
-            try:
-                cleaned_value_str = str(claim_str).replace(",", "").replace("$", "").strip()
-                claim_value = float(cleaned_value_str)
-                total += claim_value
-            except ValueError:
-                print(f"Could not convert '{claim_str}' to float for item ID: {item.get('receipt_id', 'N/A')}. Skipping.")
-                continue
-            except Exception as e:
-                print(f"Unexpected error processing claim value '{claim_str}': {e} for item ID: {item.get('receipt_id', 'N/A')}. Skipping.")
-                continue
 
-    return {"year": year, "total_claims": total, "num_receipts": len(items)}
+@receipts_router.get("/total-claims")
+async def total_claims(
+    user=Depends(get_current_user),
+    year: int = Query(..., description="Year to filter receipts (e.g., 2025)"),
+):
+    # Range query over the user's month partitions of the year in the date index
+    receipts = [Receipt.from_item(item) for item in query_receipts_by_date(user["username"], year, attributes=["receipt_id", "receipt_summary", "duplicate_of", "possible_duplicate_of"])]
+
+    # Duplicates would count the same receipt twice; possible duplicates count until confirmed
+    counted = [receipt for receipt in receipts if not receipt.duplicate_of]
+    total = sum(receipt.total for receipt in counted)
+
+    return {
+        "year": year,
+        "total_claims": float(total),
+        "num_receipts": len(counted),
+        "num_duplicates_excluded": len(receipts) - len(counted),
+        "num_possible_duplicates": sum(1 for receipt in counted if receipt.possible_duplicate_of),
+    }
 
 
 @receipts_router.get("/view/{receipt_id}")
 async def view_receipt(
+    request: Request,
     user=Depends(get_current_user),
     receipt_id: str = Path(..., description="The ID of the receipt to view"),
 ):
     """
     Fetch specific receipt details by receipt ID.
-    Returns the complete receipt metadata including extracted textract data.
+    Returns the complete receipt metadata including extracted textract data,
+    which is loaded from S3 when it was offloaded.
+    The receipt version is sent as the ETag for use in If-Match on later writes.
+    Clients accepting application/msgpack get MessagePack instead of JSON.
     """
     try:
-        response = receipt_db.get_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
+        result = receipt_db.get_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
 
-        receipt_item = response.get("Item")
-        if not receipt_item:
+        if not result.get("Item"):
             raise HTTPException(status_code=404, detail="Receipt not found")
+        receipt = Receipt.from_item(result["Item"])
 
         # Return the complete receipt data
-        return {
-            "receipt_id": receipt_item.get("receipt_id"),
-            "receipt_filename": receipt_item.get("receipt_filename"),
-            "receipt_status": receipt_item.get("receipt_status"),
-            "receipt_upload_datetime": receipt_item.get("receipt_upload_datetime"),
-            "receipt_size": receipt_item.get("receipt_size"),
-            "textract_data": receipt_item.get("textract_data", {}),
+        details = {
+            "receipt_id": receipt.receipt_id,
+            "receipt_filename": receipt.receipt_filename,
+            "receipt_status": receipt.receipt_status,
+            "receipt_upload_datetime": receipt.receipt_upload_datetime,
+            "receipt_size": receipt.receipt_size,
+            "textract_data": receipt_textract_data(receipt),
+            "receipt_summary": receipt.receipt_summary.to_item() if receipt.receipt_summary else {},
+            "version": receipt.version,
             "image_url": f"/receipts/image/{receipt_id}",  # URL to fetch the actual image
         }
+        return negotiated_response(request, details, headers={"ETag": receipt_etag(receipt.version)})
 
     except HTTPException:
         # Re-raise HTTP exceptions
@@ -184,74 +440,213 @@ async def view_receipt(
 
 @receipts_router.put("/update/{receipt_id}")
 async def update_receipt(
+    response: Response,
     receipt_id: str = Path(..., description="The ID of the receipt to update"),
     data: ReceiptUpdate = None,
     user=Depends(get_current_user),
+    if_match: Optional[str] = Header(None),
 ):
     """
     Update receipt details including status and textract data.
-    Only the fields provided in the request will be updated.
+    Only the fields provided in the request will be updated; textract_data is replaced
+    as a whole, use PATCH to change individual fields.
+    The write is conditional on the receipt existing (404 otherwise) and, when an
+    If-Match header is sent, on it still being at that version (412 otherwise).
     """
     if data is None:
         raise HTTPException(status_code=400, detail="No update data provided")
 
-    # First verify the receipt exists and belongs to the user
+    if data.receipt_status is None and data.textract_data is None:
+        raise HTTPException(status_code=400, detail="No valid fields to update")
+
+    expected_version = parse_if_match(if_match)
     try:
-        response = receipt_db.get_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
+        if data.textract_data is not None:
+            version = replace_receipt_ocr(user["username"], receipt_id, data.textract_data, expected_version, data.receipt_status)
+        else:
+            condition, attr_names, attr_values = receipt_write_condition(expected_version)
+            result = receipt_db.update_item(
+                Key={"receipt_username": user["username"], "receipt_id": receipt_id},
+                UpdateExpression="SET #status = :status ADD #version :one",
+                ConditionExpression=condition,
+                ExpressionAttributeNames={**attr_names, "#status": "receipt_status", "#version": "version"},
+                ExpressionAttributeValues={**attr_values, ":status": data.receipt_status, ":one": 1},
+                ReturnValues="UPDATED_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+            version = int(result.get("Attributes", {}).get("version", 0))
+    except ClientError as e:
+        raise conditional_write_error(e, "Error updating receipt details")
+    except Exception as e:
+        print(f"Error updating receipt: {e}")
+        raise HTTPException(status_code=500, detail="Error updating receipt details")
 
-        receipt_item = response.get("Item")
-        if not receipt_item:
-            raise HTTPException(status_code=404, detail="Receipt not found")
+    response.headers["ETag"] = receipt_etag(version)
+    publish_receipt_event(user["username"], RECEIPT_UPDATED, receipt_id, receipt_status=data.receipt_status, version=version)
+
+    return {
+        "message": "Receipt updated successfully",
+        "receipt_id": receipt_id,
+        "version": version,
+        "updated_fields": {
+            "receipt_status": data.receipt_status,
+            "textract_data": data.textract_data,
+        },
+    }
 
-        # Build update expression and attribute values
-        update_parts = []
-        expression_attr_values = {}
-        expression_attr_names = {}
 
-        # Handle status update
-        if data.receipt_status is not None:
-            update_parts.append("#status = :status")
-            expression_attr_names["#status"] = "receipt_status"
-            expression_attr_values[":status"] = data.receipt_status
+@receipts_router.patch("/update/{receipt_id}")
+async def patch_receipt(
+    request: Request,
+    response: Response,
+    receipt_id: str = Path(..., description="The ID of the receipt to update"),
+    user=Depends(get_current_user),
+    if_match: Optional[str] = Header(None),
+):
+    """
+    Partially update a receipt with a merge patch (application/merge-patch+json) or a
+    JSON Patch (application/json-patch+json). For receipts with inline OCR data only the
+    changed textract fields are written, via SET/REMOVE on their nested paths.
+    Receipts whose OCR data is in S3, that predate the summary, or that would outgrow
+    the inline size are rewritten as a whole, conditional on the version seen.
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+
+    patch = normalize_receipt_patch(body, request.headers.get("content-type", ""))
+    update_expression, expression_attr_names, expression_attr_values, added_bytes = compile_receipt_patch(patch, user["username"], receipt_id)
+    if not update_expression:
+        raise HTTPException(status_code=400, detail="No valid fields to update")
+
+    expected_version = parse_if_match(if_match)
+    condition, attr_names, attr_values = receipt_write_condition(expected_version)
+    expression_attr_names.update(attr_names)
+    expression_attr_values.update(attr_values)
+    expression_attr_names.update({"#version": "version", "#item_size": "item_size"})
+    expression_attr_values.update({":one": 1, ":added_bytes": added_bytes})
+    if patch.textract_data:
+        # item_size only grows here since removed values are not read back; a rewrite recomputes it
+        condition += " AND attribute_exists(#textract) AND attribute_exists(#summary) AND #item_size <= :size_before"
+        expression_attr_names.update({"#textract": "textract_data", "#summary": "receipt_summary"})
+        expression_attr_values[":size_before"] = RECEIPT_INLINE_ITEM_MAX - added_bytes
 
-        # Handle textract data update
-        if data.textract_data is not None:
-            update_parts.append("#textract = :textract")
-            expression_attr_names["#textract"] = "textract_data"
-            expression_attr_values[":textract"] = data.textract_data
+    try:
+        result = receipt_db.update_item(
+            Key={"receipt_username": user["username"], "receipt_id": receipt_id},
+            UpdateExpression=update_expression + " ADD #version :one, #item_size :added_bytes",
+            ConditionExpression=condition,
+            ExpressionAttributeNames=expression_attr_names,
+            ExpressionAttributeValues=expression_attr_values,
+            ReturnValues="UPDATED_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+        version = int(result.get("Attributes", {}).get("version", 0))
+    except ClientError as e:
+        current_item = deserialize_item(e.response.get("Item"))
+        current = Receipt.from_item(current_item) if current_item is not None else None
+        stale = expected_version is not None and current is not None and current.version != expected_version
+        if not patch.textract_data or current is None or stale:
+            raise conditional_write_error(e, "Error updating receipt details")
+
+        # The failed condition returned the current item, so it can be rewritten without another read
+        try:
+            merged = apply_merge_patch(receipt_textract_data(current), patch.textract_data)
+            version = replace_receipt_ocr(
+                user["username"],
+                receipt_id,
+                merged,
+                current.version,
+                patch.receipt_status,
+                fallback_date=current.receipt_date or (current.receipt_upload_datetime or "")[:10] or None,
+            )
+        except ClientError as rewrite_error:
+            raise conditional_write_error(rewrite_error, "Error updating receipt details")
+    except Exception as e:
+        print(f"Error patching receipt: {e}")
+        raise HTTPException(status_code=500, detail="Error updating receipt details")
 
-        if not update_parts:
-            raise HTTPException(status_code=400, detail="No valid fields to update")
+    response.headers["ETag"] = receipt_etag(version)
+    publish_receipt_event(user["username"], RECEIPT_UPDATED, receipt_id, receipt_status=patch.receipt_status, version=version)
+
+    return {
+        "message": "Receipt updated successfully",
+        "receipt_id": receipt_id,
+        "version": version,
+        "updated_fields": {
+            "receipt_status": patch.receipt_status,
+            "textract_data": {field: value for field, value in (patch.textract_data or {}).items() if value is not None},
+        },
+        "removed_fields": [field for field, value in (patch.textract_data or {}).items() if value is None],
+    }
 
-        # Construct the update expression
-        update_expression = "SET " + ", ".join(update_parts)
 
-        # Perform the update
-        response = receipt_db.update_item(
+@receipts_router.post("/duplicate/{receipt_id}")
+async def confirm_duplicate(
+    response: Response,
+    receipt_id: str = Path(..., description="The ID of the receipt flagged as a possible duplicate"),
+    user=Depends(get_current_user),
+    if_match: Optional[str] = Header(None),
+):
+    """
+    Confirm that a receipt flagged as a possible duplicate is one: its possible_duplicate_of
+    becomes duplicate_of and total-claims leaves it out. 409 when it has no possible duplicate.
+    Conditional on the receipt existing and, with If-Match, on its version.
+    """
+    condition, attr_names, attr_values = receipt_write_condition(parse_if_match(if_match))
+    try:
+        result = receipt_db.update_item(
             Key={"receipt_username": user["username"], "receipt_id": receipt_id},
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_attr_values,
-            ExpressionAttributeNames=expression_attr_names,
+            UpdateExpression="SET duplicate_of = possible_duplicate_of REMOVE possible_duplicate_of ADD #version :one",
+            ConditionExpression=f"{condition} AND attribute_exists(possible_duplicate_of)",
+            ExpressionAttributeNames={**attr_names, "#version": "version"},
+            ExpressionAttributeValues={**attr_values, ":one": 1},
             ReturnValues="ALL_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
         )
+    except ClientError as e:
+        old = e.response.get("Item")
+        if old and "possible_duplicate_of" not in old:
+            raise HTTPException(status_code=409, detail="Receipt is not flagged as a possible duplicate")
+        raise conditional_write_error(e, "Error confirming duplicate")
+
+    attributes = result.get("Attributes", {})
+    version = int(attributes.get("version", 0))
+    response.headers["ETag"] = receipt_etag(version)
+    publish_receipt_event(user["username"], RECEIPT_UPDATED, receipt_id, duplicate_of=attributes.get("duplicate_of"), possible_duplicate_of=None, version=version)
+    return {"message": "Duplicate confirmed", "receipt_id": receipt_id, "duplicate_of": attributes.get("duplicate_of"), "version": version}
+
+
+@receipts_router.delete("/duplicate/{receipt_id}")
+async def clear_duplicate_flag(
+    response: Response,
+    receipt_id: str = Path(..., description="The ID of the receipt flagged as a duplicate"),
+    user=Depends(get_current_user),
+    if_match: Optional[str] = Header(None),
+):
+    """
+    Mark a receipt flagged at upload as not a duplicate (or not a possible duplicate), so
+    total-claims counts it again. Conditional on the receipt existing and, with If-Match, on its version.
+    """
+    condition, attr_names, attr_values = receipt_write_condition(parse_if_match(if_match))
+    try:
+        result = receipt_db.update_item(
+            Key={"receipt_username": user["username"], "receipt_id": receipt_id},
+            UpdateExpression="REMOVE duplicate_of, possible_duplicate_of ADD #version :one",
+            ConditionExpression=condition,
+            ExpressionAttributeNames={**attr_names, "#version": "version"},
+            ExpressionAttributeValues={**attr_values, ":one": 1},
+            ReturnValues="UPDATED_NEW",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError as e:
+        raise conditional_write_error(e, "Error clearing duplicate flag")
 
-        updated_item = response.get("Attributes", {})
-
-        return {
-            "message": "Receipt updated successfully",
-            "receipt_id": receipt_id,
-            "updated_fields": {
-                "receipt_status": updated_item.get("receipt_status"),
-                "textract_data": updated_item.get("textract_data"),
-            },
-        }
-
-    except HTTPException:
-        # Re-raise HTTP exceptions
-        raise
-    except Exception as e:
-        print(f"Error updating receipt: {e}")
-        raise HTTPException(status_code=500, detail="Error updating receipt details")
+    version = int(result.get("Attributes", {}).get("version", 0))
+    response.headers["ETag"] = receipt_etag(version)
+    publish_receipt_event(user["username"], RECEIPT_UPDATED, receipt_id, duplicate_of=None, possible_duplicate_of=None, version=version)
+    return {"message": "Duplicate flag cleared", "receipt_id": receipt_id, "version": version}
 
 
 @receipts_router.get("/image/{receipt_id}")
@@ -262,12 +657,12 @@ async def get_receipt_image(
     # First, get the receipt metadata to verify ownership and get S3 path
     response = receipt_db.get_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
 
-    receipt_item = response.get("Item")
-    if not receipt_item:
+    if not response.get("Item"):
         raise HTTPException(status_code=404, detail="Receipt not found")
+    receipt = Receipt.from_item(response["Item"])
 
     # Get the S3 path from the receipt
-    s3_key = receipt_item.get("receipt_s3_path")
+    s3_key = receipt.receipt_s3_path
     if not s3_key:
         raise HTTPException(status_code=404, detail="Receipt image not found")
 
@@ -277,7 +672,7 @@ async def get_receipt_image(
         file_stream = s3_object.get()["Body"].read()
 
         # Determine content type based on file extension
-        filename = receipt_item.get("receipt_filename", "")
+        filename = receipt.receipt_filename or ""
         content_type = "image/jpeg"  # default
         if filename.lower().endswith(".png"):
             content_type = "image/png"
@@ -298,60 +693,124 @@ async def get_receipt_image(
         raise HTTPException(status_code=500, detail="Error retrieving receipt image")
 
 
+@receipts_router.post("/delete/batch")
+async def delete_receipts_batch(data: ReceiptBatchDelete, user=Depends(get_current_user)):
+    """
+    Delete many receipts at once - removes from S3 and DynamoDB.
+    As with the single delete, database records are removed even if S3 deletion fails.
+    """
+    receipt_ids = list(dict.fromkeys(data.receipt_ids))
+    if not receipt_ids:
+        raise HTTPException(status_code=400, detail="No receipt IDs provided")
+
+    try:
+        found = batch_get_receipts(user["username"], receipt_ids, ["receipt_s3_path", "receipt_optimized_s3_path", "textract_s3_path", "receipt_filename"])
+        receipts = {receipt_id: Receipt.from_item(item) for receipt_id, item in found.items()}
+
+        failed_s3_keys = delete_s3_objects([key for receipt in receipts.values() for key in receipt.s3_keys])
+
+        with receipt_db.batch_writer() as batch:
+            for receipt_id in receipts:
+                batch.delete_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
+    except Exception as e:
+        print(f"Error deleting receipts: {e}")
+        raise HTTPException(status_code=500, detail="Error deleting receipts")
+
+    for receipt_id in receipts:
+        duplicate_index.remove(user["username"], receipt_id)
+        publish_receipt_event(user["username"], RECEIPT_DELETED, receipt_id)
+
+    results = []
+    for receipt_id in receipt_ids:
+        receipt = receipts.get(receipt_id)
+        if not receipt:
+            results.append({"receipt_id": receipt_id, "result": "not_found"})
+            continue
+
+        s3_key = receipt.receipt_s3_path
+        if not s3_key:
+            s3_deletion_status = "skipped_no_path"
+        elif s3_key in failed_s3_keys:
+            s3_deletion_status = "failed"
+        else:
+            s3_deletion_status = "completed"
+
+        results.append(
+            {
+                "receipt_id": receipt_id,
+                "result": "deleted",
+                "deleted_filename": receipt.receipt_filename,
+                "s3_deletion_status": s3_deletion_status,
+            }
+        )
+
+    return {"message": "Receipts deleted", "results": results}
+
+
 @receipts_router.delete("/delete/{receipt_id}")
 async def delete_receipt(
     receipt_id: str = Path(..., description="The ID of the receipt to delete"),
     user=Depends(get_current_user),
+    if_match: Optional[str] = Header(None),
 ):
     """
     Delete a receipt completely - removes from S3 and DynamoDB.
+    The database delete is a single conditional write that returns the deleted item,
+    so the S3 path comes from it without a separate read.
     If S3 path is missing, only deletes the database record.
     """
+    condition, attr_names, attr_values = receipt_write_condition(parse_if_match(if_match))
+    delete_kwargs = {
+        "Key": {"receipt_username": user["username"], "receipt_id": receipt_id},
+        "ConditionExpression": condition,
+        "ReturnValues": "ALL_OLD",
+        "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+    }
+    if attr_names:
+        delete_kwargs["ExpressionAttributeNames"] = attr_names
+    if attr_values:
+        delete_kwargs["ExpressionAttributeValues"] = attr_values
+
+    # Delete from DynamoDB
     try:
-        # First, get the receipt metadata to verify ownership and get S3 path
-        response = receipt_db.get_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
+        result = receipt_db.delete_item(**delete_kwargs)
+        print(f"Successfully deleted receipt from database: {receipt_id}")
+    except ClientError as e:
+        raise conditional_write_error(e, "Error deleting receipt from database")
+    except Exception as e:
+        print(f"Error deleting receipt: {e}")
+        raise HTTPException(status_code=500, detail="Error deleting receipt")
 
-        receipt_item = response.get("Item")
-        if not receipt_item:
-            raise HTTPException(status_code=404, detail="Receipt not found")
+    receipt = Receipt.from_item(result.get("Attributes", {}))
+    duplicate_index.remove(user["username"], receipt_id)
+    publish_receipt_event(user["username"], RECEIPT_DELETED, receipt_id)
 
-        # Get the S3 path from the receipt
-        s3_key = receipt_item.get("receipt_s3_path")
-        deleted_s3_key = None
-
-        # Delete from S3 if path exists
-        if s3_key:
-            try:
-                s3_object = receipt_bucket.Object(s3_key)
-                s3_object.delete()
-                deleted_s3_key = s3_key
-                print(f"Successfully deleted S3 object: {s3_key}")
-            except Exception as s3_error:
-                print(f"Error deleting from S3: {s3_error}")
-                # Continue with database deletion even if S3 deletion fails
-                # This prevents orphaned database records
-        else:
-            print(f"No S3 path found for receipt {receipt_id}, skipping S3 deletion")
+    # Get the S3 path from the deleted receipt
+    s3_key = receipt.receipt_s3_path
+    deleted_s3_key = None
 
-        # Delete from DynamoDB
+    # Delete from S3 if path exists
+    if s3_key:
         try:
-            receipt_db.delete_item(Key={"receipt_username": user["username"], "receipt_id": receipt_id})
-            print(f"Successfully deleted receipt from database: {receipt_id}")
-        except Exception as db_error:
-            print(f"Error deleting from database: {db_error}")
-            raise HTTPException(status_code=500, detail="Error deleting receipt from database")
-
-        return {
-            "message": "Receipt deleted successfully",
-            "receipt_id": receipt_id,
-            "deleted_s3_key": deleted_s3_key,
-            "deleted_filename": receipt_item.get("receipt_filename"),
-            "s3_deletion_status": "completed" if deleted_s3_key else "skipped_no_path",
-        }
-
-    except HTTPException:
-        # Re-raise HTTP exceptions
-        raise
-    except Exception as e:
-        print(f"Error deleting receipt: {e}")
-        raise HTTPException(status_code=500, detail="Error deleting receipt")
+            s3_object = receipt_bucket.Object(s3_key)
+            s3_object.delete()
+            deleted_s3_key = s3_key
+            print(f"Successfully deleted S3 object: {s3_key}")
+        except Exception as s3_error:
+            # The database record is already gone; the orphaned object is left behind
+            print(f"Error deleting from S3: {s3_error}")
+    else:
+        print(f"No S3 path found for receipt {receipt_id}, skipping S3 deletion")
+
+    # Remove the OCR copy of the image and offloaded OCR data, if any
+    derived_keys = [key for key in (receipt.receipt_optimized_s3_path, receipt.textract_s3_path) if key]
+    if derived_keys:
+        delete_s3_objects(derived_keys)
+
+    return {
+        "message": "Receipt deleted successfully",
+        "receipt_id": receipt_id,
+        "deleted_s3_key": deleted_s3_key,
+        "deleted_filename": receipt.receipt_filename,
+        "s3_deletion_status": "completed" if deleted_s3_key else ("failed" if s3_key else "skipped_no_path"),
+    }
@@ -0,0 +1,201 @@
+"""
+Parallel segmented scans for table-wide jobs (migrations, maintenance, snapshot exports).
+
+ParallelScan runs one worker thread per Segment of TotalSegments, each following
+LastEvaluatedKey to the end of its segment, and yields pages as they arrive:
+
+    for page in ParallelScan(receipt_db, total_segments=8, ProjectionExpression=...):
+        ...
+
+Pages are handed over through a bounded queue, so workers stay at most a couple of
+pages ahead of the consumer. A ScanCheckpoint records, per segment, the key after the
+last page the consumer finished with; a scan started from a saved checkpoint resumes
+there. Throttling errors are retried with a backoff shared by all workers that grows on
+every throttle and decays on success.
+"""
+
+import json
+import os
+import queue
+import threading
+from typing import Dict, Iterator, List, Optional, Set
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+from src.config import SCAN_MAX_RETRIES, SCAN_SEGMENTS, receipt_db
+from src.utils import AdaptiveBackoff, deserialize_item
+
+THROUGHPUT_ERRORS = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
+
+_serializer = TypeSerializer()
+
+
+class ScanCheckpoint:
+    """Per-segment scan positions, optionally persisted to a JSON file."""
+
+    def __init__(self, total_segments: int, path: Optional[str] = None):
+        self.total_segments = total_segments
+        self.path = path
+        self.positions: Dict[int, dict] = {}
+        self.done: Set[int] = set()
+
+    @classmethod
+    def load(cls, path: str, total_segments: int) -> "ScanCheckpoint":
+        """Resume from path if it exists, else start a new checkpoint saved there."""
+        checkpoint = cls(total_segments, path)
+        if not os.path.exists(path):
+            return checkpoint
+        with open(path) as f:
+            saved = json.load(f)
+        if saved["total_segments"] != total_segments:
+            raise ValueError(f"Checkpoint {path} was taken with {saved['total_segments']} segments, not {total_segments}")
+        # Keys are stored in DynamoDB's typed JSON so numbers and binary values round-trip
+        checkpoint.positions = {int(segment): deserialize_item(key) for segment, key in saved["positions"].items()}
+        checkpoint.done = set(saved["done"])
+        return checkpoint
+
+    @property
+    def finished(self) -> bool:
+        return len(self.done) == self.total_segments
+
+    def start_key(self, segment: int) -> Optional[dict]:
+        return self.positions.get(segment)
+
+    def advance(self, segment: int, last_evaluated_key: Optional[dict]):
+        if last_evaluated_key is None:
+            self.positions.pop(segment, None)
+            self.done.add(segment)
+        else:
+            self.positions[segment] = last_evaluated_key
+
+    def save(self):
+        if not self.path:
+            return
+        saved = {
+            "total_segments": self.total_segments,
+            "positions": {segment: {name: _serializer.serialize(value) for name, value in key.items()} for segment, key in self.positions.items()},
+            "done": sorted(self.done),
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(saved, f)
+        os.replace(temp_path, self.path)
+
+
+class ParallelScan:
+    """
+    Iterate over the pages of a table scan with total_segments parallel workers.
+    Extra keyword arguments are passed to every Scan call (projection, filter, Limit).
+    A throttle with consume(units) paces reads by the capacity each page reports.
+    Statistics (pages, items, throttled) are kept in stats.
+    """
+
+    def __init__(
+        self,
+        table=None,
+        total_segments: int = SCAN_SEGMENTS,
+        checkpoint: Optional[ScanCheckpoint] = None,
+        throttle=None,
+        max_retries: int = SCAN_MAX_RETRIES,
+        checkpoint_every: int = 10,
+        **scan_kwargs,
+    ):
+        self.table = table or receipt_db
+        self.total_segments = total_segments
+        self.checkpoint = checkpoint or ScanCheckpoint(total_segments)
+        if self.checkpoint.total_segments != total_segments:
+            raise ValueError("Checkpoint and scan segment counts differ")
+        self.throttle = throttle
+        self.max_retries = max_retries
+        self.checkpoint_every = checkpoint_every
+        self.scan_kwargs = scan_kwargs
+        if throttle is not None:
+            self.scan_kwargs["ReturnConsumedCapacity"] = "TOTAL"
+        self.backoff = AdaptiveBackoff()
+        self.stats = {"pages": 0, "items": 0, "throttled": 0}
+        self._stats_lock = threading.Lock()
+
+    def _scan_page(self, kwargs: dict) -> dict:
+        attempts = 0
+        while True:
+            self.backoff.wait()
+            try:
+                response = self.table.scan(**kwargs)
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in THROUGHPUT_ERRORS or attempts >= self.max_retries:
+                    raise
+                attempts += 1
+                with self._stats_lock:
+                    self.stats["throttled"] += 1
+                self.backoff.throttled()
+                continue
+            self.backoff.succeeded()
+            if self.throttle is not None:
+                self.throttle.consume(response.get("ConsumedCapacity", {}).get("CapacityUnits", 1))
+            return response
+
+    @staticmethod
+    def _put(pages: queue.Queue, stop: threading.Event, entry: tuple):
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _worker(self, segment: int, pages: queue.Queue, stop: threading.Event):
+        kwargs = {**self.scan_kwargs, "Segment": segment, "TotalSegments": self.total_segments}
+        start_key = self.checkpoint.start_key(segment)
+        if start_key:
+            kwargs["ExclusiveStartKey"] = start_key
+        try:
+            while not stop.is_set():
+                response = self._scan_page(kwargs)
+                last_evaluated_key = response.get("LastEvaluatedKey")
+                self._put(pages, stop, (segment, response.get("Items", []), last_evaluated_key))
+                if last_evaluated_key is None:
+                    break
+                kwargs["ExclusiveStartKey"] = last_evaluated_key
+        except Exception as e:
+            self._put(pages, stop, (segment, e, None))
+        finally:
+            self._put(pages, stop, (segment, None, None))
+
+    def __iter__(self) -> Iterator[List[dict]]:
+        segments = [segment for segment in range(self.total_segments) if segment not in self.checkpoint.done]
+        if not segments:
+            return
+        pages: queue.Queue = queue.Queue(maxsize=2 * len(segments))
+        stop = threading.Event()
+        workers = [threading.Thread(target=self._worker, args=(segment, pages, stop), daemon=True) for segment in segments]
+        for worker in workers:
+            worker.start()
+
+        running = len(workers)
+        try:
+            while running:
+                segment, items, last_evaluated_key = pages.get()
+                if items is None:
+                    running -= 1
+                    continue
+                if isinstance(items, Exception):
+                    raise items
+                yield items
+                # The consumer is done with the page, so a resumed scan can start after it
+                self.checkpoint.advance(segment, last_evaluated_key)
+                self.stats["pages"] += 1
+                self.stats["items"] += len(items)
+                if self.stats["pages"] % self.checkpoint_every == 0:
+                    self.checkpoint.save()
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+            self.checkpoint.save()
+
+
+def scan_items(table=None, total_segments: int = SCAN_SEGMENTS, **kwargs) -> Iterator[dict]:
+    """Every item of a table scan, read with parallel segments. Item order is not defined."""
+    for page in ParallelScan(table, total_segments, **kwargs):
+        yield from page
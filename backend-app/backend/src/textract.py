@@ -0,0 +1,124 @@
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from starlette.concurrency import run_in_threadpool
+
+from src.config import TEXTRACT_JOB_TIMEOUT_SECONDS, TEXTRACT_POLL_INTERVAL_SECONDS, receipt_bucket, receipt_db, receipt_textract
+from src.events import OCR_COMPLETED, publish_receipt_event
+from src.utils import parse_textract_expense, parse_textract_expense_fields, receipt_write_condition, replace_receipt_ocr
+
+# Document-level amounts are printed at the end, so for these the last page wins
+LAST_OCCURRENCE_TYPES = {"TOTAL", "AMOUNT_DUE", "AMOUNT_PAID", "SUBTOTAL", "TAX"}
+FINISHED_STATUSES = {"SUCCEEDED", "PARTIAL_SUCCESS"}
+
+
+def is_pdf(data: bytes) -> bool:
+    return data[:5] == b"%PDF-"
+
+
+def start_expense_job(s3_key: str) -> str:
+    """Start an asynchronous StartExpenseAnalysis job, which unlike AnalyzeExpense handles multi-page PDFs."""
+    response = receipt_textract.start_expense_analysis(DocumentLocation={"S3Object": {"Bucket": receipt_bucket.name, "Name": s3_key}})
+    return response["JobId"]
+
+
+def merge_expense_documents(documents: List[dict]) -> dict:
+    """
+    Merge the per-page ExpenseDocuments of a job into one document, in the shape of an
+    AnalyzeExpense response. Typed summary fields are kept once: the first occurrence,
+    or the last one for totals. OTHER fields and line items are kept from every page.
+    """
+    summary_fields = []
+    typed_positions = {}
+    line_item_groups = []
+    for document in sorted(documents, key=lambda d: d.get("ExpenseIndex", 0)):
+        for field in document.get("SummaryFields", []):
+            field_type = field.get("Type", {}).get("Text", "OTHER")
+            if field_type == "OTHER":
+                summary_fields.append(field)
+            elif field_type not in typed_positions:
+                typed_positions[field_type] = len(summary_fields)
+                summary_fields.append(field)
+            elif field_type in LAST_OCCURRENCE_TYPES:
+                summary_fields[typed_positions[field_type]] = field
+        line_item_groups.extend(document.get("LineItemGroups", []))
+
+    return {
+        "DocumentMetadata": {"Pages": len(documents)},
+        "ExpenseDocuments": [{"ExpenseIndex": 1, "SummaryFields": summary_fields, "LineItemGroups": line_item_groups}],
+    }
+
+
+def get_expense_job(job_id: str) -> Tuple[str, Optional[dict]]:
+    """
+    Check a job once. When it has finished, collect every page of results through
+    NextToken and return them merged. Returns (JobStatus, merged response or None).
+    """
+    response = receipt_textract.get_expense_analysis(JobId=job_id)
+    status = response.get("JobStatus")
+    if status not in FINISHED_STATUSES:
+        return status, None
+
+    documents = list(response.get("ExpenseDocuments", []))
+    while response.get("NextToken"):
+        response = receipt_textract.get_expense_analysis(JobId=job_id, NextToken=response["NextToken"])
+        documents.extend(response.get("ExpenseDocuments", []))
+    return status, merge_expense_documents(documents)
+
+
+def complete_expense_job(username: str, receipt_id: str, job_id: str, expected_version: int) -> str:
+    """
+    Collect a finished job into its receipt with one conditional write on the version the
+    receipt had while processing. Returns the receipt's ocr_status after the check.
+    Raises ClientError when the receipt changed or was deleted meanwhile.
+    """
+    status, response = get_expense_job(job_id)
+    if status == "IN_PROGRESS":
+        return "processing"
+
+    if response is None:
+        print(f"Textract job {job_id} for receipt {receipt_id} ended with status {status}")
+        condition, names, values = receipt_write_condition(expected_version)
+        receipt_db.update_item(
+            Key={"receipt_username": username, "receipt_id": receipt_id},
+            UpdateExpression="SET ocr_status = :failed ADD #version :one",
+            ConditionExpression=condition,
+            ExpressionAttributeNames={**names, "#version": "version"},
+            ExpressionAttributeValues={**values, ":failed": "failed", ":one": 1},
+        )
+        publish_receipt_event(username, OCR_COMPLETED, receipt_id, ocr_status="failed", version=expected_version + 1)
+        return "failed"
+
+    version = replace_receipt_ocr(
+        username,
+        receipt_id,
+        parse_textract_expense(response),
+        expected_version,
+        expense_fields=parse_textract_expense_fields(response),
+        extra_attributes={"ocr_status": "completed", "ocr_pages": response["DocumentMetadata"]["Pages"]},
+    )
+    publish_receipt_event(username, OCR_COMPLETED, receipt_id, ocr_status="completed", ocr_engine="textract", version=version)
+    return "completed"
+
+
+async def track_expense_job(username: str, receipt_id: str, job_id: str, expected_version: int = 1):
+    """
+    Poll a job in the background until it finishes or TEXTRACT_JOB_TIMEOUT_SECONDS passes.
+    The boto3 calls run in the threadpool; no thread is held between polls.
+    """
+    deadline = time.monotonic() + TEXTRACT_JOB_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            if await run_in_threadpool(complete_expense_job, username, receipt_id, job_id, expected_version) != "processing":
+                return
+        except ClientError as e:
+            # Already collected by /receipts/ocr/{receipt_id}, or the receipt was deleted
+            print(f"Stopped tracking Textract job {job_id}: {e}")
+            return
+        except Exception as e:
+            print(f"Error tracking Textract job {job_id}: {e}")
+            return
+        await asyncio.sleep(TEXTRACT_POLL_INTERVAL_SECONDS)
+    print(f"Textract job {job_id} still running after {TEXTRACT_JOB_TIMEOUT_SECONDS}s; left for /receipts/ocr/{receipt_id}")
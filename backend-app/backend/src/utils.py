@@ -1,6 +1,69 @@
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from pathlib import Path as PathLib
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
-from src.config import receipt_db
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+
+from src.config import OCR_INLINE_MAX_BYTES, RECEIPT_PERIOD_INDEX, dynamo, receipt_bucket, receipt_db
+from src.models.receipts import Receipt, ReceiptMergePatch, ReceiptPatchOperation
+
+# AWS per-request limits for the batch APIs
+DYNAMO_BATCH_GET_LIMIT = 100
+DYNAMO_TRANSACT_WRITE_LIMIT = 25
+# Rounds of UnprocessedKeys resubmitted per BatchGetItem chunk before giving up
+DYNAMO_BATCH_MAX_RETRIES = 8
+S3_DELETE_OBJECTS_LIMIT = 1000
+
+# Allowance for the receipt attributes other than the OCR data
+RECEIPT_METADATA_SIZE = 1024
+# Receipts whose tracked item_size grows past this are rewritten, offloading the OCR data
+RECEIPT_INLINE_ITEM_MAX = RECEIPT_METADATA_SIZE + OCR_INLINE_MAX_BYTES
+
+# Attributes returned for receipt list rows; the OCR data is only loaded per receipt
+RECEIPT_LIST_ATTRIBUTES = [
+    "receipt_id",
+    "receipt_filename",
+    "receipt_status",
+    "receipt_upload_datetime",
+    "receipt_size",
+    "receipt_date",
+    "receipt_summary",
+    "version",
+    "duplicate_of",
+    "possible_duplicate_of",
+]
+
+# Formats seen in INVOICE_RECEIPT_DATE values, day-first as printed on Malaysian receipts
+RECEIPT_DATE_FORMATS = (
+    "%d/%m/%Y",
+    "%d-%m-%Y",
+    "%d.%m.%Y",
+    "%Y-%m-%d",
+    "%Y/%m/%d",
+    "%d/%m/%y",
+    "%d-%m-%y",
+    "%d %b %Y",
+    "%d %B %Y",
+    "%b %d, %Y",
+    "%B %d, %Y",
+)
+
+# Normalized textract labels that hold the claimable total
+TOTAL_LABELS = {"TOTAL", "AMOUNT", "GRANDTOTAL", "TOTALTOPAY"}
+LABEL_CHARS_TO_REMOVE = ["=", ":", "-", "$", ".", ",", " "]
+VENDOR_LABELS = ("VENDOR", "MERCHANT", "STORE", "COMPANY")
+
+_deserializer = TypeDeserializer()
 
 
 def parse_textract_expense(response):
@@ -18,9 +81,252 @@ def parse_textract_expense(response):
     return summary_fields
 
 
+def parse_textract_expense_fields(response) -> Dict[str, str]:
+    """Map Textract's normalized summary field types (TOTAL, INVOICE_RECEIPT_DATE, VENDOR_NAME, ...) to their first value."""
+    expense_fields = {}
+    for doc in response.get("ExpenseDocuments", []):
+        for field in doc.get("SummaryFields", []):
+            field_type = field.get("Type", {}).get("Text", "")
+            value = field.get("ValueDetection", {}).get("Text", "")
+            if field_type and value and field_type not in expense_fields:
+                expense_fields[field_type] = value
+    return expense_fields
+
+
+def normalize_label(label: str) -> str:
+    normalized = str(label).upper()
+    for char_to_remove in LABEL_CHARS_TO_REMOVE:
+        normalized = normalized.replace(char_to_remove, "")
+    return normalized.strip()
+
+
+def parse_amount(value) -> Optional[Decimal]:
+    try:
+        amount = Decimal(str(value).replace(",", "").replace("$", "").replace("RM", "").strip())
+    except InvalidOperation:
+        return None
+    return amount if amount.is_finite() else None
+
+
+def summary_field_for_label(label: str) -> Optional[str]:
+    """Return the receipt_summary field a textract label feeds, if any."""
+    normalized = normalize_label(label)
+    if normalized in TOTAL_LABELS:
+        return "total"
+    if "DATE" in normalized:
+        return "date"
+    if any(vendor_label in normalized for vendor_label in VENDOR_LABELS):
+        return "vendor"
+    if normalized == "CATEGORY":
+        return "category"
+    return None
+
+
+def summary_value(summary_field: str, value: str):
+    return parse_amount(value) if summary_field == "total" else value
+
+
+def build_receipt_summary(textract_data: dict, expense_fields: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    Build the compact receipt_summary (total, date, vendor, category) kept in the item.
+    Labels are matched like total_claims always has; Textract's typed fields win when given.
+    """
+    summary = {}
+    for label, value in textract_data.items():
+        summary_field = summary_field_for_label(label)
+        if summary_field == "total":
+            # The last matching total label wins
+            summary["total"] = summary_value("total", value)
+        elif summary_field and summary_field not in summary:
+            summary[summary_field] = value
+
+    expense_fields = expense_fields or {}
+    if parse_amount(expense_fields.get("TOTAL", "")) is not None:
+        summary["total"] = parse_amount(expense_fields["TOTAL"])
+    if expense_fields.get("INVOICE_RECEIPT_DATE"):
+        summary["date"] = expense_fields["INVOICE_RECEIPT_DATE"]
+    if expense_fields.get("VENDOR_NAME"):
+        summary["vendor"] = expense_fields["VENDOR_NAME"]
+    return {key: value for key, value in summary.items() if value is not None}
+
+
+def parse_receipt_date(text: str) -> Optional[str]:
+    """
+    Parse an OCR'd receipt date into YYYY-MM-DD. A trailing time ("01/02/2024 13:45")
+    is ignored. Returns None when no known format matches.
+    """
+    words = str(text or "").strip().split()
+    for length in range(len(words), 0, -1):
+        candidate = " ".join(words[:length])
+        for date_format in RECEIPT_DATE_FORMATS:
+            try:
+                return datetime.strptime(candidate, date_format).date().isoformat()
+            except ValueError:
+                continue
+    return None
+
+
+def receipt_period(username: str, receipt_date: str) -> str:
+    """Partition of the date index: one per user, tax year and month."""
+    return f"{username}#{receipt_date[:4]}#{receipt_date[5:7]}"
+
+
+def receipt_date_attributes(username: str, receipt_id: str, receipt_date: str) -> Dict[str, str]:
+    return {
+        "receipt_date": receipt_date,
+        "receipt_period": receipt_period(username, receipt_date),
+        "receipt_date_key": f"{receipt_date}#{receipt_id}",
+    }
+
+
+def query_all(table=None, **query_kwargs) -> List[dict]:
+    """Run a query and follow LastEvaluatedKey until every page is read."""
+    table = table or receipt_db
+    items = []
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return items
+        query_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def query_receipts_by_date(username: str, year: int, month: Optional[int] = None, day: Optional[int] = None, attributes: Optional[List[str]] = None) -> List[dict]:
+    """
+    Fetch a user's receipts for a year, month or day by receipt date from the period index.
+    A month or day is one partition; a year is its twelve month partitions.
+    """
+    projection_kwargs = {}
+    if attributes:
+        projection_expression, projection_names = projection(attributes)
+        projection_kwargs = {"ProjectionExpression": projection_expression, "ExpressionAttributeNames": projection_names}
+
+    items = []
+    for period_month in [month] if month else range(1, 13):
+        key_expr = Key("receipt_period").eq(f"{username}#{year:04d}#{period_month:02d}")
+        if month and day:
+            key_expr = key_expr & Key("receipt_date_key").begins_with(f"{year:04d}-{month:02d}-{day:02d}#")
+        items.extend(query_all(IndexName=RECEIPT_PERIOD_INDEX, KeyConditionExpression=key_expr, **projection_kwargs))
+    return items
+
+
+def ocr_s3_key(username: str, receipt_id: str) -> str:
+    # A fresh key per write, so a failed conditional write never clobbers the current data
+    return f"ocr/{username}/{receipt_id}/{uuid.uuid4().hex}.json.gz"
+
+
+def store_textract_data(s3_key: str, textract_data: dict):
+    body = gzip.compress(json.dumps(textract_data, separators=(",", ":")).encode("utf-8"))
+    receipt_bucket.put_object(Key=s3_key, Body=body, ContentType="application/json", ContentEncoding="gzip")
+
+
+def load_textract_data(s3_key: str) -> dict:
+    body = receipt_bucket.Object(s3_key).get()["Body"].read()
+    return json.loads(gzip.decompress(body))
+
+
+def receipt_textract_data(receipt_item: Union[dict, Receipt]) -> dict:
+    """Return a receipt's OCR data (from an item or a Receipt), loading it from S3 when it was offloaded."""
+    if isinstance(receipt_item, Receipt):
+        receipt_item = {"textract_s3_path": receipt_item.textract_s3_path, "textract_data": receipt_item.textract_data}
+    if receipt_item.get("textract_s3_path"):
+        return load_textract_data(receipt_item["textract_s3_path"])
+    return receipt_item.get("textract_data") or {}
+
+
+def receipt_ocr_attributes(
+    username: str,
+    receipt_id: str,
+    textract_data: dict,
+    expense_fields: Optional[Dict[str, str]] = None,
+    fallback_date: Optional[str] = None,
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Lay out a receipt's OCR data: the summary always stays in the item, the full map stays
+    inline up to OCR_INLINE_MAX_BYTES and is otherwise uploaded to S3 as gzipped JSON.
+    The date index keys come from the OCR'd receipt date, else from fallback_date.
+    Returns (attributes to set, attributes to remove) including the new item_size.
+    """
+    attributes = {"receipt_summary": build_receipt_summary(textract_data, expense_fields)}
+    receipt_date = parse_receipt_date(attributes["receipt_summary"].get("date")) or fallback_date
+    if receipt_date:
+        attributes.update(receipt_date_attributes(username, receipt_id, receipt_date))
+    if estimate_attribute_size(textract_data) > OCR_INLINE_MAX_BYTES:
+        attributes["textract_s3_path"] = ocr_s3_key(username, receipt_id)
+        store_textract_data(attributes["textract_s3_path"], textract_data)
+        removed = ["textract_data"]
+    else:
+        attributes["textract_data"] = textract_data
+        removed = ["textract_s3_path"]
+    attributes["item_size"] = RECEIPT_METADATA_SIZE + estimate_item_size(attributes)
+    return attributes, removed
+
+
+def replace_receipt_ocr(
+    username: str,
+    receipt_id: str,
+    textract_data: dict,
+    expected_version: Optional[int] = None,
+    receipt_status: Optional[str] = None,
+    fallback_date: Optional[str] = None,
+    expense_fields: Optional[Dict[str, str]] = None,
+    extra_attributes: Optional[Dict[str, Any]] = None,
+) -> int:
+    """
+    Replace a receipt's OCR data (and optionally its status) in one conditional write,
+    re-tiering it between inline and S3. Offloaded data is written to a new key first;
+    the previous object is deleted once the write succeeds, the new one if it fails.
+    Raises ClientError from the write. Returns the new receipt version.
+    """
+    attributes, removed = receipt_ocr_attributes(username, receipt_id, textract_data, expense_fields, fallback_date)
+    if receipt_status is not None:
+        attributes["receipt_status"] = receipt_status
+    attributes.update(extra_attributes or {})
+
+    condition, names, values = receipt_write_condition(expected_version)
+    set_parts = []
+    for index, (name, value) in enumerate(attributes.items()):
+        names[f"#a{index}"] = name
+        values[f":a{index}"] = value
+        set_parts.append(f"#a{index} = :a{index}")
+    remove_parts = []
+    for index, name in enumerate(removed):
+        names[f"#r{index}"] = name
+        remove_parts.append(f"#r{index}")
+    names["#version"] = "version"
+    values[":one"] = 1
+
+    try:
+        result = receipt_db.update_item(
+            Key={"receipt_username": username, "receipt_id": receipt_id},
+            UpdateExpression=f"SET {', '.join(set_parts)} REMOVE {', '.join(remove_parts)} ADD #version :one",
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_OLD",
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    except ClientError:
+        if attributes.get("textract_s3_path"):
+            delete_s3_objects([attributes["textract_s3_path"]])
+        raise
+
+    previous = result.get("Attributes", {})
+    if previous.get("textract_s3_path"):
+        delete_s3_objects([previous["textract_s3_path"]])
+    return int(previous.get("version", 0)) + 1
+
+
+def deserialize_item(raw_item: Optional[dict]) -> Optional[dict]:
+    """Convert a low-level DynamoDB item (e.g. from a ConditionalCheckFailed error) to Python values."""
+    if raw_item is None:
+        return None
+    return {name: _deserializer.deserialize(value) for name, value in raw_item.items()}
+
+
 def get_unique_filename(username: str, original_filename: str) -> str:
     """
-    Generate a unique filename by checking if it exists in the database.
+    Generate a unique filename by checking if it exists in the user's receipts.
     If it exists, append (1), (2), etc. until a unique name is found.
     """
     # Get the base name and extension
@@ -28,35 +334,351 @@ def get_unique_filename(username: str, original_filename: str) -> str:
     base_name = path_obj.stem  # filename without extension
     extension = path_obj.suffix  # extension with dot
 
-    # Check if the original filename exists for this user
-    response = receipt_db.scan(
-        FilterExpression="receipt_username = :username AND receipt_filename = :filename",
-        ExpressionAttributeValues={
-            ":username": username,
-            ":filename": original_filename,
-        },
-    )
+    # Read every filename the user has in one paginated query of their partition
+    projection_expression, projection_names = projection(["receipt_filename"])
+    existing = {
+        item.get("receipt_filename")
+        for item in query_all(
+            KeyConditionExpression=Key("receipt_username").eq(username),
+            ProjectionExpression=projection_expression,
+            ExpressionAttributeNames=projection_names,
+        )
+    }
 
-    if not response.get("Items"):
+    if original_filename not in existing:
         # Original filename doesn't exist, use it as is
         return original_filename
 
     # Original filename exists, find the next available number
     counter = 1
-    while True:
-        new_filename = f"{base_name}({counter}){extension}"
-
-        # Check if this new filename exists
-        response = receipt_db.scan(
-            FilterExpression="receipt_username = :username AND receipt_filename = :filename",
-            ExpressionAttributeValues={
-                ":username": username,
-                ":filename": new_filename,
-            },
-        )
+    while f"{base_name}({counter}){extension}" in existing:
+        counter += 1
+    return f"{base_name}({counter}){extension}"
 
-        if not response.get("Items"):
-            # This filename is available
-            return new_filename
 
-        counter += 1
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    """
+    Parse an If-Match header holding a receipt version ETag, e.g. '"3"'.
+    Returns None when the header is missing or "*", meaning no version check.
+    """
+    if not if_match or if_match.strip() == "*":
+        return None
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid If-Match header")
+
+
+def receipt_etag(version) -> str:
+    return f'"{int(version or 0)}"'
+
+
+def receipt_write_condition(expected_version: Optional[int] = None) -> Tuple[str, Dict[str, str], Dict[str, int]]:
+    """
+    Build the condition for a single-call write to an existing receipt.
+    The receipt must exist and, when expected_version is given, still be at that version.
+    Receipts written before versioning have no version attribute and count as version 0.
+    Returns (ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues).
+    """
+    condition = "attribute_exists(receipt_id)"
+    names = {}
+    values = {}
+    if expected_version is not None:
+        names["#version"] = "version"
+        if expected_version == 0:
+            condition += " AND attribute_not_exists(#version)"
+        else:
+            condition += " AND #version = :expected_version"
+            values[":expected_version"] = expected_version
+    return condition, names, values
+
+
+def conditional_write_error(error: ClientError, detail: str) -> HTTPException:
+    """
+    Map a failed receipt write to an HTTP error. A failed condition means 404 when the
+    receipt does not exist and 412 when it exists at another version; anything else is a 500.
+    Writes must pass ReturnValuesOnConditionCheckFailure="ALL_OLD" for the 412 case.
+    """
+    if error.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+        print(f"{detail}: {error}")
+        return HTTPException(status_code=500, detail=detail)
+    if error.response.get("Item"):
+        return HTTPException(status_code=412, detail="Receipt was modified by another request")
+    return HTTPException(status_code=404, detail="Receipt not found")
+
+
+def chunked(items: List, size: int) -> Iterator[List]:
+    """Yield successive slices of ``items`` holding at most ``size`` entries."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def projection(attributes: List[str]) -> Tuple[str, Dict[str, str]]:
+    """Build a ProjectionExpression with placeholder names, so reserved words are safe."""
+    names = {f"#p{index}": attribute for index, attribute in enumerate(attributes)}
+    return ", ".join(names), names
+
+
+class AdaptiveBackoff:
+    """
+    A delay shared by all workers of a scan or batch: doubled (from base_delay, up to max_delay)
+    on each throttling error and decayed on each successful page, so the work settles just
+    under the table's capacity instead of every worker retrying in lockstep.
+    """
+
+    def __init__(self, base_delay: float = 0.05, max_delay: float = 2.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def throttled(self):
+        with self._lock:
+            self.delay = min(self.max_delay, max(self.base_delay, self.delay * 2))
+
+    def succeeded(self):
+        with self._lock:
+            self.delay = self.delay * 0.5 if self.delay > self.base_delay / 2 else 0.0
+
+
+def batch_get_receipts(username: str, receipt_ids: List[str], attributes: Optional[List[str]] = None) -> Dict[str, dict]:
+    """
+    Fetch many receipts of one user with BatchGetItem, 100 keys per call, optionally
+    projected to the given attributes (receipt_id is always included).
+    Unprocessed keys are retried with a growing, jittered delay, at most
+    DYNAMO_BATCH_MAX_RETRIES times per chunk. Returns the found items keyed by receipt_id.
+    """
+    projection_kwargs = {}
+    if attributes:
+        projection_expression, projection_names = projection(["receipt_id"] + [a for a in attributes if a != "receipt_id"])
+        projection_kwargs = {"ProjectionExpression": projection_expression, "ExpressionAttributeNames": projection_names}
+
+    found = {}
+    backoff = AdaptiveBackoff()
+    for chunk in chunked(receipt_ids, DYNAMO_BATCH_GET_LIMIT):
+        request_items = {receipt_db.name: {"Keys": [{"receipt_username": username, "receipt_id": receipt_id} for receipt_id in chunk], **projection_kwargs}}
+        retries = 0
+        while True:
+            backoff.wait()
+            response = dynamo.batch_get_item(RequestItems=request_items)
+            for item in response.get("Responses", {}).get(receipt_db.name, []):
+                found[item["receipt_id"]] = item
+            request_items = response.get("UnprocessedKeys")
+            if not request_items:
+                backoff.succeeded()
+                break
+            if retries >= DYNAMO_BATCH_MAX_RETRIES:
+                raise RuntimeError(f"BatchGetItem left keys unprocessed after {retries} retries")
+            retries += 1
+            backoff.throttled()
+    return found
+
+
+def batch_update_status(username: str, receipt_ids: List[str], new_status: str) -> Dict[str, str]:
+    """
+    Set receipt_status on many receipts with TransactWriteItems, 25 updates per call.
+    Each update is conditional on the receipt existing, so missing IDs are reported
+    as "not_found" and the rest of their chunk is retried without them. A chunk cancelled
+    for any other reason (e.g. TransactionConflict) is reported as "failed" and the
+    remaining chunks still run, since earlier chunks are already committed.
+    """
+    client = receipt_db.meta.client
+    results = {}
+    for chunk in chunked(receipt_ids, DYNAMO_TRANSACT_WRITE_LIMIT):
+        pending = list(chunk)
+        while pending:
+            transact_items = [
+                {
+                    "Update": {
+                        "TableName": receipt_db.name,
+                        "Key": {"receipt_username": {"S": username}, "receipt_id": {"S": receipt_id}},
+                        "UpdateExpression": "SET receipt_status = :new_status ADD #version :one",
+                        "ConditionExpression": "attribute_exists(receipt_id)",
+                        "ExpressionAttributeNames": {"#version": "version"},
+                        "ExpressionAttributeValues": {":new_status": {"S": new_status}, ":one": {"N": "1"}},
+                    }
+                }
+                for receipt_id in pending
+            ]
+            try:
+                client.transact_write_items(TransactItems=transact_items)
+            except client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get("CancellationReasons", [])
+                missing = {receipt_id for receipt_id, reason in zip(pending, reasons) if reason.get("Code") == "ConditionalCheckFailed"}
+                if not missing:
+                    print(f"Error updating receipt statuses: {e}")
+                    results.update({receipt_id: "failed" for receipt_id in pending})
+                    break
+                results.update({receipt_id: "not_found" for receipt_id in missing})
+                pending = [receipt_id for receipt_id in pending if receipt_id not in missing]
+                continue
+            results.update({receipt_id: "updated" for receipt_id in pending})
+            pending = []
+    return results
+
+
+def delete_s3_objects(s3_keys: List[str]) -> Dict[str, str]:
+    """
+    Delete S3 objects with DeleteObjects, 1000 keys per call.
+    Returns the keys that could not be deleted mapped to the error message.
+    """
+    failed = {}
+    for chunk in chunked(s3_keys, S3_DELETE_OBJECTS_LIMIT):
+        try:
+            response = receipt_bucket.delete_objects(Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True})
+            for error in response.get("Errors", []):
+                failed[error.get("Key")] = error.get("Message", "")
+        except Exception as e:
+            print(f"Error deleting S3 objects: {e}")
+            failed.update({key: str(e) for key in chunk})
+    return failed
+
+
+def estimate_attribute_size(value: Any) -> int:
+    """Approximate the stored size of a DynamoDB attribute value in bytes."""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        return len(str(value).lstrip("-").replace(".", "")) // 2 + 2
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return 3 + sum(len(str(k).encode("utf-8")) + estimate_attribute_size(v) + 1 for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(estimate_attribute_size(v) + 1 for v in value)
+    return len(str(value).encode("utf-8"))
+
+
+def estimate_item_size(item: dict) -> int:
+    """Approximate the stored size of a DynamoDB item: attribute names plus values."""
+    return sum(len(name.encode("utf-8")) + estimate_attribute_size(value) for name, value in item.items())
+
+
+def normalize_receipt_patch(body: Any, content_type: str) -> ReceiptMergePatch:
+    """
+    Turn a PATCH body into a merge patch. JSON Patch (application/json-patch+json)
+    operations on /receipt_status and /textract_data/<field> are folded into the
+    equivalent merge patch; any other body is read as a merge patch.
+    """
+    if "json-patch" not in content_type:
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="Merge patch body must be a JSON object")
+        if "textract_data" in body and body["textract_data"] is None:
+            raise HTTPException(status_code=400, detail="textract_data cannot be removed")
+        try:
+            return ReceiptMergePatch.parse_obj(body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid merge patch: {e}")
+
+    if not isinstance(body, list):
+        raise HTTPException(status_code=400, detail="JSON Patch body must be a list of operations")
+
+    merge = ReceiptMergePatch()
+    textract_changes = {}
+    for raw_operation in body:
+        try:
+            operation = ReceiptPatchOperation.parse_obj(raw_operation)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid patch operation: {e}")
+
+        # JSON Pointer segments, unescaped per RFC 6901
+        segments = [segment.replace("~1", "/").replace("~0", "~") for segment in operation.path.split("/")[1:]]
+        if operation.op in ("add", "replace") and operation.value is not None:
+            value = operation.value
+        elif operation.op == "remove":
+            value = None
+        else:
+            raise HTTPException(status_code=400, detail=f"Unsupported patch operation: {operation.op} {operation.path}")
+
+        if segments == ["receipt_status"] and value is not None:
+            merge.receipt_status = value
+        elif len(segments) == 2 and segments[0] == "textract_data" and segments[1]:
+            textract_changes[segments[1]] = value
+        else:
+            raise HTTPException(status_code=400, detail=f"Unsupported patch path: {operation.path}")
+
+    if textract_changes:
+        merge.textract_data = textract_changes
+    return merge
+
+
+def compile_receipt_patch(patch: ReceiptMergePatch, username: Optional[str] = None, receipt_id: Optional[str] = None) -> Tuple[str, Dict[str, str], Dict[str, Any], int]:
+    """
+    Compile a merge patch into targeted SET/REMOVE clauses on textract_data fields
+    instead of replacing the whole map. Patched fields that feed the receipt_summary
+    update it too, and with username/receipt_id a new receipt date moves the receipt
+    in the date index. Returns (UpdateExpression clauses, ExpressionAttributeNames,
+    ExpressionAttributeValues, added_bytes), where added_bytes is an upper bound on
+    how much the patch can grow the item.
+    """
+    set_parts = []
+    remove_parts = []
+    names = {}
+    values = {}
+    added_bytes = 0
+
+    if patch.receipt_status is not None:
+        set_parts.append("#status = :status")
+        names["#status"] = "receipt_status"
+        values[":status"] = patch.receipt_status
+        added_bytes += estimate_attribute_size(patch.receipt_status)
+
+    summary_changes = {}
+    for index, (field, value) in enumerate((patch.textract_data or {}).items()):
+        names["#textract"] = "textract_data"
+        names[f"#f{index}"] = field
+        if value is None:
+            remove_parts.append(f"#textract.#f{index}")
+        else:
+            set_parts.append(f"#textract.#f{index} = :f{index}")
+            values[f":f{index}"] = value
+            added_bytes += len(field.encode("utf-8")) + estimate_attribute_size(value) + 1
+
+        summary_field = summary_field_for_label(field)
+        if summary_field:
+            summary_changes[summary_field] = None if value is None else summary_value(summary_field, value)
+
+    for summary_field, value in summary_changes.items():
+        names["#summary"] = "receipt_summary"
+        names[f"#s_{summary_field}"] = summary_field
+        if value is None:
+            remove_parts.append(f"#summary.#s_{summary_field}")
+        else:
+            set_parts.append(f"#summary.#s_{summary_field} = :s_{summary_field}")
+            values[f":s_{summary_field}"] = value
+            added_bytes += len(summary_field) + estimate_attribute_size(value) + 1
+
+    receipt_date = parse_receipt_date(summary_changes.get("date"))
+    if receipt_date and username and receipt_id:
+        for name, value in receipt_date_attributes(username, receipt_id, receipt_date).items():
+            names[f"#k_{name}"] = name
+            values[f":k_{name}"] = value
+            set_parts.append(f"#k_{name} = :k_{name}")
+            added_bytes += len(name) + estimate_attribute_size(value)
+
+    clauses = []
+    if set_parts:
+        clauses.append("SET " + ", ".join(set_parts))
+    if remove_parts:
+        clauses.append("REMOVE " + ", ".join(remove_parts))
+    return " ".join(clauses), names, values, added_bytes
+
+
+def apply_merge_patch(textract_data: dict, changes: Dict[str, Optional[str]]) -> dict:
+    merged = dict(textract_data)
+    for field, value in changes.items():
+        if value is None:
+            merged.pop(field, None)
+        else:
+            merged[field] = value
+    return merged
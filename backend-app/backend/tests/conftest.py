@@ -1,5 +1,6 @@
 import os
 import sys
+from types import SimpleNamespace
 
 import pytest
 from fastapi.testclient import TestClient
@@ -20,3 +21,37 @@ def client():
 def auth_headers():
     """Mock authentication headers for testing protected endpoints"""
     return {"Authorization": "Bearer test-token"}
+
+
+@pytest.fixture
+def local_aws(monkeypatch):
+    """
+    The src.local_aws stand-ins in place of the receipts table, the DynamoDB client and the
+    bucket, and a client authenticated as "alice" through a dependency override.
+    """
+    import src.config
+    import src.migrate_ocr
+    import src.ocr
+    import src.routers.receipts
+    import src.textract
+    import src.utils
+    from src.config import RECEIPT_PERIOD_INDEX, RECEIPT_PERIOD_INDEX_ATTRIBUTES, get_current_user
+    from src.duplicates import duplicate_index
+    from src.local_aws import FakeBucket, FakeDynamo, FakeTable
+
+    table = FakeTable("receipt_username", "receipt_id", indexes={RECEIPT_PERIOD_INDEX: ("receipt_period", "receipt_date_key")}, projections={RECEIPT_PERIOD_INDEX: RECEIPT_PERIOD_INDEX_ATTRIBUTES}, name="receipts")
+    dynamo = FakeDynamo(table)
+    bucket = FakeBucket("receipts")
+    for module in (src.config, src.utils, src.routers.receipts, src.textract, src.migrate_ocr):
+        monkeypatch.setattr(module, "receipt_db", table)
+    for module in (src.config, src.utils, src.routers.receipts, src.textract, src.ocr):
+        monkeypatch.setattr(module, "receipt_bucket", bucket)
+    for module in (src.config, src.utils):
+        monkeypatch.setattr(module, "dynamo", dynamo)
+    monkeypatch.setattr(duplicate_index, "_users", {})
+
+    app.dependency_overrides[get_current_user] = lambda: {"username": "alice"}
+    try:
+        yield SimpleNamespace(table=table, dynamo=dynamo, bucket=bucket, client=TestClient(app))
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
@@ -0,0 +1,104 @@
+import threading
+from decimal import Decimal
+
+import pytest
+
+from src import analytics
+from src.local_aws import FakeBucket
+
+pytest.importorskip("pyarrow")
+
+
+def receipt(username, receipt_id, date, total, vendor, category="Books", version=1):
+    return {
+        "receipt_username": username,
+        "receipt_id": receipt_id,
+        "version": Decimal(version),
+        "receipt_date": date,
+        "receipt_status": "approved",
+        "receipt_summary": {"total": Decimal(total), "vendor": vendor, "category": category},
+    }
+
+
+ITEMS = [
+    receipt("alice", "r1", "2023-12-30", "10.50", "Kedai Buku"),
+    receipt("alice", "r2", "2024-01-05", "20.00", "kedai  buku"),
+    receipt("bob", "r3", "2024-01-20", "5.25", "Farmasi", "Medical"),
+    receipt("bob", "r4", "2024-03-02", "100.00", "Farmasi", "Medical"),
+]
+
+
+def rows(items):
+    return [row for row in map(analytics.snapshot_row, items) if row]
+
+
+def test_export_rewrites_only_changed_years(tmp_path):
+    """Test that an export skips years whose receipts and versions are unchanged"""
+    store = analytics.LocalSnapshotStore(str(tmp_path))
+    stats = analytics.export_snapshot(store, rows=rows(ITEMS))
+    assert stats == {"rows": 4, "years_written": 2, "years_unchanged": 0, "years_removed": 0}
+    assert (tmp_path / "year=2024" / "receipts.parquet").exists()
+
+    changed = ITEMS[:3] + [receipt("bob", "r4", "2024-03-02", "90.00", "Farmasi", "Medical", version=2)]
+    stats = analytics.export_snapshot(store, rows=rows(changed))
+    assert stats["years_written"] == 1 and stats["years_unchanged"] == 1
+
+    stats = analytics.export_snapshot(store, rows=rows(changed[1:]))
+    assert stats["years_removed"] == 1
+    assert not (tmp_path / "year=2023").exists()
+
+
+def test_concurrent_local_exports_do_not_share_temp_files(tmp_path):
+    """Test that exports running at once each replace whole files"""
+    store = analytics.LocalSnapshotStore(str(tmp_path))
+    threads = [threading.Thread(target=analytics.export_snapshot, args=(store,), kwargs={"rows": rows(ITEMS)}) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["manifest.json", "year=2023", "year=2024"]
+    assert analytics.load_snapshot(store).num_rows == 4
+
+
+def test_snapshot_in_s3_is_shared_between_instances():
+    """Test that a snapshot exported to the bucket is what every instance loads"""
+    bucket = FakeBucket("receipts")
+    analytics.export_snapshot(analytics.S3SnapshotStore(bucket, "snapshots"), rows=rows(ITEMS))
+    assert sorted(bucket.stored) == ["snapshots/manifest.json", "snapshots/year=2023/receipts.parquet", "snapshots/year=2024/receipts.parquet"]
+
+    other_instance = analytics.S3SnapshotStore(bucket, "snapshots/")
+    assert analytics.read_manifest(other_instance)["years"]["2024"]["rows"] == 3
+    assert analytics.load_snapshot(other_instance).num_rows == 4
+
+    analytics.export_snapshot(other_instance, rows=rows(ITEMS[1:]))
+    assert "snapshots/year=2023/receipts.parquet" not in bucket.stored
+    assert analytics.load_snapshot(analytics.S3SnapshotStore(bucket, "snapshots")).num_rows == 3
+    assert analytics.load_snapshot(analytics.S3SnapshotStore(FakeBucket("empty"), "snapshots")) is None
+
+
+def test_spending_by_groups_across_users_and_years(tmp_path):
+    """Test spending aggregates by month, vendor and category"""
+    store = analytics.LocalSnapshotStore(str(tmp_path))
+    analytics.export_snapshot(store, rows=rows(ITEMS))
+    table = analytics.load_snapshot(store)
+    assert analytics.load_snapshot(store) is table
+
+    by_month = analytics.spending_by(table, "month")
+    assert by_month[0] == {"year": 2023, "month": 12, "total": 10.5, "num_receipts": 1}
+    assert {"year": 2024, "month": 1, "total": 25.25, "num_receipts": 2} in by_month
+
+    # Vendor names are normalised so OCR spacing and case differences group together
+    by_vendor = analytics.spending_by(table, "vendor", years=[2024])
+    assert by_vendor == [
+        {"year": 2024, "vendor": "FARMASI", "total": 105.25, "num_receipts": 2},
+        {"year": 2024, "vendor": "KEDAI BUKU", "total": 20.0, "num_receipts": 1},
+    ]
+
+    by_category = analytics.spending_by(table, "category", username="bob")
+    assert by_category == [{"year": 2024, "category": "Medical", "total": 105.25, "num_receipts": 2}]
+
+
+def test_admin_endpoints_require_auth(client):
+    """Test that admin analytics reject unauthenticated requests"""
+    assert client.get("/admin/analytics/spending").status_code == 401
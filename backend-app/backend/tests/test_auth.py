@@ -1,5 +1,9 @@
+import asyncio
+
+import pytest
 from fastapi.testclient import TestClient
 
+import src.config as config
 from main import app
 
 client = TestClient(app)
@@ -25,3 +29,33 @@ def test_auth_logout_endpoint():
         302,
         404,
     ]  # Adjust based on your implementation
+
+
+@pytest.mark.asyncio
+async def test_concurrent_refreshes_share_one_cognito_call(monkeypatch):
+    """Test that refreshes with the same token are coalesced and later ones reuse the result"""
+    calls = []
+    blacklisted = []
+
+    async def fake_generate_new_tokens(refresh_token):
+        calls.append(refresh_token)
+        await asyncio.sleep(0.05)
+        return "new-access", "new-refresh"
+
+    async def fake_blacklist_token(token, token_type="access"):
+        blacklisted.append(token)
+
+    async def fake_is_token_blacklisted(token, token_type=None):
+        return token in blacklisted
+
+    monkeypatch.setattr(config, "generate_new_tokens", fake_generate_new_tokens)
+    monkeypatch.setattr(config, "blacklist_token", fake_blacklist_token)
+    monkeypatch.setattr(config, "is_token_blacklisted", fake_is_token_blacklisted)
+    monkeypatch.setattr(config, "_refresh_results", {})
+
+    results = await asyncio.gather(*(config.refresh_tokens("old-refresh") for _ in range(5)))
+    # A tab arriving after the old token was blacklisted gets the same tokens
+    results.append(await config.refresh_tokens("old-refresh"))
+    assert results == [("new-access", "new-refresh", None)] * 6
+    assert calls == ["old-refresh"]
+    assert blacklisted == ["old-refresh"]
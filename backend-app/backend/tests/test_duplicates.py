@@ -0,0 +1,127 @@
+import io
+import random
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+
+import src.preprocessing as preprocessing
+import src.routers.receipts as receipts
+from src.duplicates import DuplicateIndex, MultiIndexHash, hamming_distance, image_dhash, ocr_fingerprint
+from src.local_aws import FakeTable
+from src.ocr import expense_response_from_lines, local_engine
+
+
+def make_receipt_photo(seed: int, size=(600, 1000), quality: int = 90) -> bytes:
+    """Draw a receipt-like layout of dark text bars on a light background"""
+    Image = pytest.importorskip("PIL.Image")
+    ImageDraw = pytest.importorskip("PIL.ImageDraw")
+    rng = random.Random(seed)
+    image = Image.new("L", (600, 1000), 235)
+    draw = ImageDraw.Draw(image)
+    for top in range(40, 960, 28):
+        left = rng.randint(20, 200)
+        draw.rectangle([left, top, left + rng.randint(60, 360), top + 12], fill=rng.randint(10, 90))
+    output = io.BytesIO()
+    image.resize(size).save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def test_multi_index_search_matches_brute_force():
+    """Test that multi-index hash searches find exactly the hashes within the distance"""
+    rng = random.Random(7)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    index = MultiIndexHash()
+    for position, value in enumerate(hashes):
+        index.add(value, position)
+
+    # Eight flipped bits, two in each chunk, is the worst case the chunk lookups must still find
+    for query in hashes[:20] + [hashes[0] ^ 0b1011, hashes[1] ^ 0x0003000300030003]:
+        expected = sorted(position for position, value in enumerate(hashes) if hamming_distance(query, value) <= 8)
+        assert sorted(position for _, position in index.search(query, 8)) == expected
+
+
+def test_image_hash_survives_rescaling_and_recompression():
+    """Test that a re-encoded smaller copy hashes close to the original and another receipt does not"""
+    original = image_dhash(make_receipt_photo(1))
+    resized = image_dhash(make_receipt_photo(1, size=(450, 750), quality=60))
+    other = image_dhash(make_receipt_photo(2))
+
+    assert hamming_distance(original, resized) <= 8
+    assert hamming_distance(original, other) > 8
+    assert image_dhash(b"%PDF-1.7") is None
+
+
+def test_ocr_fingerprint_normalises_vendor_date_and_total():
+    """Test that OCR differences in spacing, case and date format give the same fingerprint"""
+    assert ocr_fingerprint({"vendor": "Aeon Big ", "date": "01/03/2024", "total": Decimal("12.5")}) == "AEONBIG|2024-03-01|12.50"
+    assert ocr_fingerprint({"vendor": "AEON-BIG", "date": "2024-03-01", "total": Decimal("12.50")}) == "AEONBIG|2024-03-01|12.50"
+    assert ocr_fingerprint({"vendor": "AEON BIG", "total": Decimal("12.50")}) is None
+
+
+def test_duplicate_index_loads_user_hashes_and_skips_deleted_receipts():
+    """Test lookups by content, image hash and fingerprint against receipts loaded from the table"""
+    table = FakeTable("receipt_username", "receipt_id")
+    table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "content_sha256": "abc", "image_hash": f"{0xF0F0:016x}", "ocr_fingerprint": "SHOP|2024-03-01|12.50"})
+    table.put_item(Item={"receipt_username": "bob", "receipt_id": "r2", "content_sha256": "def"})
+    index = DuplicateIndex(max_distance=4, table=table)
+
+    assert index.find("alice", content_sha256="abc") == {"receipt_id": "r1", "match": "content"}
+    assert index.find("alice", image_hash=0xF0F3) == {"receipt_id": "r1", "match": "image", "distance": 2}
+    assert index.find("alice", image_hash=0x0F0F) is None
+    assert index.find("alice", fingerprint="SHOP|2024-03-01|12.50") == {"receipt_id": "r1", "match": "ocr"}
+    assert index.find("alice", content_sha256="def") is None
+
+    index.add("alice", "r3", content_sha256="ghi")
+    assert index.find("alice", content_sha256="ghi")["receipt_id"] == "r3"
+    index.remove("alice", "r1")
+    assert index.find("alice", content_sha256="abc", image_hash=0xF0F0) is None
+
+
+def test_only_content_matches_leave_uploads_out_of_total_claims(local_aws, monkeypatch):
+    """Test that image and fingerprint matches are hints that count towards totals until confirmed"""
+
+    async def fake_ocr(data, s3_key, policy=None):
+        return expense_response_from_lines([("Kedai Kopi Sri Maju", 99.0), ("Date: 01/03/2024", 99.0), ("TOTAL 12.50", 99.0)]), "local"
+
+    monkeypatch.setattr(receipts, "run_ocr", fake_ocr)
+    monkeypatch.setattr(local_engine, "available", lambda: True)
+
+    def upload(photo: bytes) -> dict:
+        response = local_aws.client.post("/receipts/upload", files={"file": ("receipt.jpg", io.BytesIO(photo), "image/jpeg")})
+        assert response.status_code == 200
+        return response.json()
+
+    original = upload(make_receipt_photo(1))
+    same_file = upload(make_receipt_photo(1))
+    reshot = upload(make_receipt_photo(1, quality=60))
+    same_purchase = upload(make_receipt_photo(2))
+
+    assert original["duplicate_of"] is None and original["possible_duplicate_of"] is None
+    assert same_file["duplicate_of"] == {"receipt_id": original["receipt_id"], "match": "content"} and same_file["possible_duplicate_of"] is None
+    assert reshot["duplicate_of"] is None and reshot["possible_duplicate_of"]["match"] == "image"
+    assert same_purchase["duplicate_of"] is None and same_purchase["possible_duplicate_of"] == {"receipt_id": original["receipt_id"], "match": "ocr"}
+
+    def totals() -> dict:
+        return local_aws.client.get("/receipts/total-claims", params={"year": 2024}).json()
+
+    assert totals() == {"year": 2024, "total_claims": 37.5, "num_receipts": 3, "num_duplicates_excluded": 1, "num_possible_duplicates": 2}
+
+    confirmed = local_aws.client.post(f"/receipts/duplicate/{reshot['receipt_id']}")
+    assert confirmed.status_code == 200 and confirmed.json()["duplicate_of"] == original["receipt_id"]
+    assert local_aws.client.post(f"/receipts/duplicate/{reshot['receipt_id']}").status_code == 409
+    assert local_aws.client.post("/receipts/duplicate/missing").status_code == 404
+    assert local_aws.client.delete(f"/receipts/duplicate/{same_purchase['receipt_id']}").status_code == 200
+    assert totals() == {"year": 2024, "total_claims": 25.0, "num_receipts": 2, "num_duplicates_excluded": 2, "num_possible_duplicates": 0}
+
+
+def test_oversized_images_are_refused_before_anything_is_stored(local_aws, monkeypatch):
+    """Test that an image over Pillow's pixel limit fails the duplicate check with 413, not 500"""
+    Image = pytest.importorskip("PIL.Image")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 10_000)
+    monkeypatch.setattr(preprocessing, "_executor", ThreadPoolExecutor(max_workers=1))
+
+    response = local_aws.client.post("/receipts/upload", files={"file": ("receipt.jpg", io.BytesIO(make_receipt_photo(1)), "image/jpeg")})
+
+    assert response.status_code == 413
+    assert local_aws.bucket.stored == {} and local_aws.table.items == {}
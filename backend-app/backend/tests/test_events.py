@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import src.events as events
+import src.routers.receipts as receipts
+from main import app
+from src.config import get_current_user
+from src.events import EventBroker, InMemoryBroker, Subscription, format_sse, publish_receipt_event, set_broker
+
+
+async def read_event_stream(path: str, until, on_chunk=None, headers=()) -> str:
+    """Run a GET to the app's event stream and disconnect once until(body) is true, or return when the stream ends."""
+    done = asyncio.Event()
+    body = ""
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal body
+        if message["type"] == "http.response.body":
+            body += message.get("body", b"").decode()
+            if on_chunk is not None:
+                on_chunk(body)
+            if until(body):
+                done.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), timeout=5)
+    return body
+
+
+@pytest.mark.asyncio
+async def test_events_reach_only_the_users_subscriptions():
+    """Test that events are delivered to the publishing user's streams only"""
+    broker = InMemoryBroker()
+    async with broker.subscribe("alice") as alice, broker.subscribe("bob") as bob:
+        broker.publish("alice", {"id": 1, "type": "status_changed"})
+        assert (await alice.get(timeout=1))["id"] == 1
+        assert await bob.get(timeout=0.01) is None
+    assert broker.subscriptions == {}
+
+
+@pytest.mark.asyncio
+async def test_publish_from_worker_thread():
+    """Test that events published off the event loop are still delivered"""
+    broker = InMemoryBroker()
+    async with broker.subscribe("alice") as subscription:
+        thread = threading.Thread(target=broker.publish, args=("alice", {"id": 2, "type": "ocr_completed"}))
+        thread.start()
+        thread.join()
+        assert (await subscription.get(timeout=1))["id"] == 2
+
+
+@pytest.mark.asyncio
+async def test_slow_subscription_drops_oldest_events():
+    """Test that a full queue keeps the newest events"""
+    broker = InMemoryBroker()
+    async with Subscription(broker, "alice", queue_size=2) as subscription:
+        for event_id in range(1, 4):
+            broker.publish("alice", {"id": event_id, "type": "receipt_updated"})
+        assert [(await subscription.get(timeout=1))["id"] for _ in range(2)] == [2, 3]
+
+
+@pytest.mark.asyncio
+async def test_subscriptions_work_with_other_brokers():
+    """Test that a broker implementing the EventBroker interface drives subscriptions"""
+
+    class ListBroker(EventBroker):
+        def __init__(self):
+            self.attached = []
+
+        def publish(self, username, event):
+            for subscription in self.attached:
+                if subscription.username == username:
+                    subscription.deliver(event)
+
+        def attach(self, subscription):
+            self.attached.append(subscription)
+
+        def detach(self, subscription):
+            self.attached.remove(subscription)
+
+    broker = ListBroker()
+    async with broker.subscribe("alice") as subscription:
+        broker.publish("alice", {"id": 4, "type": "receipt_updated"})
+        assert (await subscription.get(timeout=1))["id"] == 4
+    assert broker.attached == []
+
+    with pytest.raises(TypeError):
+        type("PublishOnly", (EventBroker,), {"publish": lambda self, username, event: None})()
+
+
+def test_format_sse():
+    """Test the Server-Sent Events wire format"""
+    message = format_sse({"id": 7, "type": "receipt_deleted", "receipt_id": "r1"})
+    assert message.startswith("id: 7\nevent: receipt_deleted\ndata: {")
+    assert message.endswith("\n\n")
+
+
+def test_events_endpoint_requires_auth(client):
+    """Test that the event stream rejects unauthenticated requests"""
+    assert client.get("/receipts/events").status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_events_endpoint_uses_the_installed_broker():
+    """Test that a broker installed with set_broker delivers events to /receipts/events"""
+    original = events.broker
+    set_broker(InMemoryBroker())
+    app.dependency_overrides[get_current_user] = lambda: {"username": "alice"}
+
+    def publish_once_subscribed(body):
+        if body == "retry: 5000\n\n":
+            publish_receipt_event("alice", "status_changed", "r1", receipt_status="approved")
+
+    try:
+        body = await read_event_stream("/receipts/events", lambda body: "event: status_changed" in body, publish_once_subscribed)
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+        set_broker(original)
+
+    assert '"receipt_id": "r1"' in body and '"receipt_status": "approved"' in body
+
+
+@pytest.mark.asyncio
+async def test_event_stream_ends_when_the_token_expires(monkeypatch):
+    """Test that the keepalive check closes a stream whose access token has expired"""
+    monkeypatch.setattr(receipts, "EVENT_KEEPALIVE_SECONDS", 0.02)
+    app.dependency_overrides[get_current_user] = lambda: {"username": "alice", "exp": time.time() + 0.1}
+    try:
+        body = await read_event_stream("/receipts/events", lambda body: False)
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+
+    assert body.startswith("retry: 5000\n\n") and ": keep-alive" in body
+
+
+@pytest.mark.asyncio
+async def test_event_stream_ends_after_logout(monkeypatch):
+    """Test that a stream closes once its token is blacklisted"""
+    checked = []
+
+    async def blacklisted(token, token_type=None):
+        checked.append(token)
+        return len(checked) > 1
+
+    monkeypatch.setattr(receipts, "EVENT_KEEPALIVE_SECONDS", 0.02)
+    monkeypatch.setattr(receipts, "is_token_blacklisted", blacklisted)
+    app.dependency_overrides[get_current_user] = lambda: {"username": "alice", "exp": time.time() + 3600}
+    try:
+        body = await read_event_stream("/receipts/events", lambda body: False, headers=[("Authorization", "Bearer access-token")])
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+
+    assert checked == ["access-token", "access-token"]
+    assert body.count(": keep-alive") == 1
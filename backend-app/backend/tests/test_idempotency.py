@@ -0,0 +1,113 @@
+import asyncio
+import io
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+import src.routers.receipts as receipts
+from main import app
+from src.config import get_current_user
+from src.idempotency import IdempotentRequests
+from src.local_aws import FakeTable
+
+
+def make_requests(table=None, **kwargs) -> IdempotentRequests:
+    return IdempotentRequests(table or FakeTable("idempotency_key"), ttl_seconds=3600, lock_seconds=60, poll_seconds=0.01, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_retries_get_the_stored_response_without_redoing_the_work():
+    """Test that a completed request is replayed and a reused key with another request is refused"""
+    requests = make_requests()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        return JSONResponse({"receipt_id": f"r{len(calls)}"})
+
+    first = await requests.run("alice", "key-1", "hash-a", work)
+    retry = await requests.run("alice", "key-1", "hash-a", work)
+    other_user = await requests.run("bob", "key-1", "hash-a", work)
+    with pytest.raises(HTTPException) as error:
+        await requests.run("alice", "key-1", "hash-b", work)
+
+    assert len(calls) == 2
+    assert retry.body == first.body and retry.headers["idempotent-replayed"] == "true"
+    assert "idempotent-replayed" not in first.headers
+    assert other_user.body == b'{"receipt_id":"r2"}'
+    assert error.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_concurrent_retries_attach_to_the_request_in_flight():
+    """Test that retries arriving mid-request share its response, in this process and another"""
+    table = FakeTable("idempotency_key")
+    requests, other_process = make_requests(table), make_requests(table, wait_seconds=5)
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return JSONResponse({"receipt_id": "r1"}, status_code=202)
+
+    responses = await asyncio.gather(*(requests.run("alice", "key-1", "hash-a", work) for _ in range(3)), other_process.run("alice", "key-1", "hash-a", work))
+    assert len(calls) == 1
+    assert {response.body for response in responses} == {b'{"receipt_id":"r1"}'}
+    assert [response.status_code for response in responses] == [202] * 4
+    assert sum("idempotent-replayed" in response.headers for response in responses) == 3
+
+
+@pytest.mark.asyncio
+async def test_in_progress_timeouts_failures_and_abandoned_claims():
+    """Test the 409 while another process holds the key, release on errors and takeover after the lock"""
+    table = FakeTable("idempotency_key")
+    requests = make_requests(table, wait_seconds=0.05)
+    assert requests.claim("alice#key-1", "hash-a", "other-process") is None
+
+    async def work():
+        return JSONResponse({"receipt_id": "r1"})
+
+    async def failing_work():
+        raise HTTPException(status_code=503, detail="Textract is not available")
+
+    with pytest.raises(HTTPException) as error:
+        await requests.run("alice", "key-1", "hash-a", work)
+    assert error.value.status_code == 409 and "Retry-After" in error.value.headers
+
+    # The other process died: its claim is taken over once the lock lapses
+    table.items[("alice#key-1",)]["locked_until"] = 0
+    assert (await requests.run("alice", "key-1", "hash-a", work)).body == b'{"receipt_id":"r1"}'
+
+    with pytest.raises(HTTPException):
+        await requests.run("alice", "key-2", "hash-a", failing_work)
+    assert ("alice#key-2",) not in table.items
+    assert (await requests.run("alice", "key-2", "hash-a", work)).status_code == 200
+
+
+def test_upload_endpoint_with_idempotency_key(monkeypatch):
+    """Test that a retried upload with the same Idempotency-Key is stored and OCR'd once"""
+    stored = []
+
+    async def fake_store_upload(background_tasks, user, filename, file_data, content_sha256, ocr_engine, on_duplicate):
+        stored.append(filename)
+        return JSONResponse({"receipt_id": f"r{len(stored)}", "stored_filename": filename})
+
+    monkeypatch.setattr(receipts, "store_upload", fake_store_upload)
+    monkeypatch.setattr(receipts, "idempotent_uploads", make_requests())
+    app.dependency_overrides[get_current_user] = lambda: {"username": "alice"}
+    try:
+        client = TestClient(app)
+
+        def upload(key):
+            return client.post("/receipts/upload", files={"file": ("receipt.jpg", io.BytesIO(b"jpeg"), "image/jpeg")}, headers={"Idempotency-Key": key})
+
+        first, retry = upload("abc"), upload("abc")
+        assert upload("x" * 256).status_code == 400
+    finally:
+        app.dependency_overrides.pop(get_current_user, None)
+
+    assert stored == ["receipt.jpg"]
+    assert retry.json() == first.json() == {"receipt_id": "r1", "stored_filename": "receipt.jpg"}
+    assert retry.headers["Idempotent-Replayed"] == "true"
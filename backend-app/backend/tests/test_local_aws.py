@@ -0,0 +1,92 @@
+import pytest
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from src.config import RECEIPT_PERIOD_INDEX_ATTRIBUTES
+from src.local_aws import FakeBucket, FakeDynamo, FakeTable
+from src.utils import RECEIPT_LIST_ATTRIBUTES, deserialize_item
+
+
+def make_table():
+    table = FakeTable("receipt_username", "receipt_id", name="receipts")
+    table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "version": 2, "receipt_summary": {"total": 10}, "textract_data": {"Vendor": "A"}})
+    return table
+
+
+def test_update_item_applies_string_expressions():
+    """Test SET on nested paths, REMOVE and ADD under a version condition"""
+    table = make_table()
+    result = table.update_item(
+        Key={"receipt_username": "alice", "receipt_id": "r1"},
+        UpdateExpression="SET #textract.#f0 = :v0, receipt_status = if_not_exists(receipt_status, :pending) REMOVE #summary.#total ADD #version :one, item_size :size",
+        ConditionExpression="attribute_exists(receipt_id) AND #version = :expected",
+        ExpressionAttributeNames={"#textract": "textract_data", "#f0": "TOTAL", "#summary": "receipt_summary", "#total": "total", "#version": "version"},
+        ExpressionAttributeValues={":v0": "12.00", ":pending": "pending", ":one": 1, ":size": 40, ":expected": 2},
+        ReturnValues="UPDATED_NEW",
+    )
+    assert result["Attributes"]["version"] == 3
+    item = table.get_item(Key={"receipt_username": "alice", "receipt_id": "r1"})["Item"]
+    assert item["textract_data"] == {"Vendor": "A", "TOTAL": "12.00"}
+    assert item["receipt_summary"] == {}
+    assert item["receipt_status"] == "pending" and item["item_size"] == 40
+
+
+def test_failed_conditions_return_the_current_item():
+    """Test that a failed condition raises ConditionalCheckFailedException with the typed item"""
+    table = make_table()
+    with pytest.raises(ClientError) as error:
+        table.delete_item(
+            Key={"receipt_username": "alice", "receipt_id": "r1"},
+            ConditionExpression="attribute_exists(receipt_id) AND #version = :expected",
+            ExpressionAttributeNames={"#version": "version"},
+            ExpressionAttributeValues={":expected": 1},
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        )
+    assert error.value.response["Error"]["Code"] == "ConditionalCheckFailedException"
+    assert deserialize_item(error.value.response["Item"])["version"] == 2
+
+    with pytest.raises(ClientError):
+        table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1"}, ConditionExpression="attribute_not_exists(receipt_id)")
+    assert table.query(KeyConditionExpression="receipt_username = :user", ExpressionAttributeValues={":user": "alice"})["Count"] == 1
+
+
+def test_transactions_and_bucket():
+    """Test that a transaction with a failed condition writes nothing, and S3 objects round-trip"""
+    table = make_table()
+    dynamo = FakeDynamo(table)
+    update = {
+        "TableName": "receipts",
+        "UpdateExpression": "SET receipt_status = :status",
+        "ConditionExpression": "attribute_exists(receipt_id)",
+        "ExpressionAttributeValues": {":status": {"S": "approved"}},
+    }
+    items = [{"Update": {**update, "Key": {"receipt_username": {"S": "alice"}, "receipt_id": {"S": receipt_id}}}} for receipt_id in ("r1", "missing")]
+    with pytest.raises(table.meta.client.exceptions.TransactionCanceledException) as error:
+        dynamo.transact_write_items(TransactItems=items)
+    assert [reason["Code"] for reason in error.value.response["CancellationReasons"]] == ["None", "ConditionalCheckFailed"]
+    assert "receipt_status" not in table.get_item(Key={"receipt_username": "alice", "receipt_id": "r1"})["Item"]
+    dynamo.transact_write_items(TransactItems=items[:1])
+    assert table.get_item(Key={"receipt_username": "alice", "receipt_id": "r1"})["Item"]["receipt_status"] == "approved"
+
+    bucket = FakeBucket()
+    bucket.put_object(Key="receipts/alice/a.jpg", Body=b"image")
+    assert bucket.Object("receipts/alice/a.jpg").get()["Body"].read() == b"image"
+    assert [summary.key for summary in bucket.objects.filter(Prefix="receipts/")] == ["receipts/alice/a.jpg"]
+    bucket.delete_objects(Delete={"Objects": [{"Key": "receipts/alice/a.jpg"}], "Quiet": True})
+    with pytest.raises(ClientError):
+        bucket.Object("receipts/alice/a.jpg").get()
+
+
+def test_index_queries_return_only_projected_attributes():
+    """Test that a query on an index with an INCLUDE projection cannot read other table attributes"""
+    table = FakeTable("receipt_username", "receipt_id", indexes={"by-period": ("receipt_period", "receipt_date_key")}, projections={"by-period": ["receipt_summary"]})
+    table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "receipt_period": "alice#2024#03", "receipt_date_key": "2024-03-01#r1", "receipt_summary": {"total": 10}, "duplicate_of": "r0"})
+
+    items = table.query(IndexName="by-period", KeyConditionExpression=Key("receipt_period").eq("alice#2024#03"), ProjectionExpression="receipt_id, receipt_summary, duplicate_of")["Items"]
+
+    assert items == [{"receipt_id": "r1", "receipt_summary": {"total": 10}}]
+
+
+def test_receipt_list_attributes_are_in_the_period_index():
+    """Test that every attribute read from the period index is projected into it"""
+    assert set(RECEIPT_LIST_ATTRIBUTES) <= {"receipt_username", "receipt_id", "receipt_period", "receipt_date_key", *RECEIPT_PERIOD_INDEX_ATTRIBUTES}
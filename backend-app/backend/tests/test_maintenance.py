@@ -0,0 +1,141 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import src.maintenance as maintenance
+from src import analytics
+from src.local_aws import FakeTable
+
+OLD = datetime.now(timezone.utc) - timedelta(days=2)
+
+
+class StubObjects:
+    def __init__(self, objects):
+        self.objects = objects
+        self.prefix = ""
+
+    def filter(self, Prefix):
+        self.prefix = Prefix
+        return self
+
+    def page_size(self, size):
+        return self
+
+    def pages(self):
+        matching = [o for o in self.objects if o.key.startswith(self.prefix)]
+        for start in range(0, len(matching), 2):
+            yield matching[start : start + 2]
+
+
+class StubReceiptTable:
+    def __init__(self, items):
+        self.items = items
+        self.queries = 0
+
+    def query(self, KeyConditionExpression, **kwargs):
+        self.queries += 1
+        username = KeyConditionExpression.get_expression()["values"][1]
+        return {"Items": [item for item in self.items if item["receipt_username"] == username], "ConsumedCapacity": {"CapacityUnits": 0.5}}
+
+
+def test_reconcile_s3_orphans_deletes_only_old_unreferenced_keys(monkeypatch):
+    """Test that referenced and recently written objects are kept"""
+    objects = [
+        SimpleNamespace(key="receipts/alice/a.jpg", last_modified=OLD),
+        SimpleNamespace(key="receipts/alice/orphan.jpg", last_modified=OLD),
+        SimpleNamespace(key="receipts/alice/uploading.jpg", last_modified=datetime.now(timezone.utc)),
+        SimpleNamespace(key="receipts/bob/b.jpg", last_modified=OLD),
+        SimpleNamespace(key="optimized/alice/r1.jpg", last_modified=OLD),
+        SimpleNamespace(key="ocr/bob/r2/old.json.gz", last_modified=OLD),
+    ]
+    table = StubReceiptTable(
+        [
+            {"receipt_username": "alice", "receipt_s3_path": "receipts/alice/a.jpg", "receipt_optimized_s3_path": "optimized/alice/r1.jpg"},
+            {"receipt_username": "bob", "receipt_s3_path": "receipts/bob/b.jpg", "textract_s3_path": "ocr/bob/r2/new.json.gz"},
+        ]
+    )
+    deleted = []
+    monkeypatch.setattr(maintenance, "receipt_bucket", SimpleNamespace(objects=StubObjects(objects)))
+    monkeypatch.setattr(maintenance, "receipt_db", table)
+    monkeypatch.setattr(maintenance, "delete_s3_objects", lambda keys: deleted.extend(keys) or {})
+    monkeypatch.setattr(maintenance, "MAINTENANCE_S3_REQUESTS_PER_SECOND", 0)
+
+    stats = maintenance.reconcile_s3_orphans()
+
+    assert deleted == ["receipts/alice/orphan.jpg", "ocr/bob/r2/old.json.gz"]
+    assert stats["listed"] == 6 and stats["recent"] == 1 and stats["deleted"] == 2
+    # References are loaded once per user and prefix, not per object
+    assert table.queries == 4
+
+
+def test_job_progress_stops_at_next_page():
+    """Test that a stop request cancels a job between pages"""
+    stop_event = threading.Event()
+    progress = maintenance.JobProgress("test", stop_event, report_every=3600)
+    progress.add(scanned=10)
+    stop_event.set()
+    with pytest.raises(maintenance.JobCancelled):
+        progress.add(scanned=10)
+    assert progress.counts == {"scanned": 20}
+
+
+def test_scheduler_runs_due_jobs_only():
+    """Test that jobs are due on first run and again after their interval"""
+    job = maintenance.MaintenanceJob("test", lambda dry_run, stop_event: {}, 60, lambda: True)
+    unavailable = maintenance.MaintenanceJob("missing", lambda dry_run, stop_event: {}, 60, lambda: False)
+    scheduler = maintenance.MaintenanceScheduler({"test": job, "missing": unavailable})
+
+    assert scheduler.due_jobs(1000.0) == [job]
+    job.last_started = 1000.0
+    assert scheduler.due_jobs(1030.0) == []
+    assert scheduler.seconds_until_next(1030.0) == 30
+    assert scheduler.due_jobs(1060.0) == [job]
+
+
+def snapshot_table(monkeypatch, tmp_path):
+    pytest.importorskip("pyarrow")
+    table = FakeTable("receipt_username", "receipt_id", page_bytes=300)
+    for index in range(12):
+        table.put_item(Item={"receipt_username": f"user{index % 3}", "receipt_id": f"r{index}", "version": 1, "receipt_date": f"202{index % 2 + 3}-03-01", "receipt_summary": {"total": 5}})
+    store = analytics.LocalSnapshotStore(str(tmp_path))
+    monkeypatch.setattr(analytics, "receipt_db", table)
+    monkeypatch.setattr(analytics, "default_store", lambda: store)
+    return table, store
+
+
+def test_refresh_snapshot_throttles_reads_and_reports_each_page(monkeypatch, tmp_path):
+    """Test that the snapshot export paces its scan and counts progress as pages arrive"""
+    snapshot_table(monkeypatch, tmp_path)
+    consumed, pages = [], []
+
+    class RecordingThrottle(maintenance.Throttle):
+        def consume(self, units):
+            consumed.append(units)
+
+    add = maintenance.JobProgress.add
+
+    def record_add(progress, **counts):
+        pages.append(counts)
+        add(progress, **counts)
+
+    monkeypatch.setattr(maintenance, "Throttle", RecordingThrottle)
+    monkeypatch.setattr(maintenance.JobProgress, "add", record_add)
+
+    result = maintenance.refresh_snapshot()
+
+    assert result == {"scanned": 12, "rows": 12, "years_written": 2, "years_unchanged": 0, "years_removed": 0}
+    assert len(consumed) > 1 and all(units > 0 for units in consumed)
+    assert len(pages) == len(consumed) + 1
+
+
+def test_refresh_snapshot_stops_before_exporting(monkeypatch, tmp_path):
+    """Test that a stop request cancels the export scan at the next page without writing a snapshot"""
+    _, store = snapshot_table(monkeypatch, tmp_path)
+    stop_event = threading.Event()
+    stop_event.set()
+
+    with pytest.raises(maintenance.JobCancelled):
+        maintenance.refresh_snapshot(stop_event=stop_event)
+    assert store.read(analytics.MANIFEST_FILE) is None
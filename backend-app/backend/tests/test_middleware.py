@@ -0,0 +1,170 @@
+import json
+import time
+
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import src.config as config
+from src.capture import TrafficRecorder
+from src.local_aws import FakeTable
+from src.middleware import AuthSessionMiddleware, CompressionMiddleware, TokenExpiryMiddleware, TrafficCaptureMiddleware, negotiate_encoding
+
+
+def make_app():
+    app = FastAPI()
+    app.add_middleware(AuthSessionMiddleware, secret_key="test-secret")
+
+    @app.get("/auth/login")
+    async def login(request: Request):
+        request.session["state"] = "abc"
+        return {"session": dict(request.session)}
+
+    @app.get("/receipts/view")
+    async def view(request: Request):
+        return {"has_session": "session" in request.scope}
+
+    return app
+
+
+def test_session_only_on_auth_routes():
+    """Test that the session is available under /auth and skipped elsewhere"""
+    client = TestClient(make_app())
+
+    response = client.get("/auth/login")
+    assert response.json() == {"session": {"state": "abc"}}
+    assert "session" in response.cookies
+
+    response = client.get("/receipts/view")
+    assert response.json() == {"has_session": False}
+    assert "set-cookie" not in response.headers
+
+
+def test_profile_is_decoded_once_per_token(monkeypatch):
+    """Test that /auth/me reuses the decoded id_token until it expires"""
+    token = jwt.encode({"sub": "alice", "email": "alice@example.com", "exp": int(time.time()) + 600}, "secret", algorithm="HS256")
+    decode_calls = []
+    real_decode = config.jwt.decode
+    monkeypatch.setattr(config.jwt, "decode", lambda *args, **kwargs: decode_calls.append(1) or real_decode(*args, **kwargs))
+
+    monkeypatch.setattr(config, "_profile_cache", config.OrderedDict())
+
+    app = FastAPI()
+
+    @app.get("/me")
+    async def me(user=Depends(config.get_current_user_profile)):
+        return user
+
+    client = TestClient(app)
+    for _ in range(3):
+        assert client.get("/me", cookies={"id_token": token}).json()["email"] == "alice@example.com"
+    assert len(decode_calls) == 1
+
+
+def test_token_expiry_header_on_authenticated_responses():
+    """Test that responses carry X-Token-Expires-In when the request was authenticated"""
+    app = FastAPI()
+    app.add_middleware(TokenExpiryMiddleware)
+
+    @app.get("/private")
+    async def private(request: Request):
+        request.state.token_expires_at = time.time() + 120
+        return {}
+
+    @app.get("/public")
+    async def public():
+        return {}
+
+    client = TestClient(app)
+    assert 110 <= int(client.get("/private").headers["X-Token-Expires-In"]) <= 120
+    assert "X-Token-Expires-In" not in client.get("/public").headers
+
+
+def make_compression_app():
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+    @app.get("/large")
+    async def large():
+        return [{"receipt_id": f"{index:08d}", "receipt_status": "approved"} for index in range(100)]
+
+    @app.get("/small")
+    async def small():
+        return {"status": "ok"}
+
+    @app.get("/events")
+    async def events():
+        return StreamingResponse(iter(["data: x\n\n"] * 200), media_type="text/event-stream")
+
+    return app
+
+
+def test_compression_above_threshold():
+    """Test that large JSON is gzipped with an exact length and small responses are left alone"""
+    client = TestClient(make_compression_app())
+
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert int(response.headers["content-length"]) < len(response.content)
+    assert len(response.json()) == 100
+
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+    response = client.get("/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+
+
+def test_event_stream_is_not_compressed():
+    """Test that Server-Sent Events pass through uncompressed"""
+    response = TestClient(make_compression_app()).get("/events", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+
+def test_negotiate_encoding():
+    """Test Accept-Encoding negotiation with q-values"""
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    assert negotiate_encoding("*") in ("br", "gzip")
+    assert negotiate_encoding("") is None
+
+
+def test_capture_records_sanitised_request_shapes(tmp_path):
+    """Test that captured requests keep routes, sizes and AWS calls but no identifiers"""
+    table = FakeTable("receipt_username", "receipt_id")
+    recorder = TrafficRecorder(str(tmp_path / "capture.jsonl"), "test-secret", user_buckets=8)
+    app = FastAPI()
+    app.add_middleware(TrafficCaptureMiddleware, recorder=recorder)
+
+    @app.post("/receipts/update/{receipt_id}")
+    async def update(receipt_id: str, data: dict, request: Request):
+        request.state.username = "alice@example.com"
+        table.get_item(Key={"receipt_username": "alice@example.com", "receipt_id": receipt_id})
+        table.get_item(Key={"receipt_username": "alice@example.com", "receipt_id": receipt_id})
+        return {"receipt_id": receipt_id}
+
+    receipt_id = "0b019a2a-e720-483f-80de-1848e262750a"
+    body = {
+        "receipt_id": receipt_id,
+        "new_status": "approved",
+        "textract_data": {"Vendor": "Kedai Buku Sri Maju", "TOTAL": "17.60", "vendor": "john.doe", "note": "ali-bin-abu", "phone": "0123456789", "items": 3},
+    }
+    TestClient(app).post(f"/receipts/update/{receipt_id}?year=2024&note=Alice&username=john.doe&phone=0123456789", json=body)
+    recorder.close()
+
+    line = (tmp_path / "capture.jsonl").read_text()
+    for identifying in (receipt_id, "alice", "Kedai", "john", "ali-bin-abu", "0123456789", "17.60"):
+        assert identifying.lower() not in line.lower()
+    entry = json.loads(line)
+    pseudonym = recorder.pseudonym(receipt_id)
+    assert entry["route"] == "/receipts/update/{receipt_id}"
+    assert entry["path_params"] == {"receipt_id": pseudonym}
+    assert entry["query"] == [["year", "2024"], ["note", recorder.pseudonym("Alice")], ["username", recorder.pseudonym("john.doe")], ["phone", recorder.pseudonym("0123456789")]]
+    assert entry["body"]["json"]["new_status"] == "approved" and entry["body"]["json"]["textract_data"]["items"] == 3
+    assert entry["body"]["json"]["textract_data"]["vendor"] == recorder.pseudonym("john.doe")
+    assert entry["body"]["json"] == recorder.sanitize(body)
+    assert entry["user"] == recorder.user_bucket("alice@example.com")
+    assert entry["request_bytes"] == len(json.dumps(body))
+    assert entry["status"] == 200 and entry["response_bytes"] > 0
+    assert entry["aws_calls"] == {"dynamodb.GetItem": 2}
@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+from src.migrate_ocr import migrate, needs_migration
+from src.utils import receipt_ocr_attributes, receipt_textract_data
+
+LARGE_OCR = {**{f"Item {index}": "x" * 40 for index in range(60)}, "TOTAL": "30.00"}
+
+
+def current_item(receipt_id: str, textract_data: dict) -> dict:
+    attributes, _ = receipt_ocr_attributes("alice", receipt_id, textract_data, fallback_date="2024-03-01")
+    return {"receipt_username": "alice", "receipt_id": receipt_id, "version": 1, **attributes}
+
+
+def test_needs_migration():
+    """Test that old-layout, oversized inline and stale date-keyed receipts are picked up"""
+    current = current_item("r1", {"TOTAL": "5.00"})
+    assert not needs_migration(current)
+    assert needs_migration({key: value for key, value in current.items() if key != "receipt_summary"})
+    assert needs_migration({**current, "receipt_date": "2024-05-01"})
+    assert needs_migration({**current, "textract_data": LARGE_OCR})
+
+
+def test_migrate_dry_run_then_run(local_aws):
+    """Test that a dry run only counts and a real run rewrites old receipts into the current layout"""
+    table, bucket = local_aws.table, local_aws.bucket
+    table.put_item(Item={"receipt_username": "alice", "receipt_id": "old-small", "version": 1, "receipt_upload_datetime": "2024-02-10T09:00:00", "textract_data": {"TOTAL": "5.00"}})
+    table.put_item(Item={"receipt_username": "alice", "receipt_id": "old-large", "version": 3, "receipt_upload_datetime": "2024-02-11T09:00:00", "textract_data": LARGE_OCR})
+    table.put_item(Item=current_item("current", {"TOTAL": "7.00"}))
+    before = {receipt_id: dict(table.get_item(Key={"receipt_username": "alice", "receipt_id": receipt_id})["Item"]) for receipt_id in ("old-small", "old-large", "current")}
+
+    assert migrate(dry_run=True, total_segments=2) == {"scanned": 3, "migrated": 2, "skipped_modified": 0, "failed": 0}
+    assert {receipt_id: table.get_item(Key={"receipt_username": "alice", "receipt_id": receipt_id})["Item"] for receipt_id in before} == before
+    assert bucket.stored == {}
+
+    assert migrate(total_segments=2) == {"scanned": 3, "migrated": 2, "skipped_modified": 0, "failed": 0}
+    small = table.get_item(Key={"receipt_username": "alice", "receipt_id": "old-small"})["Item"]
+    assert small["receipt_summary"] == {"total": Decimal("5.00")} and small["textract_data"] == {"TOTAL": "5.00"}
+    assert small["receipt_period"] == "alice#2024#02" and small["version"] == 2
+    large = table.get_item(Key={"receipt_username": "alice", "receipt_id": "old-large"})["Item"]
+    assert "textract_data" not in large and large["version"] == 4
+    assert list(bucket.stored) == [large["textract_s3_path"]] and receipt_textract_data(large) == LARGE_OCR
+    assert table.get_item(Key={"receipt_username": "alice", "receipt_id": "current"})["Item"] == before["current"]
+
+    assert migrate(total_segments=2)["migrated"] == 0
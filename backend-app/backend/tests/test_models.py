@@ -0,0 +1,53 @@
+from decimal import Decimal
+
+from src.models.receipts import Receipt, ReceiptSummary
+
+ITEM = {
+    "receipt_username": "alice",
+    "receipt_id": "r1",
+    "receipt_filename": "lunch.jpg",
+    "receipt_status": "pending",
+    "receipt_upload_datetime": "2024-03-02T10:00:00",
+    "receipt_size": Decimal("2048"),
+    "receipt_date": "2024-03-01",
+    "receipt_summary": {"total": Decimal("12.50"), "vendor": "SHOP"},
+    "version": Decimal("3"),
+    "receipt_s3_path": "receipts/alice/lunch.jpg",
+    "textract_s3_path": "ocr/alice/r1/a.json.gz",
+    "ocr_confidence": Decimal("91.5"),
+    "legacy_flag": True,
+}
+
+
+def test_receipt_round_trips_dynamodb_items():
+    """Test that from_item converts numbers and to_item gives the item back, unknown attributes included"""
+    receipt = Receipt.from_item(ITEM)
+    assert receipt.version == 3 and receipt.receipt_size == 2048
+    assert receipt.receipt_summary == ReceiptSummary(total=Decimal("12.50"), vendor="SHOP")
+    assert receipt.extra == {"legacy_flag": True}
+    assert receipt.to_item() == ITEM
+
+
+def test_receipt_helpers():
+    """Test the total, S3 keys and list row of a receipt"""
+    receipt = Receipt.from_item(ITEM)
+    assert receipt.total == Decimal("12.50")
+    assert receipt.s3_keys == ["receipts/alice/lunch.jpg", "ocr/alice/r1/a.json.gz"]
+    assert receipt.list_row() == {
+        "receipt_id": "r1",
+        "receipt_filename": "lunch.jpg",
+        "receipt_status": "pending",
+        "receipt_upload_datetime": "2024-03-02T10:00:00",
+        "receipt_size": 2048,
+        "receipt_date": "2024-03-01",
+        "receipt_summary": {"total": Decimal("12.50"), "vendor": "SHOP"},
+        "version": 3,
+    }
+
+
+def test_projected_receipt():
+    """Test that items read with a projection leave the other fields empty"""
+    receipt = Receipt.from_item({"receipt_id": "r2"})
+    assert receipt.receipt_username is None and receipt.extra is None
+    assert receipt.total == 0 and receipt.s3_keys == []
+    assert receipt.list_row() == {"receipt_id": "r2", "version": 0}
@@ -0,0 +1,130 @@
+import io
+
+import pytest
+from fastapi import HTTPException
+
+import src.ocr as ocr
+from src.utils import parse_textract_expense, parse_textract_expense_fields
+
+RECEIPT_LINES = [
+    ("KEDAI BUKU SRI MAJU", 95.0),
+    ("DATE: 14/03/2024 TIME: 13:45", 91.0),
+    ("Cashier: Ali", 90.0),
+    ("SUBTOTAL 16.60", 93.0),
+    ("SST 6% 1.00", 88.0),
+    ("TOTAL: RM 17.60", 96.0),
+]
+
+
+class StubEngine(ocr.OcrEngine):
+    def __init__(self, name, response, is_available=True):
+        self.name = name
+        self.response = response
+        self.is_available = is_available
+        self.calls = 0
+
+    def available(self):
+        return self.is_available
+
+    async def analyze(self, data, s3_key):
+        self.calls += 1
+        return self.response
+
+
+def test_expense_response_from_lines_matches_textract_shape():
+    """Test that local OCR lines parse into the same fields as a Textract response"""
+    response = ocr.expense_response_from_lines(RECEIPT_LINES)
+
+    fields = parse_textract_expense_fields(response)
+    assert fields["VENDOR_NAME"] == "KEDAI BUKU SRI MAJU"
+    assert fields["INVOICE_RECEIPT_DATE"] == "14/03/2024"
+    assert (fields["SUBTOTAL"], fields["TAX"], fields["TOTAL"]) == ("16.60", "1.00", "17.60")
+    assert parse_textract_expense(response)["Cashier"] == "Ali"
+    assert ocr.has_total(response)
+
+
+def test_engines_must_implement_the_interface():
+    """Test that an engine missing analyze cannot be created"""
+
+    class AvailableOnly(ocr.OcrEngine):
+        def available(self):
+            return True
+
+    with pytest.raises(TypeError):
+        AvailableOnly()
+
+
+def test_tesseract_is_looked_up_once_per_process(monkeypatch):
+    """Test that available() does not spawn tesseract --version on every upload"""
+    lookups = []
+    engine = ocr.TesseractEngine()
+    monkeypatch.setattr(engine, "_find_tesseract", lambda: lookups.append(1) or True)
+
+    assert engine.available() and engine.available()
+    assert len(lookups) == 1
+
+
+@pytest.fixture
+def engines(monkeypatch):
+    """Swap the module's engines for stubs"""
+    local = StubEngine("local", ocr.expense_response_from_lines([("SHOP", 40.0), ("TOTAL 5.00", 40.0)]))
+    textract = StubEngine("textract", ocr.expense_response_from_lines(RECEIPT_LINES))
+    monkeypatch.setattr(ocr, "local_engine", local)
+    monkeypatch.setattr(ocr, "textract_engine", textract)
+    return local, textract
+
+
+@pytest.mark.asyncio
+async def test_local_first_falls_back_on_low_confidence(engines):
+    """Test that local_first calls Textract only when local OCR is not confident"""
+    local, textract = engines
+    _, used = await ocr.run_ocr(b"", "key", "local_first")
+    assert used == "textract"
+    assert local.calls == 1 and textract.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_textract_policy_uses_local_when_textract_missing(engines):
+    """Test that uploads still get OCR when Textract is not configured"""
+    local, textract = engines
+    textract.is_available = False
+    _, used = await ocr.run_ocr(b"", "key", "textract")
+    assert used == "local"
+
+
+@pytest.mark.asyncio
+async def test_local_policy_never_calls_textract(engines):
+    """Test that the local policy fails instead of calling Textract"""
+    local, textract = engines
+    local.is_available = False
+    with pytest.raises(ocr.HTTPException) as exc_info:
+        await ocr.run_ocr(b"", "key", "local")
+    assert exc_info.value.status_code == 503
+    assert textract.calls == 0
+
+
+def test_uploads_without_ocr_are_refused_before_storing(local_aws, engines):
+    """Test that an upload OCR cannot run for leaves no object in the bucket"""
+    local, textract = engines
+    local.is_available = textract.is_available = False
+
+    image = local_aws.client.post("/receipts/upload", files={"file": ("receipt.jpg", io.BytesIO(b"\xff\xd8\xff\xe0 jpeg"), "image/jpeg")})
+    pdf = local_aws.client.post("/receipts/upload", files={"file": ("receipt.pdf", io.BytesIO(b"%PDF-1.7 receipt"), "application/pdf")})
+
+    assert image.status_code == 503 and pdf.status_code == 503
+    assert local_aws.bucket.stored == {} and local_aws.table.items == {}
+
+
+def test_failed_ocr_removes_the_stored_copies(local_aws, engines, monkeypatch):
+    """Test that the original and OCR copy are deleted when OCR fails after they were stored"""
+    local, textract = engines
+
+    async def throttled(data, s3_key):
+        raise HTTPException(status_code=503, detail="Textract is throttling requests")
+
+    monkeypatch.setattr(textract, "analyze", throttled)
+    response = local_aws.client.post("/receipts/upload", params={"ocr_engine": "textract"}, files={"file": ("receipt.jpg", io.BytesIO(b"\xff\xd8\xff\xe0 jpeg"), "image/jpeg")})
+
+    assert response.status_code == 503
+    assert local_aws.bucket.calls["put_object"] == 1 and local_aws.bucket.calls["delete_objects"] == 1
+    assert local_aws.bucket.stored == {} and local_aws.table.items == {}
@@ -0,0 +1,68 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi import HTTPException
+
+import src.preprocessing as preprocessing
+from src.preprocessing import ImageTooLargeError, preprocess_image, preprocess_upload
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_photo(width: int, height: int, orientation: int = 1) -> bytes:
+    """Create a noisy RGB JPEG with an EXIF orientation, like a phone photo"""
+    image = Image.effect_noise((width, height), 60).convert("RGB")
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=95, exif=exif)
+    return output.getvalue()
+
+
+def test_preprocess_image_orients_downscales_and_strips_metadata():
+    """Test that photos are rotated upright, downscaled, grayscale and without EXIF"""
+    original = make_photo(3000, 2000, orientation=6)
+    optimized, content_type = preprocess_image(original, max_dimension=1000)
+
+    assert content_type == "image/jpeg"
+    assert len(optimized) < len(original)
+    with Image.open(io.BytesIO(optimized)) as image:
+        # Orientation 6 is a 90 degree rotation, so portrait after transposing
+        assert image.size == (667, 1000)
+        assert image.mode == "L"
+        assert not image.getexif()
+
+
+def test_preprocess_image_skips_non_images():
+    """Test that PDFs and other non-images are left alone"""
+    assert preprocess_image(b"%PDF-1.7 not an image") is None
+
+
+@pytest.mark.asyncio
+async def test_decompression_bombs_are_refused_with_413(monkeypatch):
+    """Test that an image over Pillow's pixel limit is a client error, not a 500"""
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    monkeypatch.setattr(preprocessing, "_executor", ThreadPoolExecutor(max_workers=1))
+    photo = make_photo(100, 100)
+
+    with pytest.raises(ImageTooLargeError):
+        preprocess_image(photo)
+    with pytest.raises(HTTPException) as error:
+        await preprocess_upload(photo)
+    assert error.value.status_code == 413
+
+
+def test_executor_falls_back_to_threads_without_process_support(monkeypatch):
+    """Test that image work still runs where worker processes cannot be started, as on Lambda"""
+
+    def no_semaphores(**kwargs):
+        raise OSError(38, "Function not implemented")
+
+    monkeypatch.setattr(preprocessing, "_executor", None)
+    monkeypatch.setattr(preprocessing, "ProcessPoolExecutor", no_semaphores)
+    executor = preprocessing.get_executor()
+
+    assert isinstance(executor, ThreadPoolExecutor)
+    assert executor.submit(preprocess_image, b"not an image").result() is None
+    executor.shutdown()
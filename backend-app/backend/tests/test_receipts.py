@@ -1,6 +1,13 @@
+import json
+from decimal import Decimal
+
 from fastapi.testclient import TestClient
 
+import src.routers.receipts as receipts
 from main import app
+from src.local_aws import TransactionCanceledException
+from src.models.receipts import BATCH_RECEIPT_LIMIT
+from src.utils import receipt_ocr_attributes, receipt_textract_data
 
 client = TestClient(app)
 
@@ -14,3 +21,306 @@ def test_receipts_endpoint():
         401,
         404,
     ]  # Adjust based on your implementation
+
+
+def test_batch_endpoints_require_auth():
+    """Test that batch receipt endpoints reject unauthenticated requests"""
+    response = client.post("/receipts/status/batch", json={"receipt_ids": ["a"], "new_status": "approved"})
+    assert response.status_code == 401
+
+    response = client.post("/receipts/delete/batch", json={"receipt_ids": ["a"]})
+    assert response.status_code == 401
+
+
+def put_receipt(table, bucket, receipt_id, **attributes):
+    s3_key = f"alice/{receipt_id}.jpg"
+    bucket.put_object(Key=s3_key, Body=b"image")
+    table.put_item(Item={"receipt_username": "alice", "receipt_id": receipt_id, "receipt_status": "pending", "receipt_filename": f"{receipt_id}.jpg", "receipt_s3_path": s3_key, "version": 1, **attributes})
+    return s3_key
+
+
+def stored_receipt(table, receipt_id):
+    return table.get_item(Key={"receipt_username": "alice", "receipt_id": receipt_id}).get("Item")
+
+
+def test_batch_endpoints_limit_receipt_ids(local_aws):
+    """Test that batch requests with too many receipt IDs are rejected before touching DynamoDB"""
+    receipt_ids = [f"r{i}" for i in range(BATCH_RECEIPT_LIMIT + 1)]
+    response = local_aws.client.post("/receipts/status/batch", json={"receipt_ids": receipt_ids, "new_status": "approved"})
+    assert response.status_code == 422
+
+    response = local_aws.client.post("/receipts/delete/batch", json={"receipt_ids": receipt_ids})
+    assert response.status_code == 422
+    assert local_aws.dynamo.calls == {}
+
+
+def test_batch_status_reports_missing_receipts(local_aws):
+    """Test that a batch status update applies to the existing receipts and reports the missing ones"""
+    put_receipt(local_aws.table, local_aws.bucket, "r1")
+    put_receipt(local_aws.table, local_aws.bucket, "r2")
+
+    response = local_aws.client.post("/receipts/status/batch", json={"receipt_ids": ["r1", "missing", "r2", "r1"], "new_status": "approved"})
+
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"receipt_id": "r1", "result": "updated"},
+        {"receipt_id": "missing", "result": "not_found"},
+        {"receipt_id": "r2", "result": "updated"},
+    ]
+    for receipt_id in ("r1", "r2"):
+        item = stored_receipt(local_aws.table, receipt_id)
+        assert item["receipt_status"] == "approved"
+        assert item["version"] == 2
+    assert stored_receipt(local_aws.table, "missing") is None
+
+
+def test_batch_status_reports_cancelled_chunks_as_failed(local_aws, monkeypatch):
+    """Test that a chunk cancelled for another reason is reported failed while committed chunks keep their results and events"""
+    receipt_ids = [f"r{index:02d}" for index in range(30)]
+    for receipt_id in receipt_ids:
+        put_receipt(local_aws.table, local_aws.bucket, receipt_id)
+    transact_write_items = local_aws.dynamo.transact_write_items
+
+    def conflict_on_second_chunk(TransactItems):
+        if local_aws.dynamo.calls.get("transact_write_items", 0) == 0:
+            return transact_write_items(TransactItems=TransactItems)
+        reasons = [{"Code": "TransactionConflict", "Message": "Transaction is ongoing for the item"} for _ in TransactItems]
+        raise TransactionCanceledException({"Error": {"Code": "TransactionCanceledException", "Message": "Transaction cancelled"}, "CancellationReasons": reasons}, "TransactWriteItems")
+
+    events = []
+    monkeypatch.setattr(local_aws.dynamo, "transact_write_items", conflict_on_second_chunk)
+    monkeypatch.setattr(receipts, "publish_receipt_event", lambda username, event_type, receipt_id, **fields: events.append(receipt_id))
+
+    response = local_aws.client.post("/receipts/status/batch", json={"receipt_ids": receipt_ids, "new_status": "approved"})
+
+    assert response.status_code == 200
+    results = {result["receipt_id"]: result["result"] for result in response.json()["results"]}
+    assert results == {**{receipt_id: "updated" for receipt_id in receipt_ids[:25]}, **{receipt_id: "failed" for receipt_id in receipt_ids[25:]}}
+    assert events == receipt_ids[:25]
+    assert stored_receipt(local_aws.table, "r24")["receipt_status"] == "approved"
+    assert stored_receipt(local_aws.table, "r25")["receipt_status"] == "pending"
+
+
+def test_batch_delete_reports_failed_s3_deletes(local_aws, monkeypatch):
+    """Test that a batch delete removes every found record and reports the S3 objects that could not be deleted"""
+    failed_key = put_receipt(local_aws.table, local_aws.bucket, "r1")
+    deleted_key = put_receipt(local_aws.table, local_aws.bucket, "r2")
+    delete_objects = local_aws.bucket.delete_objects
+
+    def delete_objects_except_failed(Delete):
+        objects = [entry for entry in Delete["Objects"] if entry["Key"] != failed_key]
+        delete_objects(Delete={**Delete, "Objects": objects})
+        return {"Errors": [{"Key": failed_key, "Code": "AccessDenied", "Message": "Access Denied"}]}
+
+    monkeypatch.setattr(local_aws.bucket, "delete_objects", delete_objects_except_failed)
+
+    response = local_aws.client.post("/receipts/delete/batch", json={"receipt_ids": ["r1", "missing", "r2"]})
+
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"receipt_id": "r1", "result": "deleted", "deleted_filename": "r1.jpg", "s3_deletion_status": "failed"},
+        {"receipt_id": "missing", "result": "not_found"},
+        {"receipt_id": "r2", "result": "deleted", "deleted_filename": "r2.jpg", "s3_deletion_status": "completed"},
+    ]
+    assert stored_receipt(local_aws.table, "r1") is None
+    assert stored_receipt(local_aws.table, "r2") is None
+    assert failed_key in local_aws.bucket.stored
+    assert deleted_key not in local_aws.bucket.stored
+
+
+def test_batch_delete_s3_unavailable(local_aws, monkeypatch):
+    """Test that records are still deleted when the S3 delete call itself fails"""
+    put_receipt(local_aws.table, local_aws.bucket, "r1")
+
+    def unavailable(Delete):
+        raise ConnectionError("S3 unavailable")
+
+    monkeypatch.setattr(local_aws.bucket, "delete_objects", unavailable)
+
+    response = local_aws.client.post("/receipts/delete/batch", json={"receipt_ids": ["r1"]})
+
+    assert response.status_code == 200
+    assert response.json()["results"][0]["s3_deletion_status"] == "failed"
+    assert stored_receipt(local_aws.table, "r1") is None
+
+
+def test_view_receipt_loads_offloaded_ocr_data(local_aws):
+    """Test that a receipt's OCR data is read from S3 when it was offloaded, with the version as ETag"""
+    textract_data = {**{f"Item {index}": "x" * 40 for index in range(60)}, "TOTAL": "30.00"}
+    attributes, _ = receipt_ocr_attributes("alice", "r1", textract_data)
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "receipt_filename": "r1.jpg", "version": 3, **attributes})
+
+    response = local_aws.client.get("/receipts/view/r1")
+
+    assert response.status_code == 200
+    assert response.json()["textract_data"] == textract_data
+    assert response.json()["receipt_summary"]["total"] == 30.0
+    assert response.headers["ETag"] == '"3"'
+
+
+def put_dated_receipt(table, username, receipt_id, receipt_date, total="10.00"):
+    attributes, _ = receipt_ocr_attributes(username, receipt_id, {"TOTAL": total, "DATE": receipt_date})
+    table.put_item(Item={"receipt_username": username, "receipt_id": receipt_id, "receipt_filename": f"{receipt_id}.jpg", "receipt_status": "pending", "version": 1, **attributes})
+
+
+def viewed_ids(local_aws, **params):
+    response = local_aws.client.get("/receipts/view", params=params)
+    assert response.status_code == 200
+    return [row["receipt_id"] for row in response.json()]
+
+
+def test_view_receipts_by_year_month_and_day(local_aws):
+    """Test that dated listings read only the user's matching date index partitions, newest first"""
+    for receipt_id, receipt_date in [("dec", "2023-12-31"), ("jan", "2024-01-05"), ("mar1", "2024-03-01"), ("mar10", "2024-03-10"), ("dec24", "2024-12-20")]:
+        put_dated_receipt(local_aws.table, "alice", receipt_id, receipt_date)
+    put_dated_receipt(local_aws.table, "bob", "bob-mar", "2024-03-01")
+
+    assert viewed_ids(local_aws, year=2024) == ["dec24", "mar10", "mar1", "jan"]
+    assert viewed_ids(local_aws, year=2024, month=3) == ["mar10", "mar1"]
+    assert viewed_ids(local_aws, year=2024, month=3, day=1) == ["mar1"]
+    assert viewed_ids(local_aws, year=2024, month=2) == []
+    assert viewed_ids(local_aws) == ["dec24", "mar10", "mar1", "jan", "dec"]
+
+    rows = local_aws.client.get("/receipts/view", params={"year": 2024, "month": 1}).json()
+    assert rows == [{"receipt_id": "jan", "receipt_filename": "jan.jpg", "receipt_status": "pending", "receipt_date": "2024-01-05", "receipt_summary": {"total": 10.0, "date": "2024-01-05"}, "version": 1}]
+
+
+def test_view_receipts_rejects_month_without_year(local_aws):
+    """Test that a month needs a year and a day needs a month"""
+    assert local_aws.client.get("/receipts/view", params={"month": 3}).status_code == 400
+    assert local_aws.client.get("/receipts/view", params={"year": 2024, "day": 1}).status_code == 400
+    assert local_aws.dynamo.calls == {} and local_aws.table.calls == {}
+
+
+def test_changed_receipt_date_moves_the_receipt_between_periods(local_aws):
+    """Test that new OCR data with another date moves the date index keys with it"""
+    put_dated_receipt(local_aws.table, "alice", "r1", "2024-03-01")
+
+    response = local_aws.client.put("/receipts/update/r1", json={"textract_data": {"TOTAL": "10.00", "DATE": "2024-05-15"}})
+
+    assert response.status_code == 200
+    assert viewed_ids(local_aws, year=2024, month=3) == []
+    assert viewed_ids(local_aws, year=2024, month=5, day=15) == ["r1"]
+    item = local_aws.table.get_item(Key={"receipt_username": "alice", "receipt_id": "r1"})["Item"]
+    assert item["receipt_period"] == "alice#2024#05" and item["receipt_date_key"] == "2024-05-15#r1"
+
+
+LARGE_OCR = {**{f"Item {index}": "x" * 40 for index in range(60)}, "TOTAL": "30.00", "DATE": "2024-03-01"}
+
+
+def patch_receipt(local_aws, receipt_id, body, if_match=None):
+    headers = {"Content-Type": "application/merge-patch+json"}
+    if if_match is not None:
+        headers["If-Match"] = if_match
+    return local_aws.client.patch(f"/receipts/update/{receipt_id}", content=json.dumps(body), headers=headers)
+
+
+def test_patch_writes_only_the_changed_fields(local_aws):
+    """Test that a patch of an inline receipt is one targeted write that returns the new ETag"""
+    put_dated_receipt(local_aws.table, "alice", "r1", "2024-03-01")
+    local_aws.table.calls.clear()
+
+    response = patch_receipt(local_aws, "r1", {"receipt_status": "approved", "textract_data": {"VENDOR": "Kedai Buku", "DATE": None}}, if_match='"1"')
+    calls = dict(local_aws.table.calls)
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2"' and response.json()["removed_fields"] == ["DATE"]
+    item = stored_receipt(local_aws.table, "r1")
+    assert item["textract_data"] == {"TOTAL": "10.00", "VENDOR": "Kedai Buku"}
+    assert item["receipt_status"] == "approved" and item["version"] == 2
+    assert calls == {"update_item": 1}
+
+
+def test_patch_rewrites_receipts_with_offloaded_ocr_data(local_aws):
+    """Test that a patch the targeted write cannot apply falls back to a rewrite from the returned item"""
+    attributes, _ = receipt_ocr_attributes("alice", "r1", LARGE_OCR)
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "version": 1, **attributes})
+    old_key = attributes["textract_s3_path"]
+    local_aws.table.calls.clear()
+
+    response = patch_receipt(local_aws, "r1", {"textract_data": {"TOTAL": "31.00"}}, if_match='"1"')
+    calls = dict(local_aws.table.calls)
+
+    assert response.status_code == 200 and response.headers["ETag"] == '"2"'
+    item = stored_receipt(local_aws.table, "r1")
+    assert item["textract_s3_path"] != old_key and old_key not in local_aws.bucket.stored
+    assert receipt_textract_data(item) == {**LARGE_OCR, "TOTAL": "31.00"}
+    assert item["receipt_summary"]["total"] == Decimal("31.00")
+    # The failed targeted write returned the current item, so it was not read again
+    assert calls == {"update_item": 2}
+
+
+def test_patch_rewrites_receipts_without_a_summary(local_aws):
+    """Test that a receipt from before the summary gets one when it is patched"""
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "version": 3, "receipt_upload_datetime": "2024-02-10T09:00:00", "textract_data": {"TOTAL": "5.00"}})
+
+    response = patch_receipt(local_aws, "r1", {"textract_data": {"VENDOR": "Farmasi"}})
+
+    assert response.status_code == 200 and response.headers["ETag"] == '"4"'
+    item = stored_receipt(local_aws.table, "r1")
+    assert item["receipt_summary"] == {"total": Decimal("5.00"), "vendor": "Farmasi"}
+    assert item["receipt_period"] == "alice#2024#02"
+
+
+def test_patch_stale_version_and_missing_receipt(local_aws):
+    """Test that a patch against an old version is 412 and one for a missing receipt is 404"""
+    attributes, _ = receipt_ocr_attributes("alice", "r1", LARGE_OCR)
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "version": 2, **attributes})
+    before = stored_receipt(local_aws.table, "r1")
+
+    response = patch_receipt(local_aws, "r1", {"textract_data": {"TOTAL": "31.00"}}, if_match='"1"')
+    assert response.status_code == 412
+    assert stored_receipt(local_aws.table, "r1") == before
+    assert list(local_aws.bucket.stored) == [attributes["textract_s3_path"]]
+
+    assert patch_receipt(local_aws, "missing", {"textract_data": {"TOTAL": "1.00"}}).status_code == 404
+    assert patch_receipt(local_aws, "missing", {"receipt_status": "approved"}).status_code == 404
+
+
+def test_update_status_checks_existence_and_if_match(local_aws):
+    """Test that status updates return the new ETag, 412 on a stale If-Match and 404 for a missing receipt"""
+    put_receipt(local_aws.table, local_aws.bucket, "r1")
+
+    response = local_aws.client.post("/receipts/status", json={"receipt_id": "r1", "new_status": "approved"}, headers={"If-Match": '"1"'})
+    assert response.status_code == 200 and response.headers["ETag"] == '"2"'
+
+    response = local_aws.client.post("/receipts/status", json={"receipt_id": "r1", "new_status": "rejected"}, headers={"If-Match": '"1"'})
+    assert response.status_code == 412
+    assert stored_receipt(local_aws.table, "r1")["receipt_status"] == "approved"
+
+    response = local_aws.client.post("/receipts/status", json={"receipt_id": "r1", "new_status": "rejected"})
+    assert response.status_code == 200 and response.headers["ETag"] == '"3"'
+
+    response = local_aws.client.post("/receipts/status", json={"receipt_id": "missing", "new_status": "approved"})
+    assert response.status_code == 404
+    assert stored_receipt(local_aws.table, "missing") is None
+
+
+def test_update_receipt_checks_existence_and_if_match(local_aws):
+    """Test that PUT updates return the new ETag, 412 on a stale If-Match and 404 for a missing receipt"""
+    put_dated_receipt(local_aws.table, "alice", "r1", "2024-03-01")
+
+    response = local_aws.client.put("/receipts/update/r1", json={"receipt_status": "approved"}, headers={"If-Match": '"1"'})
+    assert response.status_code == 200 and response.headers["ETag"] == '"2"' and response.json()["version"] == 2
+
+    for body in ({"receipt_status": "rejected"}, {"textract_data": {"TOTAL": "1.00"}}):
+        response = local_aws.client.put("/receipts/update/r1", json=body, headers={"If-Match": '"1"'})
+        assert response.status_code == 412
+        assert local_aws.client.put("/receipts/update/missing", json=body).status_code == 404
+    item = stored_receipt(local_aws.table, "r1")
+    assert item["receipt_status"] == "approved" and item["textract_data"]["TOTAL"] == "10.00"
+    assert stored_receipt(local_aws.table, "missing") is None
+
+
+def test_delete_receipt_checks_existence_and_if_match(local_aws):
+    """Test that a delete with a stale If-Match keeps the receipt and its image, and a missing receipt is 404"""
+    s3_key = put_receipt(local_aws.table, local_aws.bucket, "r1", version=2)
+
+    assert local_aws.client.delete("/receipts/delete/r1", headers={"If-Match": '"1"'}).status_code == 412
+    assert stored_receipt(local_aws.table, "r1") is not None and s3_key in local_aws.bucket.stored
+
+    response = local_aws.client.delete("/receipts/delete/r1", headers={"If-Match": '"2"'})
+    assert response.status_code == 200
+    assert stored_receipt(local_aws.table, "r1") is None and s3_key not in local_aws.bucket.stored
+
+    assert local_aws.client.delete("/receipts/delete/r1").status_code == 404
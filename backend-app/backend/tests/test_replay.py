@@ -0,0 +1,67 @@
+import pytest
+from fastapi import Depends, FastAPI, Request
+
+from src.capture import TrafficRecorder
+from src.replay import build_request, replay, replay_user, summarize
+
+
+def make_record(recorder: TrafficRecorder, receipt_id: str, ts: float, **fields) -> dict:
+    record = {
+        "ts": ts,
+        "method": "GET",
+        "route": "/receipts/view/{receipt_id}",
+        "path_params": {"receipt_id": recorder.pseudonym(receipt_id)},
+        "query": [["year", "2024"]],
+        "user": 3,
+        "headers": {"accept": "application/json"},
+        "body": None,
+        "status": 200,
+        "duration_ms": 2.0,
+        "aws_calls": {"dynamodb.GetItem": 1},
+    }
+    record.update(fields)
+    return record
+
+
+def test_build_request_maps_pseudonyms_to_seeded_receipts():
+    """Test that one captured receipt maps to one seeded receipt wherever it appears"""
+    recorder = TrafficRecorder("unused.jsonl", "secret")
+    seeded = ["seed-a", "seed-b", "seed-c"]
+    body = {"json": {"receipt_ids": [recorder.pseudonym("r1")], "new_status": "approved"}}
+    request = build_request(make_record(recorder, "r1", 0.0, method="POST", body=body, content_type="application/json"), seeded, 0)
+    url_receipt_id = request["url"].rsplit("/", 1)[1]
+    assert url_receipt_id in seeded
+    assert request["content"] == ('{"receipt_ids": ["%s"], "new_status": "approved"}' % url_receipt_id).encode()
+    assert request["params"] == [("year", "2024")]
+    assert request["headers"]["x-replay-user"] == "replay-user-3"
+
+
+@pytest.mark.asyncio
+async def test_replay_reports_latency_and_aws_calls_per_route():
+    """Test a replay through ASGITransport with the replay user standing in for authentication"""
+    recorder = TrafficRecorder("unused.jsonl", "secret")
+    app = FastAPI()
+    seen = []
+
+    async def current_user():
+        raise AssertionError("authentication should be overridden")
+
+    @app.get("/receipts/view/{receipt_id}")
+    async def view(receipt_id: str, request: Request, user=Depends(current_user)):
+        from src.capture import count_aws_call
+
+        count_aws_call("dynamodb", "GetItem")
+        seen.append((user["username"], receipt_id, request.query_params["year"]))
+        return {"receipt_id": receipt_id}
+
+    app.dependency_overrides[current_user] = replay_user
+    records = [make_record(recorder, f"r{index}", 1000.0 + index * 0.01) for index in range(5)]
+    records.append(make_record(recorder, "r0", 1000.1, user=None, status=401))
+    results = await replay(app, records, {"replay-user-3": ["seed-a", "seed-b"]}, speed=10)
+
+    assert len(seen) == 5 and {receipt_id for _, receipt_id, _ in seen} <= {"seed-a", "seed-b"}
+    report = summarize(results)
+    stats = report["routes"]["GET /receipts/view/{receipt_id}"]
+    assert stats["requests"] == 6 and stats["errors"] == 0 and stats["status_changed"] == 0
+    assert stats["aws_calls"] == round(5 / 6, 2) and stats["captured_aws_calls"] == 1
+    assert stats["p50_ms"] <= stats["p95_ms"] <= stats["p99_ms"]
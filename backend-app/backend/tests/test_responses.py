@@ -0,0 +1,42 @@
+from decimal import Decimal
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src.responses import CompactJSONResponse, MessagePackResponse, negotiated_response
+
+RECEIPT = {"receipt_id": "r1", "receipt_size": Decimal("2048"), "receipt_summary": {"total": Decimal("12.50"), "vendor": "SHOP"}, "version": Decimal("3")}
+
+
+def make_app():
+    app = FastAPI()
+
+    @app.get("/receipt")
+    async def receipt(request: Request):
+        return negotiated_response(request, RECEIPT, headers={"ETag": '"3"'})
+
+    return app
+
+
+def test_compact_json_encodes_decimals_like_fastapi():
+    """Test that integral Decimals become integers and the rest floats, without whitespace"""
+    body = CompactJSONResponse(RECEIPT).body
+    assert body == b'{"receipt_id":"r1","receipt_size":2048,"receipt_summary":{"total":12.5,"vendor":"SHOP"},"version":3}'
+
+
+def test_negotiated_response_defaults_to_json():
+    """Test that clients that do not ask for MessagePack get JSON with the handler's headers"""
+    response = TestClient(make_app()).get("/receipt")
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["etag"] == '"3"'
+    assert "Accept" in response.headers["vary"]
+    assert response.json()["receipt_summary"]["total"] == 12.5
+
+
+def test_negotiated_response_sends_msgpack():
+    """Test that Accept: application/msgpack gets a MessagePack body"""
+    msgpack = pytest.importorskip("msgpack")
+    response = TestClient(make_app()).get("/receipt", headers={"Accept": "application/msgpack"})
+    assert response.headers["content-type"] == MessagePackResponse.media_type
+    assert msgpack.unpackb(response.content)["receipt_size"] == 2048
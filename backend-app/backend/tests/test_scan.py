@@ -0,0 +1,73 @@
+from src import utils
+from src.local_aws import FakeTable
+from src.scan import ParallelScan, ScanCheckpoint, scan_items
+
+
+def receipts_table(count=200, padding=0, page_bytes=2000, **kwargs):
+    table = FakeTable("receipt_username", "receipt_id", page_bytes=page_bytes, **kwargs)
+    for index in range(count):
+        table.put_item(Item={"receipt_username": f"user{index % 17}", "receipt_id": f"r{index:04d}", "receipt_filename": f"receipt{index}.jpg", "padding": "x" * padding})
+    return table
+
+
+def test_parallel_scan_reads_every_page_of_every_segment():
+    """Test that all items are returned across segments and LastEvaluatedKey pages"""
+    table = receipts_table()
+    scan = ParallelScan(table, total_segments=4)
+    ids = [item["receipt_id"] for page in scan for item in page]
+
+    assert sorted(ids) == sorted(item["receipt_id"] for item in table.items.values())
+    assert scan.stats["pages"] > 4
+    assert scan.checkpoint.finished
+
+
+def test_scan_resumes_from_checkpoint(tmp_path):
+    """Test that a stopped scan resumes after the last page the consumer finished"""
+    table = receipts_table()
+    path = str(tmp_path / "scan.json")
+
+    seen = []
+    for page_number, page in enumerate(ParallelScan(table, 3, ScanCheckpoint.load(path, 3))):
+        if page_number == 4:
+            # Stopped before finishing this page, so the resumed scan reads it again
+            break
+        seen.extend(item["receipt_id"] for item in page)
+
+    resumed = ParallelScan(table, 3, ScanCheckpoint.load(path, 3))
+    seen.extend(item["receipt_id"] for page in resumed for item in page)
+
+    assert sorted(seen) == sorted(item["receipt_id"] for item in table.items.values())
+    assert len(seen) == len(set(seen))
+
+
+def test_scan_backs_off_when_throttled():
+    """Test that throughput errors are retried until the scan completes"""
+    # About 130 read units against 100 per second of capacity
+    table = receipts_table(padding=5000, page_bytes=50_000, read_capacity=100)
+    scan = ParallelScan(table, total_segments=4)
+    items = [item for page in scan for item in page]
+
+    assert len(items) == 200
+    assert scan.stats["throttled"] > 0
+
+
+def test_scan_items_applies_filters_and_projections():
+    """Test that scan arguments are passed to every segment"""
+    from boto3.dynamodb.conditions import Attr
+
+    table = receipts_table()
+    items = list(scan_items(table, 2, FilterExpression=Attr("receipt_username").eq("user3"), ProjectionExpression="receipt_id"))
+    assert len(items) == 12
+    assert all(list(item) == ["receipt_id"] for item in items)
+
+
+def test_get_unique_filename_reads_all_pages(monkeypatch):
+    """Test that a taken filename is found even beyond the first page"""
+    table = FakeTable("receipt_username", "receipt_id", page_bytes=200)
+    for index in range(30):
+        table.put_item(Item={"receipt_username": "alice", "receipt_id": f"r{index:02d}", "receipt_filename": "scan.jpg" if index == 0 else f"scan({index}).jpg"})
+    monkeypatch.setattr(utils, "receipt_db", table)
+
+    assert utils.get_unique_filename("alice", "scan.jpg") == "scan(30).jpg"
+    assert utils.get_unique_filename("alice", "other.png") == "other.png"
+    assert table.calls["query"] > 1
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+import src.routers.receipts as receipts
+import src.textract as textract
+from src.local_aws import FakeTextract
+from src.utils import parse_textract_expense, parse_textract_expense_fields
+
+
+@pytest.fixture
+def fake_textract(monkeypatch):
+    """Replace the Textract client with the local stand-in"""
+    fake = FakeTextract(polls_until_done=1, page_size=1)
+    monkeypatch.setattr(textract, "receipt_textract", fake)
+    return fake
+
+
+def test_is_pdf():
+    """Test PDF detection by magic bytes"""
+    assert textract.is_pdf(b"%PDF-1.7\n...")
+    assert not textract.is_pdf(b"\xff\xd8\xff\xe0 jpeg")
+
+
+def test_get_expense_job_collects_and_merges_pages(fake_textract):
+    """Test that a finished job is paged through and merged into one document"""
+    job_id = fake_textract.start_expense_analysis(DocumentLocation={"S3Object": {"Bucket": "b", "Name": "k.pdf"}})["JobId"]
+
+    assert textract.get_expense_job(job_id) == ("IN_PROGRESS", None)
+
+    status, response = textract.get_expense_job(job_id)
+    assert status == "SUCCEEDED"
+    assert response["DocumentMetadata"]["Pages"] == 2
+    # One GetExpenseAnalysis call per page after the in-progress poll
+    assert fake_textract.calls["get_expense_analysis"] == 3
+
+    fields = parse_textract_expense_fields(response)
+    assert fields["VENDOR_NAME"] == "KEDAI BUKU SRI MAJU"
+    assert fields["TOTAL"] == "17.60"
+    assert parse_textract_expense(response)["Date:"] == "14/03/2024"
+
+
+def test_merge_expense_documents_keeps_last_total():
+    """Test that document totals come from the last page and other typed fields from the first"""
+
+    def page(index, *fields):
+        return {"ExpenseIndex": index, "SummaryFields": [{"Type": {"Text": t}, "LabelDetection": {"Text": t}, "ValueDetection": {"Text": v}} for t, v in fields]}
+
+    merged = textract.merge_expense_documents([page(2, ("TOTAL", "30.00"), ("VENDOR_NAME", "B")), page(1, ("TOTAL", "10.00"), ("VENDOR_NAME", "A"))])
+    fields = parse_textract_expense_fields(merged)
+    assert fields == {"TOTAL": "30.00", "VENDOR_NAME": "A"}
+
+
+def test_ocr_status_reports_a_job_collected_concurrently(local_aws, monkeypatch):
+    """Test that a lost race with the background task is answered from one consistent read"""
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1", "ocr_status": "processing", "textract_job_id": "job-1", "version": 1})
+    calls = []
+
+    def collected_meanwhile(username, receipt_id, job_id, expected_version):
+        calls.append(job_id)
+        local_aws.table.update_item(Key={"receipt_username": username, "receipt_id": receipt_id}, UpdateExpression="SET ocr_status = :completed, ocr_pages = :pages", ExpressionAttributeValues={":completed": "completed", ":pages": 2})
+        raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}}, "UpdateItem")
+
+    monkeypatch.setattr(receipts, "complete_expense_job", collected_meanwhile)
+    response = local_aws.client.get("/receipts/ocr/r1")
+
+    assert response.json() == {"receipt_id": "r1", "ocr_status": "completed", "ocr_pages": 2}
+    assert calls == ["job-1"]
+    assert local_aws.client.get("/receipts/ocr/missing").status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_track_expense_job_polls_off_the_event_loop(monkeypatch):
+    """Test that the blocking Textract polling runs in the threadpool"""
+    threads = []
+
+    def complete(username, receipt_id, job_id, expected_version):
+        threads.append(threading.current_thread())
+        return "processing" if len(threads) < 2 else "completed"
+
+    monkeypatch.setattr(textract, "complete_expense_job", complete)
+    monkeypatch.setattr(textract, "TEXTRACT_POLL_INTERVAL_SECONDS", 0)
+    await textract.track_expense_job("alice", "r1", "job-1")
+
+    assert len(threads) == 2 and threading.main_thread() not in threads
@@ -0,0 +1,228 @@
+from decimal import Decimal
+
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+
+import src.utils
+from src.utils import apply_merge_patch, build_receipt_summary, chunked, compile_receipt_patch, conditional_write_error, estimate_item_size, normalize_receipt_patch, parse_if_match, parse_receipt_date, receipt_date_attributes, receipt_textract_data, receipt_write_condition, replace_receipt_ocr
+
+
+def test_chunked_splits_into_limit_sized_slices():
+    """Test that chunked respects the batch size and keeps the remainder"""
+    chunks = list(chunked(list(range(205)), 100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 5]
+    assert chunks[2] == [200, 201, 202, 203, 204]
+
+
+def test_chunked_empty():
+    """Test that chunked yields nothing for an empty list"""
+    assert list(chunked([], 25)) == []
+
+
+def test_parse_if_match():
+    """Test that If-Match ETags are parsed into receipt versions"""
+    assert parse_if_match(None) is None
+    assert parse_if_match("*") is None
+    assert parse_if_match('"3"') == 3
+    assert parse_if_match('W/"7"') == 7
+
+    with pytest.raises(HTTPException) as exc_info:
+        parse_if_match('"abc"')
+    assert exc_info.value.status_code == 400
+
+
+def test_receipt_write_condition_with_version():
+    """Test that the write condition checks existence and the expected version"""
+    condition, names, values = receipt_write_condition()
+    assert condition == "attribute_exists(receipt_id)"
+    assert names == {} and values == {}
+
+    condition, names, values = receipt_write_condition(4)
+    assert "#version = :expected_version" in condition
+    assert values == {":expected_version": 4}
+
+    condition, _, values = receipt_write_condition(0)
+    assert "attribute_not_exists(#version)" in condition
+    assert values == {}
+
+
+def test_conditional_write_error_status_codes():
+    """Test that failed conditional writes map to 404 or 412"""
+    missing = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+    assert conditional_write_error(missing, "failed").status_code == 404
+
+    stale = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}, "Item": {"version": {"N": "2"}}}, "UpdateItem")
+    assert conditional_write_error(stale, "failed").status_code == 412
+
+    other = ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "UpdateItem")
+    assert conditional_write_error(other, "failed").status_code == 500
+
+
+def test_json_patch_is_folded_into_merge_patch():
+    """Test that JSON Patch operations become the equivalent merge patch"""
+    operations = [
+        {"op": "replace", "path": "/textract_data/TOTAL", "value": "12.50"},
+        {"op": "remove", "path": "/textract_data/VENDOR~1NAME"},
+        {"op": "replace", "path": "/receipt_status", "value": "approved"},
+    ]
+    patch = normalize_receipt_patch(operations, "application/json-patch+json")
+    assert patch.receipt_status == "approved"
+    assert patch.textract_data == {"TOTAL": "12.50", "VENDOR/NAME": None}
+
+    with pytest.raises(HTTPException):
+        normalize_receipt_patch([{"op": "move", "path": "/textract_data/TOTAL"}], "application/json-patch+json")
+
+
+def test_compile_receipt_patch_targets_single_fields():
+    """Test that a merge patch compiles to nested SET/REMOVE clauses"""
+    patch = normalize_receipt_patch({"textract_data": {"Cashier": "Ali", "OLD": None}}, "application/merge-patch+json")
+    expression, names, values, added_bytes = compile_receipt_patch(patch)
+
+    assert expression == "SET #textract.#f0 = :f0 REMOVE #textract.#f1"
+    assert names == {"#textract": "textract_data", "#f0": "Cashier", "#f1": "OLD"}
+    assert values == {":f0": "Ali"}
+    assert added_bytes == len("Cashier") + len("Ali") + 1
+
+
+def test_compile_receipt_patch_updates_summary_fields():
+    """Test that patching a total label also updates the receipt summary"""
+    patch = normalize_receipt_patch({"textract_data": {"TOTAL:": "12.50"}}, "application/merge-patch+json")
+    expression, names, values, _ = compile_receipt_patch(patch)
+
+    assert expression == "SET #textract.#f0 = :f0, #summary.#s_total = :s_total"
+    assert names["#summary"] == "receipt_summary"
+    assert values[":s_total"] == Decimal("12.50")
+
+
+def test_build_receipt_summary_prefers_typed_fields():
+    """Test that the summary uses Textract's typed fields over label matching"""
+    textract_data = {"Total": "10.00", "Date:": "01/02/2024", "Store": "Kedai A"}
+    summary = build_receipt_summary(textract_data)
+    assert summary == {"total": Decimal("10.00"), "date": "01/02/2024", "vendor": "Kedai A"}
+
+    summary = build_receipt_summary(textract_data, {"TOTAL": "RM 11.00", "INVOICE_RECEIPT_DATE": "2024-02-01"})
+    assert summary["total"] == Decimal("11.00")
+    assert summary["date"] == "2024-02-01"
+
+
+def test_apply_merge_patch():
+    """Test that merge patches set and remove textract fields"""
+    assert apply_merge_patch({"a": "1", "b": "2"}, {"a": None, "c": "3"}) == {"b": "2", "c": "3"}
+
+
+def test_estimate_item_size():
+    """Test that item size counts attribute names and values"""
+    assert estimate_item_size({"a": "xyz"}) == 4
+    assert estimate_item_size({"map": {"k": "v"}}) == len("map") + 3 + 1 + 1 + 1
+
+
+def test_parse_receipt_date_formats():
+    """Test that OCR'd receipt dates are normalized to ISO dates"""
+    assert parse_receipt_date("01/02/2024") == "2024-02-01"
+    assert parse_receipt_date("2024-02-01") == "2024-02-01"
+    assert parse_receipt_date("01-02-24 13:45") == "2024-02-01"
+    assert parse_receipt_date("1 Feb 2024") == "2024-02-01"
+    assert parse_receipt_date("not a date") is None
+    assert parse_receipt_date(None) is None
+
+
+def test_receipt_date_attributes():
+    """Test the period index keys for a receipt"""
+    assert receipt_date_attributes("alice", "r1", "2024-03-09") == {
+        "receipt_date": "2024-03-09",
+        "receipt_period": "alice#2024#03",
+        "receipt_date_key": "2024-03-09#r1",
+    }
+
+
+def test_batch_get_receipts_retries_unprocessed_keys_with_backoff(local_aws, monkeypatch):
+    """Test that unprocessed keys are resubmitted after a growing delay until they are read"""
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r1"})
+    local_aws.table.put_item(Item={"receipt_username": "alice", "receipt_id": "r2"})
+    batch_get_item = local_aws.dynamo.batch_get_item
+    unprocessed_rounds = [2]
+
+    def throttled_batch_get_item(RequestItems):
+        if unprocessed_rounds[0]:
+            unprocessed_rounds[0] -= 1
+            return {"Responses": {"receipts": []}, "UnprocessedKeys": RequestItems}
+        return batch_get_item(RequestItems=RequestItems)
+
+    sleeps = []
+    monkeypatch.setattr(local_aws.dynamo, "batch_get_item", throttled_batch_get_item)
+    monkeypatch.setattr(src.utils.time, "sleep", sleeps.append)
+
+    found = src.utils.batch_get_receipts("alice", ["r1", "r2", "missing"])
+
+    assert sorted(found) == ["r1", "r2"]
+    assert len(sleeps) == 2
+    assert 0 < sleeps[0] < sleeps[1]
+
+
+def test_batch_get_receipts_gives_up_after_max_retries(local_aws, monkeypatch):
+    """Test that keys left unprocessed on every call fail the read instead of looping forever"""
+    calls = []
+
+    def always_unprocessed(RequestItems):
+        calls.append(RequestItems)
+        return {"Responses": {}, "UnprocessedKeys": RequestItems}
+
+    monkeypatch.setattr(local_aws.dynamo, "batch_get_item", always_unprocessed)
+    monkeypatch.setattr(src.utils.time, "sleep", lambda delay: None)
+
+    with pytest.raises(RuntimeError):
+        src.utils.batch_get_receipts("alice", ["r1"])
+    assert len(calls) == src.utils.DYNAMO_BATCH_MAX_RETRIES + 1
+
+
+SMALL_OCR = {"VENDOR": "Kedai Buku", "TOTAL": "12.50", "DATE": "2024-03-01"}
+
+
+def large_ocr(total: str) -> dict:
+    return {**{f"Item {index}": "x" * 40 for index in range(60)}, "TOTAL": total, "DATE": "2024-04-02"}
+
+
+def ocr_objects(bucket) -> list:
+    return sorted(key for key in bucket.stored if key.startswith("ocr/"))
+
+
+def test_replace_receipt_ocr_moves_data_between_item_and_s3(local_aws):
+    """Test that OCR data above OCR_INLINE_MAX_BYTES is offloaded, moved back inline, and old objects are removed"""
+    table, bucket = local_aws.table, local_aws.bucket
+    key = {"receipt_username": "alice", "receipt_id": "r1"}
+    table.put_item(Item={**key, "version": 1, "textract_data": SMALL_OCR})
+
+    assert replace_receipt_ocr("alice", "r1", large_ocr("30.00"), expected_version=1) == 2
+    item = table.get_item(Key=key)["Item"]
+    assert "textract_data" not in item and ocr_objects(bucket) == [item["textract_s3_path"]]
+    assert item["receipt_summary"]["total"] == Decimal("30.00")
+    assert item["receipt_period"] == "alice#2024#04" and item["receipt_date_key"] == "2024-04-02#r1"
+    assert receipt_textract_data(item) == large_ocr("30.00")
+
+    first_key = item["textract_s3_path"]
+    assert replace_receipt_ocr("alice", "r1", large_ocr("31.00"), expected_version=2) == 3
+    item = table.get_item(Key=key)["Item"]
+    assert item["textract_s3_path"] != first_key and ocr_objects(bucket) == [item["textract_s3_path"]]
+
+    assert replace_receipt_ocr("alice", "r1", SMALL_OCR, expected_version=3) == 4
+    item = table.get_item(Key=key)["Item"]
+    assert item["textract_data"] == SMALL_OCR and "textract_s3_path" not in item
+    assert item["receipt_period"] == "alice#2024#03"
+    assert ocr_objects(bucket) == []
+
+
+def test_replace_receipt_ocr_removes_the_new_object_when_the_write_fails(local_aws):
+    """Test that a failed conditional write leaves the item and the current S3 object as they were"""
+    table, bucket = local_aws.table, local_aws.bucket
+    key = {"receipt_username": "alice", "receipt_id": "r1"}
+    table.put_item(Item={**key, "version": 1, "textract_data": SMALL_OCR})
+    replace_receipt_ocr("alice", "r1", large_ocr("30.00"), expected_version=1)
+    before = table.get_item(Key=key)["Item"]
+
+    with pytest.raises(ClientError) as error:
+        replace_receipt_ocr("alice", "r1", large_ocr("31.00"), expected_version=1)
+
+    assert error.value.response["Error"]["Code"] == "ConditionalCheckFailedException"
+    assert table.get_item(Key=key)["Item"] == before
+    assert ocr_objects(bucket) == [before["textract_s3_path"]]
@@ -40,6 +40,20 @@ export async function refreshToken() {
   return newAccessToken; // Return the new access token
 }
 
+// Refresh this many seconds before the access token expires
+const REFRESH_AHEAD_SECONDS = 60;
+let refreshInFlight = null;
+
+// One refresh at a time per tab; the backend also coalesces refreshes across tabs
+function refreshAhead() {
+  if (!refreshInFlight) {
+    refreshInFlight = refreshToken()
+      .catch((err) => console.warn("Refresh-ahead failed:", err))
+      .finally(() => { refreshInFlight = null; });
+  }
+  return refreshInFlight;
+}
+
 // Utility function to perform fetch requests with authentication headers and refresh logic
 async function authenticatedFetch(url, options = {}) {
   let accessToken = localStorage.getItem('access_token');
@@ -68,6 +82,12 @@ async function authenticatedFetch(url, options = {}) {
     return res; 
   }
 
+  // The backend reports how long the access token has left; refresh before it runs out
+  const expiresIn = res.headers.get('X-Token-Expires-In');
+  if (expiresIn !== null && Number(expiresIn) < REFRESH_AHEAD_SECONDS) {
+    refreshAhead();
+  }
+
   // For any other status, or if not 401, just return the response
   return res;
 }
@@ -14,8 +14,19 @@ const Dashboard = () => {
   const [selectedYear, setSelectedYear] = useState(latestYear.toString());
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
+  const [refreshKey, setRefreshKey] = useState(0);
   const API_BASE_URL = import.meta.env.VITE_API_BASE_URL;
 
+  // Re-fetch when the server pushes a receipt change, instead of polling
+  useEffect(() => {
+    const events = new EventSource(`${API_BASE_URL}/receipts/events`, { withCredentials: true });
+    const refresh = () => setRefreshKey((key) => key + 1);
+    ['ocr_completed', 'status_changed', 'receipt_updated', 'receipt_deleted'].forEach((type) =>
+      events.addEventListener(type, refresh)
+    );
+    return () => events.close();
+  }, [API_BASE_URL]);
+
   // Fetch Receipt View API, render to receipt dashboard component
   useEffect(() => {
     const url = `${API_BASE_URL}/receipts/view`;
@@ -32,7 +43,7 @@ const Dashboard = () => {
         setError('No receipts found');
         setLoading(false);
       });
-  }, [API_BASE_URL]);
+  }, [API_BASE_URL, refreshKey]);
 
   // Fetch Total claims based on the year filtered
   useEffect(() => {
@@ -49,7 +60,7 @@ const Dashboard = () => {
         setTotalClaim(0);
         console.error('No total claims found:', err);
       });
-  }, [selectedYear, API_BASE_URL]);
+  }, [selectedYear, API_BASE_URL, refreshKey]);
 
   return (
     <>
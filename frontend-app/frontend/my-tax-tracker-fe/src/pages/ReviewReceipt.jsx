@@ -153,18 +153,33 @@ const ReviewReceipt = () => {
     
     setIsSaving(true);
     try {
-      // Save textract data changes
-      const textractResponse = await fetchWithAuth(`${API_BASE_URL}/receipts/update/${receiptId}`, {
-        method: 'PUT',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          textract_data: editingTextractData
-        }),
+      // Save only the changed textract fields as a merge patch (null removes a field)
+      const originalTextractData = receipt?.textract_data || {};
+      const textractChanges = {};
+      Object.keys(originalTextractData).forEach(key => {
+        if (!(key in editingTextractData)) {
+          textractChanges[key] = null;
+        }
+      });
+      Object.entries(editingTextractData).forEach(([key, value]) => {
+        if (originalTextractData[key] !== value) {
+          textractChanges[key] = value;
+        }
       });
 
-      if (!textractResponse.ok) throw new Error('Failed to update receipt data');
+      if (Object.keys(textractChanges).length > 0) {
+        const textractResponse = await fetchWithAuth(`${API_BASE_URL}/receipts/update/${receiptId}`, {
+          method: 'PATCH',
+          headers: {
+            'Content-Type': 'application/merge-patch+json',
+          },
+          body: JSON.stringify({
+            textract_data: textractChanges
+          }),
+        });
+
+        if (!textractResponse.ok) throw new Error('Failed to update receipt data');
+      }
 
       // Save status changes if any
       if (statusChanged && newStatus) {